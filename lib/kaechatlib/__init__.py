@@ -236,8 +236,17 @@ class NetworkConfig(object):
 
         This is a 2-tuple, `(host, port)'. `host' is the hostname or IP address
         (a string), and `port' is the port number (an integer).
+
+        If the network has several servers, this is the first one.
+        """
+        return self._addresses[0]
+
+    @property
+    def addresses(self):
+        """List of addresses of the servers of this network, in the order
+        they should be tried. Each one is a 2-tuple like `address'.
         """
-        return self._address
+        return self._addresses
 
     @property
     def username(self):
@@ -267,9 +276,15 @@ class NetworkConfig(object):
 
     def __init__(self, name, address, username=None, realname=None, nicks=None,
       autoconnect=False, channels=None):
-        """Construct a new `NetworkConfig' object with the given parameters."""
+        """Construct a new `NetworkConfig' object with the given parameters.
+
+        `address' is either a single address, or a list of addresses (see
+        `addresses').
+        """
         self._name = name
-        self._address = address
+        if isinstance(address, tuple):
+            address = [ address ]
+        self._addresses = list(address)
         self._username = username
         self._realname = realname
         self._nicks = nicks
@@ -278,6 +293,36 @@ class NetworkConfig(object):
 
 #=============================================================================
 
+def parse_addresses(text):
+    """Parse a comma-separated list of addresses in the format
+    `<host>/<port>', as used in the configuration file, and return a list of
+    `(host, port)' tuples. The port defaults to 6667 if not specified or not
+    valid. Empty entries are skipped.
+    """
+    addresses = [ ]
+    for item in text.split(','):
+        item = item.strip().split('/', 1)
+        if not item[0]:
+            continue
+        if len(item) >= 2:
+            host, port = item
+        else:
+            host, port = item[0], 6667
+        try:
+            port = int(port)
+        except ValueError:
+            port = 6667
+        addresses.append((host.strip(), port))
+    return addresses
+
+def format_addresses(addresses):
+    """Return a list of addresses formatted as expected by
+    `parse_addresses()'.
+    """
+    return ",".join("%s/%d" % address for address in addresses)
+
+#=============================================================================
+
 def load_networks():
     """Load the network list.
 
@@ -289,24 +334,16 @@ def load_networks():
         if sect.startswith("networks/"):
             netid = sect[9:]
             name = _kc.get(sect, "name", netid)
-            address = _kc.get(sect, "address", netid).split('/', 1)
-            if len(address) >= 2:
-                host, port = address
-            else:
-                host, port = address[0], 6667
-            try:
-                port = int(port)
-            except ValueError:
-                port = 6667
-            address = (host, port)
+            addresses = (parse_addresses(_kc.get(sect, "address", netid))
+              or [ (netid, 6667) ])
             logname = os.getenv("LOGNAME") or os.getenv("USER") or "KaeChat"
             username = _kc.get(sect, "username")
             realname = _kc.get(sect, "realname")
             nicks = _kc.get_list(sect, "nicks")
             autoconnect = _kc.get_bool(sect, "autoconnect", False)
             channels = _kc.get_list(sect, "channels")
-            networks[netid] = NetworkConfig(name, address, username, realname,
-              nicks, autoconnect, channels)
+            networks[netid] = NetworkConfig(name, addresses, username,
+              realname, nicks, autoconnect, channels)
 
 #=============================================================================
 
@@ -320,7 +357,7 @@ def save_networks():
         sect = "networks/" + netid
         net = networks[netid]
         _kc.set(sect, "name", net.name)
-        _kc.set(sect, "address", "%s/%d" % net.address)
+        _kc.set(sect, "address", format_addresses(net.addresses))
         if net.username:
             _kc.set(sect, "username", net.username)
         if net.realname:
@@ -7,12 +7,15 @@ import os
 import threading
 import time
 import re
+import random
 import socket
+import ssl
 
 import kaechatlib as _kl
 import kaechatlib.config as _kc
 
 import kaeirc
+import kaeirc.loop
 import kaeirc.util
 
 #=============================================================================
@@ -28,12 +31,74 @@ def _show_notification(title, message):
 
 #=============================================================================
 
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+def get_event_loop():
+    """Return the `kaeirc.loop.EventLoop' shared by all the networks.
+
+    The loop is created, and it's thread started, on first use.
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = kaeirc.loop.EventLoop()
+            t = threading.Thread(target=_event_loop.run, name="EventLoop")
+            t.daemon = True
+            t.start()
+        return _event_loop
+
+#=============================================================================
+
+def _reconnect_delay(failures):
+    # Exponential backoff, with half of the delay randomized, so clients
+    # disconnected at the same time (for example by a netsplit) don't come
+    # back all at once.
+    delay = min(_kc.reconnect_max_delay,
+      _kc.reconnect_delay * (2 ** min(failures - 1, 16)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+#=============================================================================
+
+_member_mode_texts = {
+    "+q": "gives channel owner status to %s",
+    "-q": "removes channel owner status from %s",
+    "+a": "gives channel admin status to %s",
+    "-a": "removes channel admin status from %s",
+    "+o": "gives channel operator status to %s",
+    "-o": "removes channel operator status from %s",
+    "+h": "gives half-operator status to %s",
+    "-h": "removes half-operator status from %s",
+    "+v": "gives voice status to %s",
+    "-v": "removes voice status from %s",
+}
+
+_list_mode_texts = {
+    "+b": "sets ban on %s",
+    "-b": "unsets ban on %s",
+    "+q": "sets quiet status on %s",
+    "-q": "unsets quiet status on %s",
+    "+e": "sets ban exception on %s",
+    "-e": "unsets ban exception on %s",
+    "+I": "sets invite exception on %s",
+    "-I": "unsets invite exception on %s",
+}
+
+#=============================================================================
+
 class ClientThread(threading.Thread):
     """Thread handling the IRC connection.
 
-    This thread is responsible for constructing, connecting, and polling the
-    IRC client, and dispatching methods to the specified
+    This thread is responsible for constructing and connecting the IRC client,
+    and dispatching methods to the specified
     `kaechatlib.ui.networkframe.NetworkFrame' as required.
+
+    Once connected, the client is handed over to the event loop shared by all
+    networks (see `get_event_loop()'), and the thread waits until the
+    connection is lost. It then connects again (unless disabled in the
+    configuration), trying the servers of the network in turn, with an
+    increasing delay between failed attempts. The client keeps its channels
+    across connections, so the channel frames are kept too.
     """
 
     @property
@@ -57,38 +122,85 @@ class ClientThread(threading.Thread):
         self._frame = frame
         net = frame.network
         self._nick_index = 0
+        self._quit_channels = [ ]
+        self._updates = frame.updates
+        self._stopping = False
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
         nick = self._get_next_nick()
         username = (net.username or _kc.default_username)
         realname = (net.realname or _kc.default_realname)
         self._client = kaeirc.Client(username, frame.network.address,
           nickname=nick, realname=realname)
+        self._client.set_flood_control(_kc.flood_burst, _kc.flood_rate)
         self._client.add_listener(self)
 
     def run(self):
         """Main body of the thread. Called by the `start()' method."""
-        self.frame.echo("Connecting to %s:%d..." % self._frame.network.address,
-          channel=_kl.SERVER_CHANNEL, event=_kl.NOTICE_EV)
-        try:
-            self._client.connect()
-        except socket.error as e:
-            self._frame.echo("Error connecting: %s" % str(e),
+        addresses = self._frame.network.addresses
+        index = 0
+        failures = 0
+        first = True
+        while not self._stopping:
+            if failures:
+                delay = _reconnect_delay(failures)
+                self._echo("Reconnecting in %.1f seconds..." % delay,
+                  channel=_kl.SERVER_CHANNEL, event=_kl.NOTICE_EV)
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                if self._stopping:
+                    break
+            address = addresses[index % len(addresses)]
+            self._client.address = address
+            self._echo("Connecting to %s:%d..." % address,
               channel=_kl.SERVER_CHANNEL, event=_kl.NOTICE_EV)
-            self._frame.active = False
-            return
-        if self._frame.network.channels:
-            for chan in self._frame.network.channels:
-                self._client.join(chan)
-        while self._client.connected:
-            self._client.poll()
-            time.sleep(0.01)
+            self._closed.clear()
+            try:
+                self._client.connect()
+            except (socket.error, ssl.SSLError, kaeirc.ConnectionError) as e:
+                self._echo("Error connecting: %s" % str(e),
+                  channel=_kl.SERVER_CHANNEL, event=_kl.NOTICE_EV)
+                if not _kc.reconnect:
+                    break
+                # Try the next server.
+                index += 1
+                failures += 1
+                continue
+            failures = 0
+            if first and self._frame.network.channels:
+                self._client.join_channels(self._frame.network.channels)
+            first = False
+            get_event_loop().add_client(self._client)
+            self._closed.wait()
+            if self._stopping or not _kc.reconnect:
+                break
+            failures = 1
+        self._frame.active = False
 
     def stop(self):
         """Tells the thread to stop itself.
 
-        This just calls `disconnect()' on the client instance.
+        This calls `disconnect()' on the client instance, and cancels any
+        pending reconnection.
         """
+        self._stopping = True
+        self._wakeup.set()
+        self._closed.set()
         self._client.disconnect(_kl.FULL_VERSION_STR)
 
+    def _echo(self, text, who=None, channel=None, prefix="", event=None):
+        # The frame must only be used from the Tk thread; see
+        # `kaechatlib.ui.updates'.
+        self._updates.echo(self._frame, text, who=who, channel=channel,
+          prefix=prefix, event=event)
+
+    def _refresh_userlist(self, channel):
+        self._updates.refresh_userlist(self._frame, channel)
+
+    def _change_userlist(self, channel, *change):
+        # See `kaechatlib.ui.userlist.UserListModel' for the changes.
+        self._updates.change_userlist(self._frame, channel, change)
+
     def _get_next_nick(self):
         nicks = self._frame.network.nicks or _kc.default_nicks
         if self._nick_index < len(nicks):
@@ -98,13 +210,45 @@ class ClientThread(threading.Thread):
             r = _kl.random_nick()
         return r
 
+    def _on_disconnected(self, who, requested):
+        if not requested:
+            self._echo("Connection lost.", channel=_kl.SERVER_CHANNEL,
+              event=_kl.NOTICE_EV)
+        else:
+            self._stopping = True
+        self._closed.set()
+
+    def _on_resync(self, who, channel, joined, left):
+        # Called instead of rebuilding the channel when it's joined again
+        # after reconnecting; only report what changed meanwhile.
+        parts = [ ]
+        if joined:
+            parts.append("%d joined (%s)" % (len(joined),
+              ", ".join(sorted(joined)[:10])
+              + (", ..." if len(joined) > 10 else "")))
+        if left:
+            parts.append("%d left (%s)" % (len(left),
+              ", ".join(sorted(left)[:10]) + (", ..." if len(left) > 10 else "")))
+        if parts:
+            self._echo("While disconnected: %s" % "; ".join(parts),
+              channel=channel, event=_kl.JOIN_EV)
+
     def _on_join(self, who, channel):
         if who[0] == self.client.nickname:
             text = "Now talking on %s" % channel
         else:
             text = "%s (%s@%s) joined %s" % (who[0], who[1], who[2], channel)
-        self._frame.echo(text, channel=channel, event=_kl.JOIN_EV)
-        self._frame.refresh_userlist(channel)
+        self._echo(text, channel=channel, event=_kl.JOIN_EV)
+        if who[0] != self.client.nickname:
+            # Our own join is followed by the `NAMES' list; the user list is
+            # refreshed when it ends.
+            self._change_userlist(channel, "add", who[0])
+        cur = self._frame.cur_channel
+        if (not cur) or (cur[0] == '('):
+            self._updates.post(self._select_first_channel, channel)
+
+    def _select_first_channel(self, channel):
+        # Run in the Tk thread, after any previous joins were shown.
         if  (not self._frame.cur_channel) \
          or (self._frame.cur_channel[0] == '('):
             self._frame.select_channel(channel)
@@ -114,8 +258,11 @@ class ClientThread(threading.Thread):
             text = "You left %s (%s)" % (channel, reason)
         else:
             text = "%s left %s (%s)" % (who[0], channel, reason)
-        self._frame.echo(text, channel=channel, event=_kl.PART_EV)
-        self._frame.refresh_userlist(channel)
+        self._echo(text, channel=channel, event=_kl.PART_EV)
+        if who[0] == self._client.nickname:
+            self._refresh_userlist(channel)
+        else:
+            self._change_userlist(channel, "remove", who[0])
 
     def _on_privmsg(self, who, channel, text):
         if channel == self._client.nickname:
@@ -142,20 +289,20 @@ class ClientThread(threading.Thread):
             self._on_privmsg_ctcp(who, channel, cmd, args)
             return
         if text:
-            self._frame.echo(text, who=who[0], channel=channel, prefix=prefix,
+            self._echo(text, who=who[0], channel=channel, prefix=prefix,
                 event=event)
             if hi:
                 _show_notification("PRIVMSG from %s:" % who[0], text)
                 if _kc.highlights_to_chan:
                     if prefix is None:
                         prefix = ""
-                    self._frame.echo(text, who=who[0],
+                    self._echo(text, who=who[0],
                       channel=_kl.HIGHLIGHTS_CHANNEL,
                       prefix=("[%s] %s" % (channel, prefix)),
                       event=_kl.MESSAGE_EV)
 
     def _on_privmsg_ctcp(self, who, channel, cmd, args):
-        self._frame.echo("Received CTCP %s from %s." % (cmd, who[0]))
+        self._echo("Received CTCP %s from %s." % (cmd, who[0]))
         reply = None
         fn = "_on_privmsg_ctcp_" + cmd.lower()
         if hasattr(self, fn):
@@ -165,7 +312,7 @@ class ClientThread(threading.Thread):
           and (cmd.lower() in _kc.config.options("ctcp"))):
             reply = _kc.config.get("ctcp", cmd)
         if reply:
-            self._frame.echo("Sent: %s" % reply)
+            self._echo("Sent: %s" % reply)
             self._client.notice_ctcp(who[0], "%s %s" % (cmd.upper(), reply))
 
     def _on_privmsg_ctcp_version(self, who, channel, args):
@@ -180,7 +327,7 @@ class ClientThread(threading.Thread):
     def _on_notice(self, who, channel, text):
         if text.startswith('\1') and (text[-1] == '\1'):
             text = text[1:-1]
-            self._frame.echo("Received CTCP reply from %s: %s" % (who[0], text))
+            self._echo("Received CTCP reply from %s: %s" % (who[0], text))
             return
         hi = False
         l = _nick_re.findall(text)
@@ -192,162 +339,167 @@ class ClientThread(threading.Thread):
         event = _kl.HIGHLIGHT_EV if hi else _kl.NOTICE_EV
         if _kc.notices_to_chan:
             channel = _kl.NOTICES_CHANNEL
-        elif kaeirc.nick_equals(channel, self.client.nickname):
+        elif self.client.nick_equals(channel, self.client.nickname):
             channel = who[0]
         prefix = None if _kc.notices_to_chan else "[notice] "
-        self._frame.echo(text, who=who[0], channel=channel, event=event,
+        self._echo(text, who=who[0], channel=channel, event=event,
           prefix=prefix)
         if hi:
             _show_notification("NOTICE from %s:" % who[0], text)
 
     def _on_topic(self, who, channel, newtopic):
-        self._frame.echo("%s changed topic to: %s" % (who[0], newtopic),
+        self._echo("%s changed topic to: %s" % (who[0], newtopic),
           channel=channel, event=_kl.TOPIC_CHANGE_EV)
-        self._frame.get_channel_frame(channel)._topicvar.set(newtopic)
+        self._updates.post(self._frame.set_topic, channel, newtopic)
 
     def _before_quit(self, who, reason=None):
+        self._quit_channels = [ ]
         if who[0] != self._client.nickname:
-            for channel in self._client.channels:
-                chan = self._client.channels[channel]
-                if who[0] in chan.nicknames:
-                    self._frame.echo("%s quit%s" % (who[0],
-                      (" (%s)" % reason) if reason is not None else ""),
-                      channel=channel, event=_kl.QUIT_EV)
+            user = self._client.users.get(who[0])
+            if user is None:
+                return
+            self._quit_channels = [ chan.name for chan in user.channels ]
+            text = "%s quit%s" % (who[0],
+              (" (%s)" % reason) if reason is not None else "")
+            for channel in self._quit_channels:
+                self._echo(text, channel=channel, event=_kl.QUIT_EV)
 
     def _on_quit(self, who, reason=None):
-        for name in self._frame._channel_frames:
-            f = self._frame._channel_frames[name]
-            f.refresh_userlist()
+        for channel in self._quit_channels:
+            self._change_userlist(channel, "remove", who[0])
+        self._quit_channels = [ ]
 
     def _on_kick(self, who, channel, nickname, reason=None):
         if nickname == self._client.nickname:
             text = "You were kicked by %s (%s)" % (who[0], reason or who[0])
         else:
             text = "%s was kicked by %s (%s)" % (nickname, who[0], reason)
-            self._frame.refresh_userlist(channel)
-        self._frame.echo(text, channel=channel, event=_kl.KICK_EV)
+            self._change_userlist(channel, "remove", nickname)
+        self._echo(text, channel=channel, event=_kl.KICK_EV)
 
     def _on_nick(self, who, nickname):
-        if who[0] == self._client.nickname:
-            self._frame.nicklabel.configure(text=nickname)
+        # `Client' already renamed the user, so look it up by it's new name.
+        if self._client.nick_equals(nickname, self._client.nickname):
+            self._updates.post(self._frame._nicklabel.configure,
+              text=nickname)
             text = "You are now known as %s" % nickname
         else:
             text = ("%s is now known as %s" % (who[0], nickname))
-        for name in self.frame._channel_frames:
-            if not name[0] in kaeirc.CHANNEL_PREFIXES: continue
-            ul = self._client.channels[name].nicknames
-            if who[0] in ul:
-                f = self._frame._channel_frames[name]
-                mode = ul[who[0]]
-                del ul[who[0]]
-                ul[nickname] = mode
-                f.refresh_userlist()
-                self._frame.echo(text, channel=name, event=_kl.NICK_CHANGE_EV)
-
-    def _on_mode(self, who, channel, mode, arg1=None, arg2=None):
-        if channel[0] in kaeirc.CHANNEL_PREFIXES:
-            op = True
-            chan = self._client.channels[channel]
-            op = (mode[0] == '+')
-            c = mode[1]
-            text = None
-            if c == 'o':
-                nickname = arg1
-                if nickname is not None:
-                    if op:
-                        text = "%s gives channel operator status to %s"
-                    else:
-                        text = "%s removes channel operator status from %s"
-                    text = text % (who[0], nickname)
-                    self._frame.refresh_userlist(channel)
-            elif c == 'v':
-                nickname = arg1
-                if nickname is not None:
-                    if op:
-                        text = "%s gives voice status to %s"
-                    else:
-                        text = "%s removes voice status from %s"
-                    text = (text % (who[0], nickname))
-                    self._frame.refresh_userlist(channel)
-            elif c == 'q':
-                mask = arg1
-                if op:
-                    text = "%s sets quiet status on %s"
-                else:
-                    text = "%s unsets quiet status on %s"
-                text = text % (who[0], mask)
-            elif c == 'b':
-                mask = arg1
-                if op:
-                    text = "%s sets ban on %s"
-                else:
-                    text = "%s unsets ban on %s"
-                text = text % (who[0], mask)
-            if text is None:
-                nickname = arg1
-                if nickname is not None:
-                    text = "%s gives mode %s to %s"
-                else:
-                    text = "%s changes mode %s to %s"
-                text = text % (who[0], mode, channel)
-            self._frame.echo(text, channel=channel, event=_kl.MODE_CHANGE_EV)
+        user = self._client.users.get(nickname)
+        if user is None:
+            return
+        for chan in user.channels:
+            self._change_userlist(chan.name, "rename", who[0], nickname)
+            self._echo(text, channel=chan.name,
+              event=_kl.NICK_CHANGE_EV)
+
+    def _on_mode(self, who, channel, mode=None, *args):
+        if (mode is None) or not self._client.is_channel(channel):
+            return
+        isupport = self._client.isupport
+        changes = isupport.parse_modes(mode, args)
+        # Build a single line for all the changes, grouping consecutive
+        # changes of the same mode ("gives voice status to a, b, c").
+        parts = [ ]
+        members = [ ]
+        last, targets = None, [ ]
+        for (m, arg) in changes + [ (None, None) ]:
+            if (m != last) or (arg is None):
+                if last is not None:
+                    parts.append(self._mode_text(last, targets))
+                last, targets = m, [ ]
+            if m is None:
+                break
+            if arg is not None:
+                targets.append(arg)
+            if (m[1] in isupport.prefix_modes) and (arg is not None):
+                members.append(arg)
+        chan = self._client.channels.get(channel)
+        if members and (chan is not None):
+            for nickname in members:
+                ni = chan.nicknames.get(nickname)
+                if ni is not None:
+                    self._change_userlist(channel, "set_status", nickname,
+                      ni.status)
+        if parts:
+            self._echo("%s %s" % (who[0], "; ".join(parts)),
+              channel=channel, event=_kl.MODE_CHANGE_EV)
+
+    def _mode_text(self, mode, targets):
+        if mode[1] in self._client.isupport.prefix_modes:
+            text = _member_mode_texts.get(mode)
+        else:
+            text = _list_mode_texts.get(mode)
+        if text is None:
+            if targets:
+                return "sets mode %s %s" % (mode, " ".join(targets))
+            return "sets mode %s" % mode
+        return text % ", ".join(targets)
 
     def _on_rpl_welcome(self, who, nickname, message):
-        self._frame._nicklabel.configure(text=nickname)
-        self._frame.echo(message, channel=_kl.SERVER_CHANNEL,
+        self._updates.post(self._frame._nicklabel.configure, text=nickname)
+        self._echo(message, channel=_kl.SERVER_CHANNEL,
           event=_kl.NOTICE_EV)
         # TODO: Implement some kind of `select_network' function.
         # XXX: It's done, need to use it here.
-        _kl.mainframe._notebook.raise_page(self._frame._pagename)
+        self._updates.post(_kl.mainframe._notebook.raise_page,
+          self._frame._pagename)
 
     def _on_rpl_topic(self, who, _, channel, topic):
-        self._frame.echo("Topic for %s: %s" % (channel, topic),
+        self._echo("Topic for %s: %s" % (channel, topic),
           channel=channel, event=_kl.TOPIC_CHANGE_EV)
-        self._frame.get_channel_frame(channel)._topicvar.set(topic)
+        self._updates.post(self._frame.set_topic, channel, topic)
 
     # XXX: `rpl_topicsetby' was added manually and may need changing in the
     #      future.
     def _on_rpl_topicsetby(self, who, _, channel, mask, secs):
         st = time.strftime("%c", time.localtime(int(secs)))
-        self._frame.echo("Topic for %s set by %s on %s" % (channel, mask, st),
+        self._echo("Topic for %s set by %s on %s" % (channel, mask, st),
           channel=channel, event=_kl.TOPIC_CHANGE_EV)
 
     def _on_rpl_endofnames(self, who, me, channel, message):
-        self._frame.refresh_userlist(channel)
+        # Channels joined in batches are refreshed when the batch is done.
+        if not self._client.is_joining(channel):
+            self._refresh_userlist(channel)
+
+    def _on_join_batch(self, who, channels):
+        for channel in channels:
+            self._refresh_userlist(channel)
 
     def _on_rpl_whoisuser(self, who, me, nickname, username, host, _, realname):
-        self._frame.echo("%s is %s@%s; Real name: %s"
+        self._echo("%s is %s@%s; Real name: %s"
           % (nickname, username, host, realname))
 
-    def _on_rpl_channelmodeis(self, who, me, channel, mode, _):
-        self._frame.echo("Mode of %s is: %s" % (channel, mode))
+    def _on_rpl_channelmodeis(self, who, me, channel, mode="", *args):
+        self._echo("Mode of %s is: %s" % (channel,
+          " ".join((mode,) + args)))
 
     def _on_rpl_away(self, who, me, nickname, awaymsg):
-        self._frame.echo("%s is away: %s" % (nickname, awaymsg),
+        self._echo("%s is away: %s" % (nickname, awaymsg),
           channel=nickname, event=_kl.NOTICE_EV)
 
     def _on_rpl_unaway(self, who, me, message):
-        self._frame.echo(message)
+        self._echo(message)
 
     def _on_rpl_nowaway(self, who, me, message):
-        self._frame.echo(message)
+        self._echo(message)
 
     def _before_err_nicknameinuse(self, who, me, nickname, message):
-        self._frame.echo("%s: %s" % (nickname, message))
+        self._echo("%s: %s" % (nickname, message))
         if not self._client.authed:
             nickname = self._get_next_nick()
-            self._frame.echo("Trying `%s'..." % nickname)
+            self._echo("Trying `%s'..." % nickname)
             self._client.nick(nickname)
             return True
 
     def _tgt_msg_error(self, who, me, target, message):
-        self._frame.echo("%s: %s" % (target, message))
+        self._echo("%s: %s" % (target, message))
 
     _on_err_chanoprivsneeded = _tgt_msg_error
     _on_err_nosuchnick = _tgt_msg_error
 
     def _server_message(self, who, me, message):
-        self._frame.echo(message, channel=_kl.SERVER_CHANNEL,
+        self._echo(message, channel=_kl.SERVER_CHANNEL,
           event=_kl.NOTICE_EV)
 
     _on_rpl_yourhost = _server_message
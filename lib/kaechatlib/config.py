@@ -12,7 +12,9 @@ DEFAULT_FILE = os.path.join(os.getenv("HOME") or ".", ".kaechat", FILENAME)
 def update_config():
     global nick_complete_suffix, notices_to_chan, highlights_to_chan, \
            default_username, default_realname, default_nicks, \
-           default_quit_message, default_part_message, confirm_quit
+           default_quit_message, default_part_message, confirm_quit, \
+           flood_burst, flood_rate, reconnect, reconnect_delay, \
+           reconnect_max_delay, scrollback_lines, scrollback_log_dir
     nick_complete_suffix = get("chat", "nick_complete_suffix", ", ")
     notices_to_chan = get_bool("chat", "notices_to_chan", False)
     highlights_to_chan = get_bool("chat", "highlights_to_chan", True)
@@ -21,7 +23,14 @@ def update_config():
     default_nicks = get_list("networks", "nicks")
     default_quit_message = get("chat", "default_quit_message")
     default_part_message = get("chat", "default_part_message")
+    scrollback_lines = int(get_float("chat", "scrollback_lines", 5000))
+    scrollback_log_dir = get("chat", "scrollback_log_dir")
     confirm_quit = get_bool("general", "confirm_quit")
+    flood_burst = int(get_float("networks", "flood_burst", 10))
+    flood_rate = get_float("networks", "flood_rate", 0.5)
+    reconnect = get_bool("networks", "reconnect", True)
+    reconnect_delay = get_float("networks", "reconnect_delay", 2.0)
+    reconnect_max_delay = get_float("networks", "reconnect_max_delay", 300.0)
 
 def reload_config(bd):
     global basedir, config
@@ -85,6 +94,15 @@ def get_bool(section, option, default=False):
                 return False
     return default
 
+def get_float(section, option, default=0.0):
+    t = get(section, option, None)
+    if t is not None:
+        try:
+            return float(t)
+        except ValueError:
+            pass
+    return default
+
 def set_bool(section, option, value):
     t = "true" if value else "false"
     set(section, option, t)
@@ -19,6 +19,9 @@ import kaechatlib.ui as _kui
 import kaechatlib.ui.networklist as _kuinl
 import kaechatlib.ui.preferences as _kuipf
 import kaechatlib.ui.about as _kuiab
+import kaechatlib.ui.updates as _kuiup
+import kaechatlib.ui.scrollback as _kuisb
+import kaechatlib.ui.userlist as _kuiul
 
 #=============================================================================
 
@@ -69,6 +72,13 @@ class ChannelFrame(Tix.Frame):
         """The name of the channel."""
         return self._channel
 
+    @property
+    def scrollback(self):
+        """The `kaechatlib.ui.scrollback.Scrollback' keeping count of the
+        lines in the text box.
+        """
+        return self._scrollback
+
     def __init__(self, frame, channel):
         """Constructs a new `ChannelFrame' instance for the given channel.
 
@@ -81,10 +91,19 @@ class ChannelFrame(Tix.Frame):
         self._init_widgets()
         self._init_bindings()
         self._event = _k.IDLE_EV
+        self._scrollback = _kuisb.Scrollback(self._textbox)
+        self.reload_config()
 
     def reload_config(self):
         """Reload the configuration for this channel."""
-        pass
+        self._scrollback.limit = _kc.scrollback_lines
+        if _kc.scrollback_log_dir:
+            name = self._channel.replace(os.sep, "_")
+            self._scrollback.log = os.path.join(
+              os.path.expanduser(_kc.scrollback_log_dir),
+              self._frame.network.name.replace(os.sep, "_"), name + ".log")
+        else:
+            self._scrollback.log = None
 
     def echo(self, text, who=None, prefix=None):
         """Print a string to the text box.
@@ -102,29 +121,60 @@ class ChannelFrame(Tix.Frame):
         WHO is colored based on it's hash value. The colors are taken from the
         `colors' member if it's not None, or from `default_colors'.
         """
+        self.echo_lines([ (text, who, prefix) ])
+
+    def echo_lines(self, lines):
+        """Print many strings to the text box at once.
+
+        `lines' is a list of `(text, who, prefix)' tuples, with the same
+        meaning as the arguments to `echo()'. All the text is inserted with a
+        single call. The text box is scrolled to the end only if it was
+        already showing the end.
+        """
         tb = self._textbox
+        args, count = self._render_lines(lines)
+        if not args:
+            return
+        atend = (tb.yview()[1] >= 1.0)
         tb.configure(state=Tix.NORMAL)
+        tb.insert(Tix.END, *args)
+        self._scrollback.added(count)
+        tb.configure(state=Tix.DISABLED)
+        if atend:
+            tb.yview_moveto(1.0)
+
+    def _render_lines(self, lines):
+        # Returns the arguments to `Text.insert()' after the index, as a flat
+        # sequence of text, tags, text, tags, and so on (consecutive untagged
+        # pieces are joined), and the number of lines.
         colors = self.colors or self.default_colors
-        for line in text.splitlines():
-            tb.insert(Tix.END, time.strftime("[%H:%M:%S] "))
-            if prefix is not None:
-                tb.insert(Tix.END, prefix)
-            if who is not None:
-                tb.insert(Tix.END, "<%s>" % who,
-                  "color_%d" % (hash(who) % len(colors)))
-            else:
-                tb.insert(Tix.END, "***")
-            tb.insert(Tix.END, " ")
-            for (part, tag) in self._format_message(line):
-                if tag is None:
-                    tb.insert(Tix.END, part)
+        stamp = time.strftime("[%H:%M:%S] ")
+        args = [ ]
+        plain = [ ]
+        count = 0
+        for (text, who, prefix) in lines:
+            for line in text.splitlines():
+                count += 1
+                plain.append(stamp)
+                if prefix is not None:
+                    plain.append(prefix)
+                if who is not None:
+                    args.extend(("".join(plain), (), "<%s>" % who,
+                      "color_%d" % (hash(who) % len(colors))))
+                    plain = [ ]
                 else:
-                    tb.insert(Tix.END, part, tag)
-            tb.insert(Tix.END, "\n")
-        tb.configure(state=Tix.DISABLED)
-        t, b = tb.yview()
-        h = b - t
-        tb.yview_moveto(1 - h)
+                    plain.append("***")
+                plain.append(" ")
+                for (part, tag) in self._format_message(line):
+                    if tag is None:
+                        plain.append(part)
+                    else:
+                        args.extend(("".join(plain), (), part, tag))
+                        plain = [ ]
+                plain.append("\n")
+        if plain:
+            args.extend(("".join(plain), ()))
+        return args, count
 
     def clear(self, line=0):
         """Clear the text box.
@@ -134,47 +184,58 @@ class ChannelFrame(Tix.Frame):
         If it's negative, the text from line `line' to the beginning of the
         text is cleared.
         """
-        tb = self.textbox.text
+        tb = self._textbox
         tb.configure(state=Tix.NORMAL)
         if line == 0:
-            tb.delete("0.0", Tix.END)
+            self._scrollback.clear()
         elif line > 0:
-            tb.delete("%d.0" % (line + 1), Tix.END)
+            self._scrollback.truncate(line)
         else: # line < 0
-            lines = tb.get("0.0", Tix.END).splitlines()
-            count = len(lines)
-            tb.delete("0.0", "%d.0" % (count + -(-line)))
+            self._scrollback.clear(-line)
         tb.configure(state=Tix.DISABLED)
 
     def refresh_userlist(self):
-        """Update the user list.
+        """Rebuild the user list from the members of the channel.
 
-        Should be called when the users for this channel are received, or when
-        somebody joins/parts.
+        Should be called when the users for this channel are received. For
+        single changes, `change_userlist()' is faster.
         """
         if self._userlist is not None:
-            self._userlist.delete(0, Tix.END)
-            if self._channel in self._frame.client.channels:
-                ops = [ ]
-                voices = [ ]
-                users = [ ]
-                l = self._frame.client.channels[self._channel].nicknames
-                for name in l:
-                    ni = l[name]
-                    mode = l[name].mode
-                    if 'o' in mode:
-                        ops.append("@" + ni.nickname)
-                    elif 'v' in mode:
-                        voices.append("+" + ni.nickname)
-                    else:
-                        users.append(ni.nickname)
-                l = (sorted(ops, key=unicode.lower)
-                   + sorted(voices, key=unicode.lower)
-                   + sorted(users, key=unicode.lower))
-                for name in l:
-                    self._userlist.insert(Tix.END, name)
-                self._userlistlabel.configure(
-                  text="%d Users, %d OPs" % (len(l), len(ops)))
+            model = self._userlist.model
+            client = self._frame.client
+            chan = client.channels.get(self._channel)
+            isupport = client.isupport
+            model.configure(isupport.prefix_modes, isupport.prefix_symbols,
+              kaeirc.util.make_folder(client.casemapping))
+            if chan is not None:
+                # The client thread may be changing the list; `values()' takes
+                # a snapshot at once.
+                model.reset([ (ni.nickname, ni.status)
+                  for ni in chan.nicknames.values() ])
+            else:
+                model.reset(())
+            self._userlist.refresh()
+            self._update_userlist_label()
+
+    def change_userlist(self, changes):
+        """Apply changes to the user list.
+
+        `changes' is a list of tuples with the name of a method of
+        `kaechatlib.ui.userlist.UserListModel' (`add', `remove', `rename', or
+        `set_status') followed by it's arguments. Only the visible rows are
+        updated in the widget.
+        """
+        if self._userlist is not None:
+            model = self._userlist.model
+            for change in changes:
+                getattr(model, change[0])(*change[1:])
+            self._userlist.refresh()
+            self._update_userlist_label()
+
+    def _update_userlist_label(self):
+        model = self._userlist.model
+        self._userlistlabel.configure(text="%d Users, %d OPs"
+          % (model.count, model.op_count))
 
     def _init_widgets(self):
         f = Tix.Frame(self)
@@ -196,23 +257,24 @@ class ChannelFrame(Tix.Frame):
             ff.pack(side=Tix.RIGHT, fill=Tix.BOTH)
             self._userlistlabel = Tix.Label(ff)
             self._userlistlabel.pack(side=Tix.TOP, fill=Tix.X)
-            self._userlist_ = Tix.ScrolledListBox(ff)
-            self._userlist_.pack(side=Tix.BOTTOM, fill=Tix.BOTH, expand=True)
-            self._userlist = self._userlist_.listbox
-            self._userlist.configure(selectmode=Tix.BROWSE, bg="white")
+            # Only the visible rows are in the widget, so big channels open
+            # as fast as small ones.
+            self._userlist = _kuiul.UserListView(ff, _kuiul.UserListModel(),
+              bg="white")
+            self._userlist.pack(side=Tix.BOTTOM, fill=Tix.BOTH, expand=True)
             colors = self._colors or self.default_colors
             for i in range(len(colors)):
                 c = colors[i]
                 self._textbox.tag_configure("color_%d" % i, foreground=c)
             self._textbox.tag_configure(_kui.WEB_LINK_TAG,
               foreground="#0000FF")
-            m = Tix.Menu(self._userlist, tearoff=False)
+            m = Tix.Menu(self._userlist.listbox, tearoff=False)
             m.add_command(label="Who is this?", command=self._whois_ul)
             m.add_command(label="Start conversation",
               command=self._start_query_ul)
             self._userlist.menu = m
             _kui.set_colors(self._userlistlabel, "window")
-            _kui.set_colors(self._userlist, "user_list")
+            _kui.set_colors(self._userlist.listbox, "user_list")
         else:
             self._userlist = None
         _kui.set_colors(self, "window")
@@ -221,8 +283,9 @@ class ChannelFrame(Tix.Frame):
 
     def _init_bindings(self):
         if self._userlist is not None:
-            self._userlist.bind("<Double-Button-1>", self._start_query_ul)
-            self._userlist.bind("<Button-3>", self._userlist_rclick)
+            lb = self._userlist.listbox
+            lb.bind("<Double-Button-1>", self._start_query_ul)
+            lb.bind("<Button-3>", self._userlist_rclick)
         if self._topicbox is not None:
             self._topicbox.bind("<Return>", self._set_topic)
         self._textbox.tag_bind(_kui.WEB_LINK_TAG, "<Double-Button-1>",
@@ -241,15 +304,14 @@ class ChannelFrame(Tix.Frame):
             webbrowser.open(url)
 
     def _start_query_ul(self, event=None):
-        sel = self._userlist.get(Tix.ANCHOR)
+        sel = self._userlist.selected_nickname()
         if sel:
-            if (sel[0] == '@') or (sel[0] == '+'):
-                sel = sel[1:]
             self._frame.select_channel(sel)
 
     def _whois_ul(self):
-        sel = self.userlist.get(Tix.ANCHOR)
-        self._frame.client.whois(sel)
+        sel = self._userlist.selected_nickname()
+        if sel:
+            self._frame.client.whois(sel)
 
     def _set_topic(self, event):
         self._frame.client.topic(self.channel, self.topicvar.get())
@@ -289,12 +351,23 @@ class NetworkFrame(Tix.Frame):
         """Currently selected channel."""
         return self._cur_channel
 
+    @property
+    def updates(self):
+        """The `kaechatlib.ui.updates.UpdateQueue' used by the client thread
+        to update this frame.
+        """
+        return _k.mainframe.updates
+
     @property
     def active(self):
         """Boolean indicating whether this frame is still active (i.e.
-        connected)."""
+        connected, or trying to reconnect)."""
         return self._active
 
+    @active.setter
+    def active(self, active):
+        self._active = active
+
     def __init__(self, frame=None, pagename=None, network=None, netid=None):
         Tix.Frame.__init__(self, frame)
         self._frame = frame
@@ -352,9 +425,22 @@ class NetworkFrame(Tix.Frame):
 
         Shortcut for `get_channel_frame(channel).echo(text, ...)'.
         """
-        self.get_channel_frame(channel).echo(text, who=who, prefix=prefix)
-        if (event is not None) and (channel != self._cur_channel):
-            self.set_channel_event(channel, event)
+        self.echo_lines([ (text, who, prefix, event) ], channel)
+
+    def echo_lines(self, lines, channel=None):
+        """Print many strings to a channel text box at once.
+
+        `lines' is a list of `(text, who, prefix, event)' tuples, with the
+        same meaning as the arguments to `echo()'. The channel event is set
+        only once, to the highest of them.
+        """
+        self.get_channel_frame(channel).echo_lines([ (text, who, prefix)
+          for (text, who, prefix, _) in lines ])
+        if channel != self._cur_channel:
+            events = [ event for (_, _, _, event) in lines
+              if event is not None ]
+            if events:
+                self.set_channel_event(channel, max(events))
 
     def clear(self, channel=None, lines=0):
         """Clear a channel text box.
@@ -377,6 +463,21 @@ class NetworkFrame(Tix.Frame):
         if f:
             f.refresh_userlist()
 
+    def set_topic(self, channel, topic):
+        """Show the topic of a channel in it's frame."""
+        self.get_channel_frame(channel)._topicvar.set(topic)
+
+    def change_userlist(self, channel, changes):
+        """Apply changes to the user list of a channel.
+
+        Roughly equivalent to
+        `get_channel_frame(channel).change_userlist(changes)', except that the
+        channel frame is not created if it does not already exist.
+        """
+        f = self.get_channel_frame(channel, create=False)
+        if f:
+            f.change_userlist(changes)
+
     def refresh_chanlist(self):
         """Update the channel list.
 
@@ -482,9 +583,9 @@ class NetworkFrame(Tix.Frame):
         suffix = " "
         if prefix[0] == '/':
             l = sorted([("/" + x) for x in _k.chat_commands.keys()])
-        elif prefix[0] in kaeirc.CHANNEL_PREFIXES:
+        elif self.client.is_channel(prefix):
             l = sorted(self.client.channels.keys(), _k.cmp_channels)
-        elif self._cur_channel and (self._cur_channel[0] in kaeirc.CHANNEL_PREFIXES):
+        elif self.client.is_channel(self._cur_channel):
             nl = self.client.channels[self._cur_channel].nicknames
             l = [ nl[x].nickname for x in nl.keys() ]
             l.sort(key=unicode.lower)
@@ -581,6 +682,13 @@ class MainFrame(Tix.Frame):
         self._init_bindings()
         self._root().title("KaeChat")
         self._page_serial = 0
+        self._updates = _kuiup.UpdateQueue(self)
+        self._updates.start()
+
+    @property
+    def updates(self):
+        """The `kaechatlib.ui.updates.UpdateQueue' shared by all networks."""
+        return self._updates
 
     def connect(self, netid):
         """Connect to a given network ID."""
@@ -595,6 +703,7 @@ class MainFrame(Tix.Frame):
 
     def reload_config(self):
         """Calls `reload_config()' on each open `NetworkFrame'."""
+        self._echobox_scrollback.limit = _kc.scrollback_lines
         for page in self._notebook.pages():
             if hasattr(page, "_netframe"):
                 page._netframe.reload_config()
@@ -604,6 +713,7 @@ class MainFrame(Tix.Frame):
         tb = self._echobox
         tb.configure(state=Tix.NORMAL)
         tb.insert(Tix.END, text + "\n")
+        self._echobox_scrollback.added(text.count("\n") + 1)
         tb.configure(state=Tix.DISABLED)
 
     def _init_widgets(self):
@@ -615,6 +725,8 @@ class MainFrame(Tix.Frame):
         self._echobox_.pack(fill=Tix.BOTH, expand=True)
         self._echobox = self._echobox_.text
         self._echobox.configure(state=Tix.DISABLED)
+        self._echobox_scrollback = _kuisb.Scrollback(self._echobox,
+          _kc.scrollback_lines)
 
     def _init_bindings(self):
         pass
@@ -37,8 +37,8 @@ class NetworkEditWindow(tkSimpleDialog.Dialog):
         self.name_var = Tix.StringVar(self,
             self.network.name if self.network is not None else "New Network")
         self.addr_var = Tix.StringVar(self,
-          (("%s/%d" % self.network.address) if self.network is not None
-          else "server/6667"))
+          (_k.format_addresses(self.network.addresses).replace(",", ", ")
+          if self.network is not None else "server/6667"))
         self.nicks_var = Tix.StringVar(self,
           ", ".join(self.network.nicks) if self.network is not None else "")
         self.user_var = Tix.StringVar(self,
@@ -64,16 +64,16 @@ class NetworkEditWindow(tkSimpleDialog.Dialog):
 
     def validate(self):
         name = self.name_var.get()
-        addr = self.addr_var.get().split('/', 1)
-        if len(addr) == 2:
-            try:
-                addr = (addr[0].strip(), int(addr[1]))
-            except ValueError:
-                tkMessageBox.showerror("Error", "Port must be a number.")
-                return False
-        else:
-            addr = (addr[0].strip(), 6667)
-        if len(addr[0]) == 0:
+        for item in self.addr_var.get().split(','):
+            item = item.split('/', 1)
+            if len(item) == 2:
+                try:
+                    int(item[1])
+                except ValueError:
+                    tkMessageBox.showerror("Error", "Port must be a number.")
+                    return False
+        addr = _k.parse_addresses(self.addr_var.get())
+        if not addr:
             tkMessageBox.showerror("Error", "You must specify an address.")
             return False
         username = self.user_var.get()
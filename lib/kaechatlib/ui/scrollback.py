@@ -0,0 +1,121 @@
+
+"""
+Scrollback Limit
+
+The text boxes of the channels would otherwise grow forever, making every
+insert and scroll slower. A `Scrollback' counts the lines in a `Text' widget
+as they are added (without asking Tk), and when there are too many, deletes
+the oldest ones in a single call, optionally appending them to a log file.
+"""
+
+import codecs
+import os
+
+#=============================================================================
+
+class Scrollback(object):
+    """Line bookkeeping for a `Text' widget that is only appended to.
+
+    The widget must be in the `NORMAL' state when `added()', `trim()', or
+    `clear()' are called, since they may delete text.
+    """
+
+    @property
+    def lines(self):
+        """Number of lines currently in the widget."""
+        return self._lines
+
+    @property
+    def trimmed(self):
+        """Total number of lines deleted by `trim()' so far."""
+        return self._trimmed
+
+    @property
+    def limit(self):
+        """Maximum number of lines kept, or None for no limit."""
+        return self._limit
+
+    @limit.setter
+    def limit(self, limit):
+        self._limit = limit or None
+
+    @property
+    def log(self):
+        """Path of the file the trimmed lines are appended to, or None."""
+        return self._log
+
+    @log.setter
+    def log(self, log):
+        self._log = log or None
+
+    def __init__(self, text, limit=None, log=None):
+        """Construct a new `Scrollback' for the `Text' widget `text'.
+
+        `limit' is the maximum number of lines, or None (or zero) for no
+        limit. `log' is the path of a file where trimmed lines are appended,
+        or None to just drop them.
+        """
+        self._text = text
+        self._lines = 0
+        self._trimmed = 0
+        self._limit = limit or None
+        self._log = log or None
+
+    def added(self, count):
+        """Account for `count' lines added at the end.
+
+        When the limit is exceeded by a tenth of it, the oldest lines are
+        trimmed to get back to the limit, so lines are deleted in blocks
+        rather than one by one.
+        """
+        self._lines += count
+        limit = self._limit
+        if (limit is not None) and (self._lines > limit + (limit // 10)):
+            self.trim(self._lines - limit)
+
+    def trim(self, count):
+        """Delete the oldest `count' lines (or all, if there are fewer), and
+        append them to the log, if any.
+        """
+        count = min(count, self._lines)
+        if count <= 0:
+            return
+        end = "%d.0" % (count + 1)
+        if self._log is not None:
+            self._write_log(self._text.get("1.0", end))
+        self._text.delete("1.0", end)
+        self._lines -= count
+        self._trimmed += count
+
+    def clear(self, keep=0):
+        """Delete all the lines but the last `keep'. The deleted lines are
+        not logged.
+        """
+        keep = max(0, min(keep, self._lines))
+        if keep == 0:
+            self._text.delete("1.0", "end")
+        else:
+            self._text.delete("1.0", "%d.0" % (self._lines - keep + 1))
+        self._lines = keep
+
+    def truncate(self, keep):
+        """Delete all the lines after the first `keep'. The deleted lines are
+        not logged.
+        """
+        keep = max(0, keep)
+        if keep < self._lines:
+            self._text.delete("%d.0" % (keep + 1), "end")
+            self._lines = keep
+
+    def _write_log(self, data):
+        try:
+            d = os.path.dirname(self._log)
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+            with codecs.open(self._log, "a", "utf-8") as f:
+                f.write(data)
+        except (IOError, OSError):
+            # Losing the old lines is better than failing to show new ones.
+            pass
+
+#=============================================================================
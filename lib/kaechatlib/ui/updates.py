@@ -0,0 +1,161 @@
+
+"""
+UI Update Queue
+
+Tk is not thread-safe; widgets must only be touched from the thread running
+the main loop. The client threads post their updates to an `UpdateQueue'
+instead, and the main loop runs them every `UPDATE_INTERVAL' milliseconds.
+
+Updates are coalesced when run: all the lines echoed to a channel since the
+last run are inserted at once, and each user list is refreshed only once (or
+only changed where needed), so a burst of messages causes a single redraw.
+
+An update raising an exception doesn't stop the others: the traceback is
+printed to standard error (like Tk does for callbacks), and the run goes on.
+"""
+
+import traceback
+import collections
+
+#=============================================================================
+
+# Milliseconds between runs of the queued updates (at most 25 per second).
+UPDATE_INTERVAL = 40
+
+_CALL = 0
+_ECHO = 1
+_REFRESH_USERLIST = 2
+_CHANGE_USERLIST = 3
+
+#=============================================================================
+
+class UpdateQueue(object):
+    """Queue of UI updates run periodically by the Tk main loop.
+
+    The `post()', `echo()', `refresh_userlist()', and `change_userlist()'
+    methods may be called from any thread. The rest of the methods must only
+    be called from the Tk thread.
+    """
+
+    @property
+    def interval(self):
+        """Milliseconds between runs of the queued updates."""
+        return self._interval
+
+    def __init__(self, widget, interval=UPDATE_INTERVAL):
+        """Construct a new `UpdateQueue'.
+
+        `widget' is any Tk widget, used to schedule the runs with `after()'.
+        """
+        self._widget = widget
+        self._interval = interval
+        # `deque.append()' and `deque.popleft()' are atomic, so no lock is
+        # needed.
+        self._updates = collections.deque()
+        self._after_id = None
+
+    def start(self):
+        """Start running the queued updates periodically."""
+        if self._after_id is None:
+            self._after_id = self._widget.after(self._interval, self._run)
+
+    def stop(self):
+        """Stop running the queued updates. Pending updates are kept."""
+        if self._after_id is not None:
+            self._widget.after_cancel(self._after_id)
+            self._after_id = None
+
+    def post(self, fn, *args, **kw):
+        """Arrange for `fn' to be called with `args' and `kw' in the Tk
+        thread.
+        """
+        self._updates.append((_CALL, fn, args, kw))
+
+    def echo(self, frame, text, who=None, channel=None, prefix="",
+      event=None):
+        """Arrange for `frame.echo(text, ...)' to be called in the Tk thread.
+
+        `frame' is a `NetworkFrame'. Consecutive lines for the same channel
+        are passed to a single call of `frame.echo_lines()'.
+        """
+        self._updates.append((_ECHO, frame, channel, (text, who, prefix,
+          event)))
+
+    def refresh_userlist(self, frame, channel):
+        """Arrange for `frame.refresh_userlist(channel)' to be called in the
+        Tk thread. Refreshes of the same channel are merged.
+        """
+        self._updates.append((_REFRESH_USERLIST, frame, channel))
+
+    def change_userlist(self, frame, channel, change):
+        """Arrange for `frame.change_userlist(channel, changes)' to be called
+        in the Tk thread.
+
+        `change' is a tuple with the name of a `UserListModel' method (like
+        `add') followed by it's arguments. The changes for a channel are
+        passed together, in order, unless the user list is refreshed in the
+        same run (making them unnecessary).
+        """
+        self._updates.append((_CHANGE_USERLIST, frame, channel, change))
+
+    def run_pending(self):
+        """Run the updates queued so far.
+
+        Lines echoed to the same channel are grouped, and inserted before
+        running any other kind of update, so the order is kept. User lists are
+        refreshed or changed last, since they show the current state anyway.
+
+        Exceptions raised by the updates are reported, not propagated, so
+        the rest of the updates already taken from the queue are still run.
+        """
+        updates = self._updates
+        lines = collections.OrderedDict()
+        refresh = collections.OrderedDict()
+        changes = collections.OrderedDict()
+        # Updates queued while running are left for the next run.
+        for _ in xrange(len(updates)):
+            update = updates.popleft()
+            kind = update[0]
+            if kind == _ECHO:
+                key = (update[1], update[2])
+                group = lines.get(key)
+                if group is None:
+                    group = lines[key] = [ ]
+                group.append(update[3])
+            elif kind == _REFRESH_USERLIST:
+                refresh[(update[1], update[2])] = True
+            elif kind == _CHANGE_USERLIST:
+                key = (update[1], update[2])
+                group = changes.get(key)
+                if group is None:
+                    group = changes[key] = [ ]
+                group.append(update[3])
+            else:
+                self._echo_lines(lines)
+                _, fn, args, kw = update
+                _call(fn, *args, **kw)
+        self._echo_lines(lines)
+        for (frame, channel) in refresh:
+            _call(frame.refresh_userlist, channel)
+        for ((frame, channel), group) in changes.iteritems():
+            if (frame, channel) not in refresh:
+                _call(frame.change_userlist, channel, group)
+
+    def _echo_lines(self, lines):
+        for ((frame, channel), group) in lines.iteritems():
+            _call(frame.echo_lines, group, channel)
+        lines.clear()
+
+    def _run(self):
+        # Rescheduled first, so nothing raised while running the updates
+        # stops the queue.
+        self._after_id = self._widget.after(self._interval, self._run)
+        self.run_pending()
+
+def _call(fn, *args, **kw):
+    try:
+        fn(*args, **kw)
+    except Exception:
+        traceback.print_exc()
+
+#=============================================================================
@@ -0,0 +1,379 @@
+
+"""
+User List
+
+The members of a channel are shown sorted by rank (operators first, then
+voiced users, and so on), then by nickname. Rebuilding the whole list on
+every change is too slow for big channels, so `UserListModel' keeps the
+sorted rows and finds where each change goes with `bisect'.
+
+A `Listbox' holding thousands of rows is still slow to fill and to scroll,
+so `UserListView' only puts in it the rows currently visible, taking them
+from the model as the list is scrolled.
+"""
+
+import bisect
+import time
+
+import Tix
+import tkFont
+
+import kaeirc
+import kaeirc.util
+
+#=============================================================================
+
+class UserListModel(object):
+    """Sorted list of the members of a channel.
+
+    Members are identified by their folded nickname. The ranks come from the
+    channel member modes with a prefix (`ov' by default, or as announced by
+    the server in the `PREFIX' ISUPPORT token); members with none of them
+    come last.
+
+    The methods changing the list return a 2-tuple with the index of the row
+    removed and the index of the row inserted (either may be None). The text
+    of the rows is available by indexing the model.
+    """
+
+    @property
+    def count(self):
+        """Number of members."""
+        return len(self._keys)
+
+    @property
+    def op_count(self):
+        """Number of members with operator status or higher."""
+        return self._op_count
+
+    def __init__(self, prefix_modes="ov", prefix_symbols="@+",
+      fold=kaeirc.util.make_folder()):
+        """Construct a new, empty `UserListModel'.
+
+        `prefix_modes' and `prefix_symbols' are as in
+        `kaeirc.isupport.ISupport'. `fold' folds a nickname for sorting and
+        lookups.
+        """
+        self._keys = [ ]
+        self._rows = [ ]
+        self._members = { }
+        self._op_count = 0
+        self.configure(prefix_modes, prefix_symbols, fold)
+
+    def configure(self, prefix_modes, prefix_symbols, fold):
+        """Change the ranks and folding. The list must be reset afterwards
+        with `reset()'.
+        """
+        self._bits = [ kaeirc.mode_bit(c) for c in prefix_modes ]
+        self._symbols = prefix_symbols
+        self._op_rank = (prefix_modes.index("o") if "o" in prefix_modes
+          else -1)
+        self._fold = fold
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        return self._rows[index]
+
+    def rows(self, start=0, end=None):
+        """Return a list with the text of the rows from `start' to `end'."""
+        return self._rows[start:end]
+
+    def nickname(self, index):
+        """Return the nickname of the member at the row `index'."""
+        return self._members[self._keys[index][1]][1]
+
+    def find(self, prefix):
+        """Return the first row (in display order) of a member whose
+        nickname starts with `prefix', or None if there is none.
+        """
+        fprefix = self._fold(prefix)
+        keys = self._keys
+        # Rows are sorted by nickname within each rank.
+        for rank in xrange(len(self._bits) + 1):
+            i = bisect.bisect_left(keys, (rank, fprefix))
+            if ((i < len(keys)) and (keys[i][0] == rank)
+              and keys[i][1].startswith(fprefix)):
+                return i
+        return None
+
+    def index(self, nickname):
+        """Return the row of a member, or None if not in the list."""
+        entry = self._members.get(self._fold(nickname))
+        if entry is None:
+            return None
+        return bisect.bisect_left(self._keys, entry[0])
+
+    def reset(self, members):
+        """Replace all the members.
+
+        `members' is an iterable of `(nickname, status)' tuples, where
+        `status' is a bit mask of member modes (see `kaeirc.NickInfo').
+        """
+        self._members = { }
+        for (nickname, status) in members:
+            key = (self._rank(status), self._fold(nickname))
+            self._members[key[1]] = (key, nickname, status)
+        entries = sorted(self._members.itervalues())
+        self._keys = [ key for (key, _, _) in entries ]
+        self._rows = [ self._text(key[0], nickname)
+          for (key, nickname, _) in entries ]
+        self._op_count = sum(1 for key in self._keys
+          if key[0] <= self._op_rank)
+
+    def add(self, nickname, status=0):
+        """Add a member, or update it if already in the list."""
+        key = (self._rank(status), self._fold(nickname))
+        entry = self._members.get(key[1])
+        if entry is not None:
+            if (entry[0] == key) and (entry[1] == nickname):
+                self._members[key[1]] = (key, nickname, status)
+                return (None, None)
+            old = self._delete(entry[0])
+        else:
+            old = None
+        self._members[key[1]] = (key, nickname, status)
+        return (old, self._insert(key, nickname))
+
+    def remove(self, nickname):
+        """Remove a member. Does nothing if it's not in the list."""
+        entry = self._members.pop(self._fold(nickname), None)
+        if entry is None:
+            return (None, None)
+        return (self._delete(entry[0]), None)
+
+    def rename(self, nickname, newnick):
+        """Change the nickname of a member, keeping it's status. Does nothing
+        if it's not in the list.
+        """
+        entry = self._members.get(self._fold(nickname))
+        if entry is None:
+            return (None, None)
+        old, _ = self.remove(nickname)
+        if self._fold(newnick) in self._members:
+            # Already there (the list was reset after the change).
+            return (old, None)
+        _, new = self.add(newnick, entry[2])
+        return (old, new)
+
+    def set_status(self, nickname, status):
+        """Change the status of a member. Does nothing if it's not in the
+        list.
+        """
+        entry = self._members.get(self._fold(nickname))
+        if entry is None:
+            return (None, None)
+        return self.add(entry[1], status)
+
+    def _rank(self, status):
+        if status:
+            for (rank, bit) in enumerate(self._bits):
+                if status & bit:
+                    return rank
+        return len(self._bits)
+
+    def _text(self, rank, nickname):
+        if rank < len(self._symbols):
+            return self._symbols[rank] + nickname
+        return nickname
+
+    def _insert(self, key, nickname):
+        i = bisect.bisect_left(self._keys, key)
+        self._keys.insert(i, key)
+        self._rows.insert(i, self._text(key[0], nickname))
+        if key[0] <= self._op_rank:
+            self._op_count += 1
+        return i
+
+    def _delete(self, key):
+        i = bisect.bisect_left(self._keys, key)
+        del self._keys[i]
+        del self._rows[i]
+        if key[0] <= self._op_rank:
+            self._op_count -= 1
+        return i
+
+#=============================================================================
+
+# Seconds after the last key press in which typed letters add to the text to
+# find, rather than starting again.
+_FIND_TIMEOUT = 1.0
+
+class UserListView(Tix.Frame):
+    """Scrollable list showing the rows of a `UserListModel'.
+
+    Only the visible rows are kept in the `Listbox'; call `refresh()' after
+    changing the model. Typing a nickname selects the first match.
+    """
+
+    @property
+    def model(self):
+        """The `UserListModel' shown."""
+        return self._model
+
+    @property
+    def listbox(self):
+        """The `Listbox' widget, for bindings and colors."""
+        return self._listbox
+
+    @property
+    def top(self):
+        """Index in the model of the first visible row."""
+        return self._top
+
+    def __init__(self, master, model, **kw):
+        """Construct a new `UserListView' showing `model'.
+
+        Keyword arguments are passed to the `Listbox' constructor.
+        """
+        Tix.Frame.__init__(self, master)
+        self._model = model
+        self._top = 0
+        self._visible = 1
+        self._selected = None
+        self._find_text = ""
+        self._find_time = 0
+        self._font_spec = None
+        self._font = None
+        self._scrollbar = Tix.Scrollbar(self, orient=Tix.VERTICAL,
+          command=self._scroll_command)
+        self._scrollbar.pack(side=Tix.RIGHT, fill=Tix.Y)
+        kw.setdefault("selectmode", Tix.BROWSE)
+        kw.setdefault("exportselection", False)
+        self._listbox = Tix.Listbox(self, **kw)
+        self._listbox.pack(side=Tix.LEFT, fill=Tix.BOTH, expand=True)
+        self._init_bindings()
+
+    def refresh(self):
+        """Show the rows of the model from `top' again."""
+        n = len(self._model)
+        self._top = max(0, min(self._top, n - self._visible))
+        lb = self._listbox
+        lb.delete(0, Tix.END)
+        rows = self._model.rows(self._top, self._top + self._visible)
+        if rows:
+            lb.insert(Tix.END, *rows)
+        if self._selected is not None:
+            i = self._model.index(self._selected)
+            if i is None:
+                self._selected = None
+            elif self._top <= i < self._top + len(rows):
+                lb.selection_set(i - self._top)
+                lb.activate(i - self._top)
+        if n > self._visible:
+            self._scrollbar.set(float(self._top) / n,
+              float(self._top + self._visible) / n)
+        else:
+            self._scrollbar.set(0.0, 1.0)
+
+    def scroll_to(self, index):
+        """Scroll so row `index' of the model is visible."""
+        if self._show(index):
+            self.refresh()
+
+    def select(self, index):
+        """Select row `index' of the model, scrolling to it."""
+        self._selected = self._model.nickname(index)
+        self._show(index)
+        self.refresh()
+
+    def selected_nickname(self):
+        """Return the nickname of the selected member, or None."""
+        return self._selected
+
+    def _init_bindings(self):
+        lb = self._listbox
+        lb.bind("<Configure>", self._configure)
+        lb.bind("<<ListboxSelect>>", self._listbox_select)
+        lb.bind("<Button-1>", self._click, add=True)
+        lb.bind("<Button-4>", lambda e: self._scroll_units(-3))
+        lb.bind("<Button-5>", lambda e: self._scroll_units(3))
+        lb.bind("<MouseWheel>",
+          lambda e: self._scroll_units(-3 if e.delta > 0 else 3))
+        lb.bind("<Up>", lambda e: self._move(-1))
+        lb.bind("<Down>", lambda e: self._move(1))
+        lb.bind("<Prior>", lambda e: self._move(-self._visible))
+        lb.bind("<Next>", lambda e: self._move(self._visible))
+        lb.bind("<Home>", lambda e: self._move(-len(self._model)))
+        lb.bind("<End>", lambda e: self._move(len(self._model)))
+        lb.bind("<Key>", self._key)
+
+    def _show(self, index):
+        # Move `top' so `index' is visible. Returns whether it moved.
+        if index < self._top:
+            self._top = index
+        elif index >= self._top + self._visible:
+            self._top = index - self._visible + 1
+        else:
+            return False
+        return True
+
+    def _configure(self, event):
+        # Rows that fit in the widget. `Listbox' rows are one pixel taller
+        # than the font, plus the selection border. The font is only looked
+        # up again if the option changed (like by `set_colors()').
+        lb = self._listbox
+        spec = lb.cget("font")
+        if spec != self._font_spec:
+            self._font_spec = spec
+            self._font = tkFont.Font(root=lb, font=spec)
+        row = (self._font.metrics("linespace") + 1
+          + 2 * int(lb.cget("selectborderwidth")))
+        border = 2 * (int(lb.cget("borderwidth"))
+          + int(lb.cget("highlightthickness")))
+        visible = max(1, (event.height - border) // row)
+        if visible != self._visible:
+            self._visible = visible
+            self.refresh()
+
+    def _scroll_command(self, *args):
+        n = len(self._model)
+        if args[0] == "moveto":
+            self._top = int(round(float(args[1]) * n))
+        elif args[0] == "scroll":
+            count = int(args[1])
+            if args[2] == "pages":
+                count *= self._visible
+            self._top += count
+        self.refresh()
+
+    def _scroll_units(self, count):
+        self._top += count
+        self.refresh()
+        return "break"
+
+    def _click(self, event):
+        self._listbox.focus_set()
+
+    def _listbox_select(self, event):
+        sel = self._listbox.curselection()
+        if sel:
+            i = self._top + int(sel[0])
+            if i < len(self._model):
+                self._selected = self._model.nickname(i)
+
+    def _move(self, count):
+        n = len(self._model)
+        if n:
+            i = (self._model.index(self._selected)
+              if self._selected is not None else None)
+            i = 0 if i is None else max(0, min(n - 1, i + count))
+            self.select(i)
+        return "break"
+
+    def _key(self, event):
+        # Type-to-find.
+        if (not event.char) or (event.char < " "):
+            return
+        now = time.time()
+        if now - self._find_time > _FIND_TIMEOUT:
+            self._find_text = ""
+        self._find_time = now
+        self._find_text += event.char
+        i = self._model.find(self._find_text)
+        if i is not None:
+            self.select(i)
+        return "break"
+
+#=============================================================================
@@ -14,17 +14,33 @@ CHANNEL_PREFIXES
   This is a convenience string designating which characters are valid as the
   first character of a channel name. Useful to check if the target of an
   operation is a channel or an user. The order of the characters is also useful
-  in case you want to sort a list of channels.
+  in case you want to sort a list of channels. Note that servers may use a
+  different set; see `Client.is_channel()'.
+
+PRIORITY_IMMEDIATE
+PRIORITY_INTERACTIVE
+PRIORITY_BULK
+  Priorities for `Client.send()'. See `kaeirc.flood' for details.
 """
 
 import sys
+import os
+import errno
+import codecs
+import select
 import socket
+import ssl
 import collections
 import re
-import time
 import random
 
 import kaeirc.aliases
+import kaeirc.flood
+import kaeirc.isupport
+import kaeirc.loop
+import kaeirc.parser
+import kaeirc.segment
+import kaeirc.transport
 import kaeirc.util
 
 #=============================================================================
@@ -33,9 +49,35 @@ __version__ = "0.1.2"
 
 CHANNEL_PREFIXES = "#&+!"
 
+PRIORITY_IMMEDIATE = kaeirc.flood.PRIORITY_IMMEDIATE
+PRIORITY_INTERACTIVE = kaeirc.flood.PRIORITY_INTERACTIVE
+PRIORITY_BULK = kaeirc.flood.PRIORITY_BULK
+
+#=============================================================================
+
+_RECV_SIZE = 65536
+
+# Limits assumed for the prefix of our own messages until the server tells
+# us our user and host names.
+_USERLEN = 11
+_HOSTLEN = 63
+
+# IRCv3 capabilities requested when the server offers them.
+_CAPABILITIES = ("multi-prefix", "userhost-in-names", "chghost")
+
+# Maximum number of members (as last seen) of the channels joined by a single
+# `JOIN' of `join_channels()' or after reconnecting, so the `NAMES' replies
+# come in pieces.
+_JOIN_BATCH_MEMBERS = 1000
+
+# Seconds to wait for the replies to a batch of `join_channels()' (after the
+# time flood control is expected to hold the `JOIN' back), before giving up
+# on the channels without a reply and sending the next batch.
+_JOIN_BATCH_TIMEOUT = 30
+
 #=============================================================================
 
-_USER_RE = re.compile(r'([^!]+)!([^@]+)@(.+)')
+Message = kaeirc.parser.Message
 
 #=============================================================================
 
@@ -65,23 +107,44 @@ def parse_prefix(user):
     Returns a 4-tuple, `(nickname, username, host, user)'. If `username' or
     `host' is not specified, it's returned as None.
     """
-    # TODO: This does not match docs.
-    m = _USER_RE.match(user)
-    if m:
-        nick, username, host = m.group(1, 2, 3)
-        return (nick, username, host, user)
-    else:
-        return (user, None, None, user)
+    return kaeirc.parser.split_prefix(user)
 
 #=============================================================================
 
-def nick_equals(n1, n2):
+def nick_equals(n1, n2, casemapping=kaeirc.util.DEFAULT_CASEMAPPING):
     """Compare two nicknames for equality.
 
-    Comparison is done as defined by the IRC protocol. See
-    `kaeirc.util.strlower()' for details.
+    Comparison is done as defined by the IRC protocol, using the given case
+    mapping. See `kaeirc.util' for details. To use the mapping announced by
+    the server, see `Client.nick_equals()'.
     """
-    return (kaeirc.util.strlower(n1) == kaeirc.util.strlower(n2))
+    fold = kaeirc.util.make_folder(casemapping)
+    return (fold(n1) == fold(n2))
+
+#=============================================================================
+
+def _find_handlers(obj):
+    # Returns a mapping from handler names (like "on_privmsg") to the bound
+    # methods of `obj' handling them. A method named "on_x" takes precedence
+    # over one named "_on_x".
+    r = { }
+    for name in dir(obj):
+        fn = name[1:] if (name[:1] == "_") else name
+        if not (fn.startswith("on_") or fn.startswith("before_")):
+            continue
+        if (fn is not name) and (fn in r):
+            continue
+        f = getattr(obj, name, None)
+        if callable(f):
+            r[fn] = f
+    return r
+
+def _is_error(cmd):
+    # Whether `cmd' (a handler name, see `kaeirc.parser.command_name()') is
+    # an error reply: an alias starting with "err_", or a numeric 400-599
+    # without an alias.
+    return (cmd[:4] == "err_") or ((len(cmd) == 3) and cmd.isdigit()
+      and (cmd[0] in "45"))
 
 #=============================================================================
 
@@ -97,33 +160,171 @@ class ConnectionError(Error):
 
 #=============================================================================
 
-class NickInfo(object):
-    """Holds the real nickname of an user and it's mode."""
+def mode_bit(c):
+    """Return the bit used for the channel member mode `c' (like `o' or `v')
+    in `NickInfo.status'.
+
+    Bits are allocated the first time a mode is seen, and are the same for
+    all the channels and clients.
+    """
+    bit = _mode_bits.get(c)
+    if bit is None:
+        bit = 1 << len(_mode_bits)
+        _mode_bits[c] = bit
+        _mode_letters.append((bit, c))
+    return bit
+
+_mode_bits = { }
+_mode_letters = [ ]
+
+for _c in "qaohv":
+    mode_bit(_c)
+del _c
+
+#=============================================================================
+
+class User(object):
+    """Holds information about an user seen in any of the joined channels.
+
+    A single instance is shared by all the channels the user is in (see
+    `Client.users'), so a change of nickname or host is seen by all of them
+    at once. The folded nickname (`key') is also shared, so it's stored only
+    once no matter how many channels the user is in.
+    """
+
+    __slots__ = ("_nickname", "_key", "_username", "_host", "_channels")
 
     @property
     def nickname(self):
         """Real nickname as specified by the user."""
         return self._nickname
 
+    @nickname.setter
+    def nickname(self, nickname):
+        self._nickname = nickname
+
+    @property
+    def key(self):
+        """Folded nickname, used as key in the dictionaries of `Client', or
+        None if not known.
+        """
+        return self._key
+
+    @key.setter
+    def key(self, key):
+        self._key = key
+
+    @property
+    def username(self):
+        """User name, or None if not known yet."""
+        return self._username
+
+    @username.setter
+    def username(self, username):
+        self._username = username
+
+    @property
+    def host(self):
+        """Host name, or None if not known yet."""
+        return self._host
+
+    @host.setter
+    def host(self, host):
+        self._host = host
+
+    @property
+    def channels(self):
+        """List of `Channel' instances this user is in.
+
+        This is a list rather than a set, as most users are only in a few
+        channels, and even an empty set takes more memory than a short list.
+        """
+        return self._channels
+
+    def __init__(self, nickname, username=None, host=None, key=None):
+        """Create a new `User' instance with the given name and host, and an
+        empty channel list.
+        """
+        self._nickname = nickname
+        self._key = key
+        self._username = username
+        self._host = host
+        self._channels = [ ]
+
+#=============================================================================
+
+class NickInfo(object):
+    """Holds the user record of a channel member and it's mode."""
+
+    __slots__ = ("_user", "_status")
+
+    @property
+    def user(self):
+        """The `User' instance shared by all the channels."""
+        return self._user
+
+    @property
+    def nickname(self):
+        """Real nickname as specified by the user."""
+        return self._user.nickname
+
+    @property
+    def status(self):
+        """Mode of this user as a bit mask. See `mode_bit()'."""
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        self._status = status
+
     @property
     def mode(self):
         """Mode of this user as a string."""
-        return self._mode
+        status = self._status
+        if not status:
+            return ""
+        return "".join([ c for (bit, c) in _mode_letters if status & bit ])
 
     @mode.setter
     def mode(self, mode):
-        self._mode = mode
-
-    def __init__(self, nickname, mode=""):
-        """Create a new `NickInfo' instance with the given name and mode."""
-        self._nickname = nickname
-        self._mode = mode
+        status = 0
+        for c in mode:
+            status |= mode_bit(c)
+        self._status = status
+
+    def __init__(self, user, mode="", status=0):
+        """Create a new `NickInfo' instance with the given user and mode.
+
+        `user' should be a `User' instance. For compatibility, a nickname
+        may be passed instead, in which case a new `User' is created. The
+        mode may be given either as a string (`mode') or as a bit mask
+        (`status').
+        """
+        if not isinstance(user, User):
+            user = User(user)
+        self._user = user
+        self._status = status
+        if mode:
+            self.mode = mode
+
+    def has_mode(self, c):
+        """Return whether this user has the mode `c'."""
+        return bool(self._status & mode_bit(c))
+
+    def set_mode(self, c, value=True):
+        """Set (or unset, if `value' is false) the mode `c'."""
+        if value:
+            self._status |= mode_bit(c)
+        else:
+            self._status &= ~mode_bit(c)
 
 #=============================================================================
 
 class Channel(object):
     """Holds the name of a channel and the list of users in that channel."""
 
+    __slots__ = ("_name", "_nicknames", "_modes")
+
     @property
     def name(self):
         """Name of this channel."""
@@ -131,15 +332,33 @@ class Channel(object):
 
     @property
     def nicknames(self):
-        """Mapping from lower-cased nicknames to `NickInfo' objects."""
+        """Mapping from folded nicknames to `NickInfo' objects."""
         return self._nicknames
 
-    def __init__(self, name):
+    @property
+    def modes(self):
+        """Dictionary mapping the channel modes currently set to their
+        argument, or True if they have none. List modes (like bans) and
+        member modes are not included.
+        """
+        return self._modes
+
+    @property
+    def mode_string(self):
+        """The channel modes as a string (like `+ntl 10')."""
+        flags = sorted(self._modes)
+        if not flags:
+            return ""
+        args = [ self._modes[c] for c in flags if self._modes[c] is not True ]
+        return " ".join([ "+" + "".join(flags) ] + args)
+
+    def __init__(self, name, casemapping=kaeirc.util.DEFAULT_CASEMAPPING):
         """Create a new `Channel' instance with the given name and an empty
-        user list.
+        user list, using `casemapping' for the nicknames.
         """
         self._name = name
-        self._nicknames = kaeirc.util.casedict()
+        self._nicknames = kaeirc.util.casedict(casemapping=casemapping)
+        self._modes = { }
 
 #=============================================================================
 
@@ -152,7 +371,8 @@ class Client(object):
     The application must call the `poll()' method regularly in the main loop,
     until the `connected' attribute is false. That method is responsible for
     reading from the socket (if data is available) and dispatch calls to the
-    registered listeners.
+    registered listeners. Alternatively, the client may be added to a
+    `kaeirc.loop.EventLoop', which calls `poll()' only when needed.
     """
 
     @property
@@ -177,10 +397,22 @@ class Client(object):
     @property
     def address(self):
         """Address this client is connected to, as passed to the
-        constructor.
+        constructor. May be changed before calling `connect()', for example
+        to try another server of the network.
         """
         return self._address
 
+    @address.setter
+    def address(self, address):
+        self._address = address
+
+    @property
+    def tls(self):
+        """Boolean telling whether TLS is used, as passed to the
+        constructor.
+        """
+        return self._tls
+
     @property
     def channels(self):
         """List of channels currently joined.
@@ -189,6 +421,45 @@ class Client(object):
         """
         return self._channels
 
+    @property
+    def users(self):
+        """Users in any of the joined channels, including this client.
+
+        This is a dictionary mapping nicknames to `User' instances. Each
+        `User' knows the channels it's in, so events like `NICK' or `QUIT'
+        only need to look at those.
+        """
+        return self._users
+
+    @property
+    def casemapping(self):
+        """Case mapping used for nicknames and channel names, as announced by
+        the server in the `CASEMAPPING' ISUPPORT token. See `kaeirc.util'.
+        """
+        return self._casemapping
+
+    @property
+    def isupport(self):
+        """The `kaeirc.isupport.ISupport' registry with the features
+        announced by the server. Cleared at the start of every connection.
+        """
+        return self._isupport
+
+    @property
+    def own_prefix(self):
+        """The `nickname!username@host' prefix used by the server for the
+        messages sent by this client, or None if not known yet. Used to
+        compute the room left for the text in a line.
+        """
+        if self._userhost is None:
+            return None
+        return "%s!%s@%s" % ((self._nickname,) + self._userhost)
+
+    @property
+    def caps(self):
+        """Set of IRCv3 capabilities enabled for this connection."""
+        return self._caps
+
     @property
     def listeners(self):
         """List of registered listeners called when an event occurs."""
@@ -210,24 +481,66 @@ class Client(object):
         return self._authed
 
     @property
-    def socket(self):
-        """Underlying socket object used for communication."""
-        return self._socket
+    def transport(self):
+        """Transport used for communication (see `kaeirc.transport'), or
+        None if not connected.
+        """
+        return self._transport
 
     @property
-    def file(self):
-        """Underlying file object used to read/write to the socket. Created in
-        connect() by calling `self.socket.makefile()'.
+    def socket(self):
+        """Underlying socket object used for communication, or None if not
+        connected or if the transport has no socket.
         """
-        return self._file
+        if self._transport is None:
+            return None
+        return self._transport.socket
 
     @property
     def encoding(self):
         """Encoding used for conversion to/from unicode."""
         return self._encoding
 
+    @property
+    def loop(self):
+        """The `kaeirc.loop.EventLoop' this client was added to, or None if
+        the application calls `poll()' by itself.
+        """
+        return self._loop
+
+    @property
+    def current_message(self):
+        """The `Message' being dispatched to the handlers, or None. Handlers
+        may use this to look at the IRCv3 message tags.
+        """
+        return self._message
+
+    @property
+    def wants_write(self):
+        """Boolean telling whether there is data which may be sent right
+        away. Lines held back by flood control don't count; see `send_delay'.
+        """
+        return bool(self._wbuf) or self._send_queue.ready()
+
+    @property
+    def send_delay(self):
+        """Time in seconds until flood control allows sending the next queued
+        line, or None if no line is being held back.
+        """
+        return self._send_queue.delay()
+
+    @property
+    def send_queue_depth(self):
+        """Number of lines waiting to be sent."""
+        return self._send_queue.depth()
+
+    @property
+    def send_queue_eta(self):
+        """Estimated time in seconds until all the queued lines are sent."""
+        return self._send_queue.eta()
+
     def __init__(self, username, address, nickname=None, realname=None,
-      encoding="utf-8"):
+      encoding="utf-8", tls=False, tls_verify=True):
         """Create a new `kaeirc.Client' using the specified username and
         address.
 
@@ -236,7 +549,11 @@ class Client(object):
         `username'.
 
         `address' must be a 2-tuple, with the first item being the host name (a
-        string) and the second item the port number (an integer).
+        string) and the second item the port number (an integer), or a string
+        with the path of an Unix domain socket.
+
+        If `tls' is true, the connection is encrypted with TLS, and if
+        `tls_verify' is also true, the certificate of the server is verified.
 
         `nickname' is passed in the initial `NICK' command. If this nickname is
         already in use, the listeners will be called to handle that, and if
@@ -250,23 +567,123 @@ class Client(object):
         self._realname = realname or username
         self._encoding = encoding
         self._address = address
+        self._tls = tls
+        self._tls_verify = tls_verify
+        self._isupport = kaeirc.isupport.ISupport()
+        self._casemapping = kaeirc.util.DEFAULT_CASEMAPPING
+        self._fold = kaeirc.util.make_folder(self._casemapping)
         self._channels = kaeirc.util.casedict()
+        self._users = kaeirc.util.casedict()
         self._listeners = [ ]
-        self._socket = None
-        self._file = None
+        self._listener_handlers = [ ]
+        self._own_handlers = _find_handlers(self)
+        self._call_table = { }
+        self._dispatch_table = { }
+        self._message = None
+        self._names = { }
+        self._transport = None
         self._connected = False
         self._quitting = False
+        self._requested = False
         self._authed = False
-        self._send_queue = [ ]
+        self._rejoining = set()
+        self._resyncing = set()
+        self._join_queue = [ ]
+        self._join_batch = set()
+        self._join_waiting = set()
+        self._join_names = [ ]
+        self._join_complete = False
+        self._join_deadline = None
+        self._join_timer = None
+        self._activity = { }
+        self._activity_tick = 0
+        self._send_queue = kaeirc.flood.SendQueue()
+        self._loop = None
+        self._userhost = None
+        self._caps = set()
+        self._caps_offered = set()
+        self._init_buffers()
+
+    def _init_buffers(self):
+        self._rbuf = bytearray(_RECV_SIZE)
+        self._rview = memoryview(self._rbuf)
+        self._rlen = 0
+        self._wbuf = bytearray()
+        self._decoder = codecs.getincrementaldecoder(self._encoding)()
+        self._fallback_decoder = \
+          codecs.getincrementaldecoder("cp1252")("replace")
+
+    def set_flood_control(self, burst=kaeirc.flood.DEFAULT_BURST,
+      rate=kaeirc.flood.DEFAULT_RATE):
+        """Configure flood control for the lines sent with `send()'.
+
+        Up to `burst' lines are sent at once; after that, lines are sent at a
+        rate of `rate' lines per second (fractions allowed). If `rate' is None
+        or zero, flood control is disabled.
+        """
+        self._send_queue.configure(burst, rate)
+
+    def fold(self, text):
+        """Fold a nickname or channel name using the case mapping of the
+        server. The result can be used with the `*_folded()' methods of the
+        dictionaries in `channels', `users', and `Channel.nicknames'.
+        """
+        return self._fold(text)
+
+    def nick_equals(self, n1, n2):
+        """Compare two nicknames for equality, using the case mapping of the
+        server.
+        """
+        fold = self._fold
+        return (fold(n1) == fold(n2))
+
+    def is_channel(self, name):
+        """Return whether `name' is a channel name, according to the channel
+        types supported by the server.
+        """
+        return bool(name) and (name[0] in self._isupport.chantypes)
+
+    def set_casemapping(self, casemapping):
+        """Change the case mapping, and update the keys of all the
+        dictionaries. Called when the server announces it's mapping.
+        """
+        if casemapping == self._casemapping:
+            return
+        self._casemapping = casemapping
+        self._fold = kaeirc.util.make_folder(casemapping)
+        self._channels.set_casemapping(casemapping, lambda c: c.name)
+        self._users.set_casemapping(casemapping, lambda u: u.nickname)
+        for (key, user) in self._users.iteritems():
+            user.key = key
+        for chan in self._channels.itervalues():
+            nicknames = chan.nicknames
+            members = nicknames.values()
+            nicknames.clear()
+            nicknames.set_casemapping(casemapping)
+            for info in members:
+                nicknames.set_folded(info.user.key, info)
+
+    def fileno(self):
+        """Return the file descriptor of the underlying transport, or None
+        if not connected.
+        """
+        if self._transport is None:
+            return None
+        return self._transport.fileno()
 
     def add_listener(self, listener):
         """Adds an object to the list of listeners for the instance.
 
         See the description about `on_received()' for more information about
         listeners.
+
+        The handler methods of the listener are looked up at this point. If
+        the listener gains or loses handlers later, `refresh_listeners()' must
+        be called.
         """
         if not listener in self.listeners:
             self.listeners.append(listener)
+            self.refresh_listeners()
 
     def remove_listener(self, listener):
         """Removes an object from the list of listeners, so it won't receive
@@ -274,50 +691,121 @@ class Client(object):
         """
         if listener in self.listeners:
             self.listeners.remove(listener)
+            self.refresh_listeners()
+
+    def refresh_listeners(self):
+        """Look up the handler methods of all listeners again.
+
+        This is done automatically by `add_listener()' and
+        `remove_listener()'.
+        """
+        # New tables are built and swapped in, so a dispatch in progress in
+        # another thread keeps using the old ones.
+        self._listener_handlers = [ _find_handlers(l) for l in self.listeners ]
+        self._call_table = { }
+        self._dispatch_table = { }
 
-    def connect(self, timeout=10):
+    def connect(self, timeout=10, transport=None):
         """Establish connection to the IRC server.
 
-        This method first connects the socket to the address specified in the
-        constructor, and sends the required `USER' and `NICK' commands to
-        initiate the IRC connection.
+        This method first connects to the address specified in the
+        constructor (trying all of it's addresses, see
+        `kaeirc.transport.Connector'), and sends the required `USER' and
+        `NICK' commands to initiate the IRC connection. It returns as soon as
+        the server accepts the registration.
+
+        When reconnecting, the channels in `channels' are joined again once
+        the server sends the message of the day, a few at a time, and their
+        member lists are updated when the `NAMES' replies arrive. The
+        listeners' `on_resync' handlers are then called with the channel
+        name, the list of nicknames which appeared, and the list of nicknames
+        which are gone since the connection was lost.
 
-        `timeout' is the time in seconds (fractions allowed) to wait for the
-        server to respond. If the timeout expires, `TimeoutError' is raised.
+        If `transport' is not None, it's used instead of connecting to the
+        address. It must be a connected transport (see `kaeirc.transport'),
+        for example one end of a `kaeirc.transport.pipe()'.
+
+        `timeout' is the time in seconds (fractions allowed) for the whole
+        process. If it expires, `ConnectionError' is raised.
 
         This method may also raise `socket.error' for other errors.
         """
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind(("", 0))
-        self.socket.connect(self.address)
+        deadline = kaeirc.util.monotonic() + timeout
+        if transport is None:
+            try:
+                transport = kaeirc.transport.open_transport(self._address,
+                  timeout, self._tls, self._tls_verify)
+            except socket.timeout:
+                raise ConnectionError("Timed out")
+        self._transport = transport
         self._connected = True
-        self._file = self.socket.makefile()
-        self.send("CAP REQ multi-prefix")
-        self.send("CAP END")
-        self.nick(self._nickname)
-        self.send("USER %s 0 * :%s" % (self.username, self.realname))
-        self.socket.setblocking(0)
-        st = time.clock()
+        self._quitting = False
+        self._requested = False
+        self._authed = False
+        self._send_queue.clear()
+        self._init_buffers()
+        self._register()
         while not self.authed:
-            time.sleep(0.1)
-            self.poll()
-            t = time.clock() - st
-            if t >= timeout:
+            if not self.connected:
+                self.poll()
+                raise ConnectionError("Connection closed")
+            remaining = deadline - kaeirc.util.monotonic()
+            if remaining <= 0:
+                self._transport.close()
+                self._transport = None
+                self._connected = False
                 raise ConnectionError("Timed out")
-        for (chan, v) in self.channels:
-            self.join(chan)
+            # Wake up when flood control allows sending held back lines
+            # (like a `NICK' retry); `poll()' sends them.
+            delay = self.send_delay
+            if delay is not None:
+                remaining = min(remaining, delay)
+            fd = transport.fileno()
+            select.select([ fd ], [ fd ] if self._wbuf else [ ], [ ],
+              remaining)
+            self.poll()
+
+    def _register(self):
+        # All the registration commands are sent with a single write, and the
+        # client doesn't wait for replies between them.
+        self._isupport.clear()
+        self._caps = set()
+        self._caps_offered = set()
+        self._names.clear()
+        self._userhost = None
+        self._rejoining = set(self._channels.iterkeys())
+        self._resyncing = set()
+        # Channels of a batch in flight when the connection was lost are
+        # joined again first.
+        self._join_queue[:0] = [ (name, None) for name in self._join_names
+          if self._fold(name) in self._join_waiting ]
+        self._join_batch = set()
+        self._join_waiting = set()
+        self._join_names = [ ]
+        self._join_complete = False
+        self._cancel_join_timer()
+        self.send("CAP LS 302", PRIORITY_IMMEDIATE)
+        self.send("NICK %s" % self._nickname, PRIORITY_IMMEDIATE)
+        self.send("USER %s 0 * :%s" % (self.username, self.realname),
+          PRIORITY_IMMEDIATE)
+        self._flush()
 
     def disconnect(self, reason=None):
         """Sends a `QUIT' command to the server, optionally with a reason
         message, and closes the underlying socket.
 
-        This function also sets the `connected' attribute to false.
+        This function also sets the `connected' attribute to false. The socket
+        is closed by the next call to `poll()', after flushing the queued
+        data.
 
         Operations on a disconnected client may raise exceptions.
         """
-        self._send("QUIT" if reason is None else ("QUIT :%s" % reason))
+        self.send("QUIT" if reason is None else ("QUIT :%s" % reason))
         self._connected = False
         self._quitting = True
+        self._requested = True
+        if self._loop is not None:
+            self._loop.notify(self)
 
     def quit(self, reason=None):
         """Alias for `disconnect()'."""
@@ -327,40 +815,148 @@ class Client(object):
         """Poll the connection for incoming data.
 
         This method looks if there's data pending to be read from the socket,
-        and if so, calls `on_received()' with the text received.
+        and if so, calls `on_received()' for each complete line received.
+
+        Then, all the queued lines are sent with a single call. If the socket
+        cannot take all the data, the rest is kept for the next call.
+
+        When the connection is closed, the listeners' `on_disconnected'
+        handlers are called with a boolean telling whether it was requested
+        with `disconnect()' (as opposed to lost, or closed by the server).
         """
-        while self.connected:
-            try:
-                text = self.file.readline()
-            except socket.error:
-                break
-            else:
-                try:
-                    text = unicode(text, self.encoding).rstrip("\n\r")
-                except ValueError:
-                    text = unicode(text, 'cp1252').rstrip("\n\r")
-                self.on_received(text)
-        while self._send_queue:
-            text = self._send_queue[0]
-            del self._send_queue[0]
-            self._send(text)
+        more = True
+        while more and self.connected:
+            lines, more = self._recv_lines()
+            for text in lines:
+                if not self.connected:
+                    break
+                if text:
+                    self.on_received(text)
+        if (self._join_waiting
+          and (kaeirc.util.monotonic() >= self._join_deadline)):
+            # No reply for some channels; don't hold the rest back.
+            self._join_waiting = set()
+            self._join_complete = True
+        if self._join_complete:
+            names = self._join_names
+            self._join_batch = set()
+            self._join_names = [ ]
+            self._join_complete = False
+            self._cancel_join_timer()
+            self.try_call("on_join_batch", None, [ names ])
+            self._send_join_batch()
+        if self._transport is not None:
+            self._flush()
         if self._quitting:
-            if self.socket:
-                self.socket.close()
-            self._file = None
-            self._socket = None
+            transport, self._transport = self._transport, None
             self._authed = False
-            self._send_queue = False
-
-    def _send(self, text):
-        self.try_call("on_raw_send", None, [ text ])
-        self.file.write(text + "\r\n")
-        self.file.flush()
-
-    def send(self, text):
-        """Sends raw text to the underlying socket, and flushes it."""
+            self._send_queue.clear()
+            self._wbuf = bytearray()
+            if transport is not None:
+                transport.close()
+                # Called directly; `try_call()' stops when not connected.
+                for f in self._lookup_handlers("on_disconnected"):
+                    f(None, self._requested)
+
+    def _recv_lines(self):
+        # Reads as much as fits in the receive buffer with a single call, and
+        # returns a 2-tuple: the list of complete lines received (decoded),
+        # and whether there may be more data to read. Incomplete lines are
+        # kept at the start of the buffer for the next call.
+        space = len(self._rbuf) - self._rlen
+        if space == 0:
+            # Line longer than the buffer; make room for it.
+            self._rview = None
+            self._rbuf.extend(bytearray(len(self._rbuf)))
+            self._rview = memoryview(self._rbuf)
+            space = len(self._rbuf) - self._rlen
+        try:
+            n = self._transport.recv_into(self._rview[self._rlen:], space)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._connected = False
+                self._quitting = True
+            return ([ ], False)
+        if n == 0:
+            # Connection closed by peer.
+            self._connected = False
+            self._quitting = True
+            return ([ ], False)
+        # If the buffer was not filled, the socket was drained; this avoids a
+        # call just to learn that there's nothing else to read.
+        more = (n == space)
+        total = self._rlen + n
+        end = self._rbuf.rfind(b"\n", self._rlen, total) + 1
+        if end == 0:
+            self._rlen = total
+            return ([ ], more)
+        data = self._rview[:end].tobytes()
+        self._rlen = total - end
+        if self._rlen:
+            self._rbuf[:self._rlen] = self._rview[end:total]
+        try:
+            text = self._decoder.decode(data, True)
+        except UnicodeDecodeError:
+            # At least one line is not valid in the configured encoding;
+            # decode line by line, falling back to cp1252 where needed.
+            self._decoder.reset()
+            lines = [ ]
+            for line in data.split(b"\n"):
+                try:
+                    lines.append(self._decoder.decode(line, True))
+                except UnicodeDecodeError:
+                    self._decoder.reset()
+                    lines.append(self._fallback_decoder.decode(line, True))
+            text = u"\n".join(lines)
+        lines = text.split(u"\n")
+        lines.pop()
+        for i in xrange(len(lines)):
+            if lines[i].endswith(u"\r"):
+                lines[i] = lines[i][:-1]
+        return (lines, more)
+
+    def _flush(self):
+        # Other threads may append while we're here; the queue only uses
+        # atomic operations, so lines are never lost nor sent twice.
+        lines = self._send_queue.pop_ready()
+        if lines:
+            for text in lines:
+                self.try_call("on_raw_send", None, [ text ])
+            lines.append(b"")
+            self._wbuf += b"\r\n".join(lines)
+        if not self._wbuf:
+            return
+        try:
+            n = self._transport.send(self._wbuf)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self._connected = False
+                self._quitting = True
+            return
+        del self._wbuf[:n]
+
+    def send(self, text, priority=None):
+        """Queues raw text to be sent to the server.
+
+        The text is encoded right away, and written to the socket, along with
+        any other queued lines, on the next call to `poll()' which flood
+        control allows it.
+
+        `priority' is one of `PRIORITY_IMMEDIATE', `PRIORITY_INTERACTIVE', or
+        `PRIORITY_BULK'. If not specified or None, the priority is chosen based
+        on the command (see `kaeirc.flood.command_priorities'), except that
+        lines sent before the registration is accepted (like `NICK' retries
+        and `CAP' negotiation) are sent with `PRIORITY_IMMEDIATE'.
+        """
+        if priority is None:
+            if not self._authed:
+                priority = PRIORITY_IMMEDIATE
+            else:
+                priority = kaeirc.flood.command_priority(text)
         text = text.encode(self.encoding)
-        self._send_queue.append(text)
+        self._send_queue.put(text, priority)
+        if self._loop is not None:
+            self._loop.notify(self)
 
     def nick(self, nickname):
         """Issue a `NICK' command.
@@ -372,12 +968,49 @@ class Client(object):
         """
         self.send("NICK %s" % nickname)
 
-    def join(self, channel):
+    def join(self, channel, priority=None):
         """Issue a `JOIN' command.
 
         The server responds either with `JOIN', or an error.
+
+        `priority' is passed to `send()'. Automatic joins should use
+        `PRIORITY_BULK', or better, `join_channels()'.
+        """
+        self.send("JOIN %s" % channel, priority)
+
+    def join_channels(self, channels):
+        """Join many channels, in the given order, in batches.
+
+        `channels' is a sequence of channel names, or 2-tuples of channel name
+        and key. As many channels as the server's `TARGMAX' and line length
+        limits allow are packed in a single `JOIN' line (fewer if their sizes
+        are known, see `_JOIN_BATCH_MEMBERS'), sent with `PRIORITY_BULK'. The
+        next batch is only sent once the server has replied to all the
+        channels in the previous one (with `RPL_ENDOFNAMES' or an error
+        naming the channel), so the replies don't pile up and interactive
+        commands are not delayed behind them. Channels without a reply after
+        `_JOIN_BATCH_TIMEOUT' seconds are given up.
+
+        When a batch is done, the listeners' `on_join_batch' handlers are
+        called with the list of channel names in it; heavy processing of the
+        member lists can be done there instead of on every `RPL_ENDOFNAMES'
+        (see `is_joining()').
+
+        Channels already joined are skipped. Channels not yet joined when the
+        connection is lost are joined after reconnecting.
+        """
+        for channel in channels:
+            if isinstance(channel, basestring):
+                channel = (channel, None)
+            self._join_queue.append(channel)
+        self._send_join_batch()
+
+    def is_joining(self, channel):
+        """Return whether `channel' is in a batch of `join_channels()' (or of
+        the channels joined again after reconnecting) not yet reported to the
+        `on_join_batch' handlers.
         """
-        self.send("JOIN %s" % channel)
+        return self._fold(channel) in self._join_batch
 
     def part(self, channel, reason=None):
         """Issue a `PART' command, optionally with a reason.
@@ -394,10 +1027,12 @@ class Client(object):
 
         This tells the server to send `text' as a message to `target'.
 
-        `target' may be either a channel name, or a nickname.
+        `target' may be either a channel name, or a nickname, or a list of
+        them. Each line of `text' is split as needed to fit in the protocol
+        line length, and several targets are sent in a single command when
+        the server allows it (see `kaeirc.segment').
         """
-        for line in text.splitlines():
-            self.send("PRIVMSG %s :%s" % (target, line))
+        self._send_text("PRIVMSG", target, text)
 
     def privmsg_ctcp(self, target, text):
         """Issue a `PRIVMSG' command using Client To Client Protocol.
@@ -418,10 +1053,11 @@ class Client(object):
             simply ignore the request. This should only be used if `target'
             refers to a nickname.
 
-        `target' may be either a channel name, or a nickname.
+        `target' may be either a channel name, or a nickname, or a list of
+        them. Long lines are split as in `privmsg()', repeating the query in
+        each of them.
         """
-        for line in text.splitlines():
-            self.send("PRIVMSG %s :\1%s\1" % (target, line))
+        self._send_ctcp("PRIVMSG", target, text)
 
     def notice(self, target, text):
         """Issue a `NOTICE' command.
@@ -429,8 +1065,7 @@ class Client(object):
         The `NOTICE' command is almost the same as the `PRIVMSG' command,
         except that clients should *NOT* respond to notices.
         """
-        for line in text.splitlines():
-            self.send("NOTICE %s :%s" % (target, line))
+        self._send_text("NOTICE", target, text)
 
     def notice_ctcp(self, target, text):
         """Issue a `NOTICE' command using Client To Client Protocol.
@@ -440,8 +1075,45 @@ class Client(object):
 
         This should be used to reply to a CTCP query.
         """
+        self._send_ctcp("NOTICE", target, text)
+
+    def _send_ctcp(self, command, target, text):
         for line in text.splitlines():
-            self.send("NOTICE %s :\1%s\1" % (target, line))
+            query, _, rest = line.partition(" ")
+            if rest:
+                self._send_text(command, target, rest, query)
+            elif query:
+                self._send_text(command, target, "\1%s\1" % query)
+
+    def _send_text(self, command, target, text, query=None):
+        encoding = self._encoding
+        if isinstance(target, basestring):
+            target = [ target ]
+        # Room left for the target and the text in the line relayed by the
+        # server: ":<prefix> <command> <target> :<text>\r\n".
+        room = (self._isupport.linelen - self._prefix_length()
+          - len(command) - 7)
+        if query is not None:
+            room -= len(query.encode(encoding, "replace")) + 3
+        groups = kaeirc.segment.group_targets(target,
+          self._isupport.target_limit(command), room // 2, encoding)
+        lines = [ line for line in text.splitlines() if line ]
+        for group in groups:
+            left = room - len(group.encode(encoding, "replace"))
+            head = "%s %s :" % (command, group)
+            for line in lines:
+                for chunk in kaeirc.segment.split_text(line, left, encoding):
+                    if query is None:
+                        self.send(head + chunk)
+                    else:
+                        self.send("%s\1%s %s\1" % (head, query, chunk))
+
+    def _prefix_length(self):
+        nickname = self._nickname or ""
+        if self._userhost is None:
+            # Assume the longest user and host names allowed.
+            return len(nickname) + _USERLEN + _HOSTLEN + 2
+        return len(self.own_prefix.encode(self._encoding, "replace"))
 
     def whois(self, nickname):
         """Issue a `WHOIS' command."""
@@ -482,6 +1154,47 @@ class Client(object):
         if arg2: text += " " + arg2
         self.send(text)
 
+    def modes(self, channel, changes, priority=None):
+        """Issue as few `MODE' commands as possible to apply a list of mode
+        changes.
+
+        `changes' is a list of `(mode, arg)' tuples, where `mode' is a string
+        like `+o' or `-b', and `arg' is the argument, or None. Changes are
+        packed according to the `MODES' limit announced by the server, and
+        the maximum line length.
+
+        Returns the number of commands sent.
+        """
+        limit = self._isupport.modes
+        maxlen = self._isupport.linelen - 2
+        head = "MODE %s " % channel
+        count = 0
+        i = 0
+        while i < len(changes):
+            letters, args = [ ], [ ]
+            sign = None
+            size = len(head)
+            while i < len(changes):
+                mode, arg = changes[i]
+                extra = len(mode[1:]) + ((mode[0] != sign) and 1 or 0)
+                if arg:
+                    if (limit is not None) and (len(args) >= limit):
+                        break
+                    extra += len(arg) + 1
+                if letters and (size + extra > maxlen):
+                    break
+                if mode[0] != sign:
+                    sign = mode[0]
+                    letters.append(sign)
+                letters.append(mode[1:])
+                if arg:
+                    args.append(arg)
+                size += extra
+                i += 1
+            self.send(head + " ".join([ "".join(letters) ] + args), priority)
+            count += 1
+        return count
+
     def away(self, reason=None):
         """Issue an `AWAY' command.
 
@@ -499,22 +1212,26 @@ class Client(object):
         a method named `fn', it calls this method with the `who' and unpacked
         `args' arguments.
 
+        If a method returns something other than None, the rest of listeners
+        are not called, and that value is returned.
+
         This method is intended for internal use, but may be useful in
         specialized cases.
         """
-        for l in self.listeners:
-            f = None
-            if hasattr(l, fn):
-                f = getattr(l, fn)
-            elif hasattr(l, "_"+fn):
-                f = getattr(l, "_"+fn)
-            if f:
-                r = f(who, *args)
-                if r is not None:
-                    return r
+        handlers = self._call_table.get(fn)
+        if handlers is None:
+            handlers = self._lookup_handlers(fn)
+            self._call_table[fn] = handlers
+        for f in handlers:
+            r = f(who, *args)
+            if r is not None:
+                return r
             if not self.connected:
                 break
 
+    def _lookup_handlers(self, fn):
+        return tuple(h[fn] for h in self._listener_handlers if fn in h)
+
     def on_received(self, text):
         """Handle a received command, reply, or error, and dispatch method
         calls to relevant listener methods. This is the workhorse of the
@@ -524,15 +1241,17 @@ class Client(object):
         replies (001-399) or errors (400-999).
 
         When some data is received (typically by `poll()'), this function is
-        called to parse the line into the "prefix", the "command", and the
-        "arguments".
+        called to parse the line into the "tags", the "prefix", the "command",
+        and the "arguments" (see `kaeirc.parser.parse()'). The resulting
+        `Message' is available to the handlers as `current_message'.
 
         If the line begins with a colon (':'), it's parsed as the prefix. The
         prefix specifies the entity (server or user) sending the command. The
         prefix has the format ":nickname!username@host", with "!username" and
-        "@host" being optional. Items not specified are taken as None. If no
-        prefix is found, a 3-tuple of None is used. The prefix is passed to the
-        handler (see below) as the `who' argument.
+        "@host" being optional. Items not specified are taken as None. The
+        prefix is passed to the handler (see below) as the `who' argument, a
+        `kaeirc.parser.Prefix' which behaves like the 4-tuple returned by
+        `parse_prefix()'. If no prefix is found, a 4-tuple of None is used.
 
         The second word in the line (first if there's no prefix), the lowercase
         version is used as command. If there's an alias for the command in
@@ -540,125 +1259,475 @@ class Client(object):
         alias. In any case, the command, with the prefix "on_" added, is the
         "handler".
 
-        This method calls the `try_call()' method, passing the "handler" as the
-        `fn' argument, the prefix as the `who' argument, and the rest of the
-        words as the `args' argument.
+        The listeners' "before_" handlers are called first, as by the
+        `try_call()' method, passing the prefix as the `who' argument, and the
+        rest of the words as the `args' argument. If any of them returns
+        something other than None, processing stops. Otherwise, the client's
+        own handler is called, followed by the listeners' "on_" handlers.
+
+        The handlers for each command are looked up only once; see
+        `refresh_listeners()'.
         """
         self.try_call("on_raw_recv", None, [ text ])
-        args = text.split(" ")
-        who = (None, None, None, None)
-        if (len(args[0]) > 0) and (args[0][0] == ':'):
-            who = parse_prefix(args[0][1:])
-            args = args[1:]
-        cmd, args = args[0], args[1:]
-        newargs = [ ]
-        last = None
-        for a in args:
-            if (last is None) and (len(a) > 0) and (a[0] == ':'):
-                last = [ ]
-                a = a[1:]
-            if last is not None:
-                last.append(a)
-            else:
-                newargs.append(a)
-        if last is not None:
-            newargs.append(" ".join(last))
-        args = newargs
-        if cmd in kaeirc.aliases.command_aliases:
-            cmd = kaeirc.aliases.command_aliases[cmd]
-        cmd = cmd.lower()
-        r = self.try_call("before_" + cmd, who, args)
-        if r is not None:
-            return r
-        fn = "on_" + cmd
-        f = None
-        if hasattr(self, fn):
-            f = getattr(self, fn)
-        elif hasattr(self, "_"+fn):
-            f = getattr(self, "_"+fn)
-        if f:
-            f(who, *args)
-        self.try_call(fn, who, args)
+        msg = kaeirc.parser.parse(text)
+        prev, self._message = self._message, msg
+        try:
+            return self._dispatch(msg)
+        finally:
+            self._message = prev
+
+    def _dispatch(self, msg):
+        who, cmd, args, _ = msg
+        if self._join_waiting and (len(args) > 1) and _is_error(cmd):
+            # Any error naming a channel being joined (even one without a
+            # handler) ends the wait for it.
+            self._join_finished(self._fold(args[1]))
+        entry = self._dispatch_table.get(cmd)
+        if entry is None:
+            fn = "on_" + cmd
+            entry = (self._lookup_handlers("before_" + cmd),
+              self._own_handlers.get(fn), self._lookup_handlers(fn))
+            self._dispatch_table[cmd] = entry
+        before, own, after = entry
+        for f in before:
+            r = f(who, *args)
+            if r is not None:
+                return r
+            if not self.connected:
+                break
+        if own is not None:
+            own(who, *args)
+        for f in after:
+            if f(who, *args) is not None:
+                break
+            if not self.connected:
+                break
 
     def _on_rpl_welcome(self, who, nickname, message):
         self._nickname = nickname
         self._authed = True
+        # Most servers end the message with our full prefix.
+        words = message.split()
+        if words:
+            nick, username, host, _ = kaeirc.parser.split_prefix(words[-1])
+            if (username is not None) and (host is not None):
+                self._userhost = (username, host)
+
+    def _on_rpl_hosthidden(self, who, me, host, message=None):
+        if self._userhost is not None:
+            self._userhost = (self._userhost[0], host)
+
+    def _on_cap(self, who, target, subcommand, *args):
+        subcommand = subcommand.upper()
+        if not args:
+            return
+        names = [ cap.split("=", 1)[0] for cap in args[-1].split() ]
+        if subcommand == "LS":
+            self._caps_offered.update(names)
+            if (len(args) > 1) and (args[0] == "*"):
+                # More lines follow.
+                return
+            if self.authed:
+                return
+            wanted = [ cap for cap in _CAPABILITIES
+              if cap in self._caps_offered ]
+            if wanted:
+                self.send("CAP REQ :%s" % " ".join(wanted))
+            else:
+                self.send("CAP END")
+        elif subcommand == "ACK":
+            for cap in names:
+                if cap[:1] == "-":
+                    self._caps.discard(cap[1:])
+                else:
+                    self._caps.add(cap)
+            if not self.authed:
+                self.send("CAP END")
+        elif subcommand == "NAK":
+            if not self.authed:
+                self.send("CAP END")
+        elif subcommand == "NEW":
+            self._caps_offered.update(names)
+        elif subcommand == "DEL":
+            self._caps_offered.difference_update(names)
+            self._caps.difference_update(names)
+
+    def _on_rpl_isupport(self, who, me, *args):
+        changed = self._isupport.update(args[:-1])
+        if "CASEMAPPING" in changed:
+            self.set_casemapping(self._isupport.casemapping)
 
     def _on_nick(self, who, nickname):
-        if nick_equals(who[0], self.nickname):
+        fold = self._fold
+        old = fold(who[0])
+        if old == fold(self.nickname):
             self._nickname = nickname
-        for name in self.channels:
-            chan = self.channels[name]
-            if who[0] in chan.nicknames:
-                old = chan.nicknames[who[0]]
-                del chan.nicknames[who[0]]
-                chan.nicknames[who[0]] = old
+        new = fold(nickname)
+        for entries in self._names.itervalues():
+            entry = entries.pop(old, None)
+            if entry is not None:
+                entries[new] = (nickname,) + entry[1:]
+        user = self._users.pop_folded(old, None)
+        if user is None:
+            return
+        user.nickname = nickname
+        user.key = new
+        self._users.set_folded(new, user)
+        for chan in user.channels:
+            nicknames = chan.nicknames
+            nicknames.set_folded(new, nicknames.pop_folded(old))
+
+    def _on_chghost(self, who, username, host):
+        if self.nick_equals(who[0], self.nickname):
+            self._userhost = (username, host)
+        user = self._users.get(who[0])
+        if user is not None:
+            user.username = username
+            user.host = host
 
     def _on_join(self, who, channel):
-        if nick_equals(who[0], self.nickname):
+        if self.nick_equals(who[0], self.nickname):
+            if (who[1] is not None) and (who[2] is not None):
+                self._userhost = (who[1], who[2])
+            key = self._fold(channel)
+            if key in self._rejoining:
+                self._rejoining.discard(key)
+                self._resyncing.add(key)
             if not channel in self.channels:
-                self.channels[channel] = Channel(channel)
-                self.channels[channel].nicknames[self.nickname] = \
-                  NickInfo(self.nickname, "")
-        else:
-            self.channels[channel].nicknames[who[0]] = NickInfo(who[0], "")
-
-    def _on_part(self, who, channel, reason):
-        if nick_equals(who[0], self.nickname):
-            if channel in self.channels:
-                del self.channels[channel]
-        else:
-            del self.channels[channel].nicknames[who[0]]
+                self.channels[channel] = Channel(channel, self._casemapping)
+        if channel in self.channels:
+            self._add_member(self.channels[channel], who[0], 0,
+              who[1], who[2])
+            entries = self._staged_names(channel)
+            if entries is not None:
+                entries.setdefault(self._fold(who[0]),
+                  (who[0], who[1], who[2], 0))
+
+    def _on_part(self, who, channel, reason=None):
+        if self.nick_equals(who[0], self.nickname):
+            self._remove_channel(channel)
+        elif channel in self.channels:
+            self._remove_member(self.channels[channel], who[0])
+            self._unstage_member(channel, who[0])
 
     def _on_ping(self, who, reply):
         self.send("PONG :%s" % reply)
 
     def _on_quit(self, who, reason=None):
-        if nick_equals(who[0], self.nickname):
+        key = self._fold(who[0])
+        if key == self._fold(self.nickname):
             self.disconnect()
         else:
-            for channel in self.channels:
-                chan = self.channels[channel]
-                if who[0] in chan.nicknames:
-                    del chan.nicknames[who[0]]
+            for entries in self._names.itervalues():
+                entries.pop(key, None)
+            user = self._users.pop_folded(key, None)
+            if user is not None:
+                for chan in user.channels:
+                    chan.nicknames.pop_folded(key, None)
 
     def _on_kick(self, who, channel, nickname, reason=None):
-        if channel in self.channels:
-            if nick_equals(who[0], self.nickname):
-                del self.channels[channel]
-            else:
-                del self.channels[channel].nicknames[nickname]
-
-    def _on_mode(self, who, channel, mode, arg1=None, arg2=None):
-        if channel[0] in kaeirc.CHANNEL_PREFIXES:
-            op = True
-            chan = self.channels[channel]
-            op = (mode[0] == '+')
+        if self.nick_equals(nickname, self.nickname):
+            self._remove_channel(channel)
+        elif channel in self.channels:
+            self._remove_member(self.channels[channel], nickname)
+            self._unstage_member(channel, nickname)
+
+    def _on_mode(self, who, target, modes=None, *args):
+        if (modes is not None) and self.is_channel(target):
+            chan = self.channels.get(target)
+            if chan is not None:
+                self._apply_modes(chan,
+                  self._isupport.parse_modes(modes, args))
+
+    def _on_rpl_channelmodeis(self, who, me, channel, modes=None, *args):
+        chan = self.channels.get(channel)
+        if (chan is not None) and (modes is not None):
+            chan.modes.clear()
+            self._apply_modes(chan, self._isupport.parse_modes(modes, args))
+
+    def _apply_modes(self, chan, changes):
+        prefix_modes = self._isupport.prefix_modes
+        list_modes = self._isupport.chanmodes[0]
+        nicknames = chan.nicknames
+        modes = chan.modes
+        entries = self._staged_names(chan.name)
+        for (mode, arg) in changes:
             c = mode[1]
-            if (c == 'o') or (c == 'v'):
-                nickname = arg1
-                if nickname is not None:
-                    if not c in chan.nicknames[nickname].mode:
-                        if op:
-                            chan.nicknames[nickname].mode += c
-                        else:
-                            chan.nicknames[nickname].mode = \
-                              chan.nicknames[nickname].mode.replace(c, '')
+            if c in prefix_modes:
+                info = nicknames.get(arg) if arg else None
+                if info is not None:
+                    info.set_mode(c, mode[0] == "+")
+                if arg and (entries is not None):
+                    self._stage_mode(entries, arg, c, mode[0] == "+")
+            elif c in list_modes:
+                continue
+            elif mode[0] == "+":
+                modes[c] = arg if arg is not None else True
+            else:
+                modes.pop(c, None)
 
     def _on_rpl_namreply(self, who, me, mode, channel, names):
+        # Names are only parsed here; the member list is replaced at once
+        # when `RPL_ENDOFNAMES' arrives. Until then, membership changes are
+        # applied to both the staged names and the current list.
         if channel in self.channels:
-            names = names.strip().split(" ")
-            for name in names:
+            fold = self._fold
+            key = fold(channel)
+            entries = self._names.get(key)
+            if entries is None:
+                entries = self._names[key] = { }
+            prefix = self._isupport.prefix
+            for name in names.split(" "):
                 if name:
-                    mode = ""
-                    if name[0] == '@':
-                        mode += 'o'
+                    status = 0
+                    while name and (name[0] in prefix):
+                        status |= mode_bit(prefix[name[0]])
                         name = name[1:]
-                    elif name[0] == '+':
-                        mode += 'v'
-                        name = name[1:]
-                    self.channels[channel].nicknames[name] = \
-                      NickInfo(name, mode)
+                    if "@" in name:
+                        nickname, username, host, _ = \
+                          kaeirc.parser.split_prefix(name)
+                        entries[fold(nickname)] = (nickname, username, host,
+                          status)
+                    elif name:
+                        entries[fold(name)] = (name, None, None, status)
+
+    def _on_rpl_endofnames(self, who, me, channel, message=None):
+        key = self._fold(channel)
+        entries = self._names.pop(key, None)
+        chan = self.channels.get(channel)
+        if (entries is not None) and (chan is not None):
+            joined, left = self._commit_names(chan, entries)
+            if key in self._resyncing:
+                self._resyncing.discard(key)
+                self.try_call("on_resync", who, [ chan.name, joined, left ])
+        self._join_finished(key)
+
+    def _on_rpl_endofmotd(self, who, me, message=None):
+        self._rejoin()
+
+    def _on_err_nomotd(self, who, me, message=None):
+        self._rejoin()
+
+    def _rejoin(self):
+        # Channels are joined again most recently active first, before any
+        # channels still queued by `join_channels()'. Channels with a key are
+        # joined with it.
+        if not self._rejoining:
+            self._send_join_batch()
+            return
+        chans = [ self._channels.get_folded(key) for key in self._rejoining ]
+        activity = { }
+        for (target, tick) in self._activity.iteritems():
+            key = self._fold(target)
+            activity[key] = max(tick, activity.get(key, 0))
+        self._activity = { }
+        chans = sorted((chan for chan in chans if chan is not None),
+          key=lambda chan: activity.get(self._fold(chan.name), 0),
+          reverse=True)
+        queue = [ ]
+        for chan in chans:
+            key = chan.modes.get("k")
+            queue.append((chan.name,
+              key if isinstance(key, basestring) else None))
+        self._join_queue[:0] = queue
+        self._send_join_batch()
+
+    def _send_join_batch(self):
+        # Sends the next batch of queued channels in a single `JOIN', unless
+        # a batch is still in flight. Channels with a key go first, since keys
+        # are matched by position.
+        if self._join_batch or not self._authed:
+            return
+        limit = self._isupport.target_limit("JOIN")
+        maxbytes = self._isupport.linelen - len("JOIN  \r\n")
+        queue = self._join_queue
+        batch = [ ]
+        size = members = 0
+        while queue:
+            name, key = queue[0]
+            fold = self._fold(name)
+            chan = self._channels.get_folded(fold)
+            if (fold in self._join_waiting) or ((chan is not None)
+              and (fold not in self._rejoining)):
+                # Duplicate, or already joined.
+                queue.pop(0)
+                continue
+            n = len(chan.nicknames) if chan is not None else 0
+            width = len(name.encode(self._encoding, "replace")) + 1
+            if key is not None:
+                width += len(key.encode(self._encoding, "replace")) + 1
+            if batch and (((limit is not None) and (len(batch) >= limit))
+              or (size + width > maxbytes)
+              or (members + n > _JOIN_BATCH_MEMBERS)):
+                break
+            queue.pop(0)
+            batch.append((name, key))
+            self._join_waiting.add(fold)
+            size += width
+            members += n
+        if not batch:
+            return
+        batch.sort(key=lambda entry: entry[1] is None)
+        self._join_names = [ name for (name, _) in batch ]
+        self._join_batch = set(self._join_waiting)
+        keys = [ key for (_, key) in batch if key is not None ]
+        if keys:
+            self.send("JOIN %s %s" % (",".join(self._join_names),
+              ",".join(keys)), PRIORITY_BULK)
+        else:
+            self.send("JOIN %s" % ",".join(self._join_names), PRIORITY_BULK)
+        timeout = self._send_queue.eta() + _JOIN_BATCH_TIMEOUT
+        self._join_deadline = kaeirc.util.monotonic() + timeout
+        if self._loop is not None:
+            # Just polls; `poll()' checks the deadline.
+            self._join_timer = self._loop.call_later(timeout,
+              self._loop.notify, self)
+
+    def _cancel_join_timer(self):
+        if self._join_timer is not None:
+            self._join_timer.cancel()
+            self._join_timer = None
+
+    def _join_finished(self, key):
+        # The batch is reported (and the next one sent) by `poll()' after
+        # processing all the received data, so the listeners' handlers for
+        # the last reply see the channel as still joining.
+        if key in self._join_waiting:
+            self._join_waiting.discard(key)
+            if not self._join_waiting:
+                self._join_complete = True
+
+    def _on_privmsg(self, who, target, text=None):
+        self._activity_tick += 1
+        self._activity[target] = self._activity_tick
+
+    _on_notice = _on_privmsg
+
+    def _on_join_error(self, who, me, channel, message=None):
+        # Forget the channels we couldn't join again.
+        key = self._fold(channel)
+        if key in self._rejoining:
+            self._rejoining.discard(key)
+            self._remove_channel(channel)
+        self._join_finished(key)
+
+    _on_err_nosuchchannel = _on_join_error
+    _on_err_toomanychannels = _on_join_error
+    _on_err_channelisfull = _on_join_error
+    _on_err_inviteonlychan = _on_join_error
+    _on_err_bannedfromchan = _on_join_error
+    _on_err_badchannelkey = _on_join_error
+    _on_err_badchanmask = _on_join_error
+    _on_err_unavailresource = _on_join_error
+    _on_err_needreggednick = _on_join_error
+    _on_err_badchanname = _on_join_error
+
+    def _on_err_linkchannel(self, who, me, channel, forward=None,
+      message=None):
+        # The server joins us to `forward' instead; that's like any other
+        # channel joined by the user.
+        self._on_join_error(who, me, channel, message)
+
+    def _staged_names(self, channel):
+        # Returns the names staged for `channel' (a dictionary mapping folded
+        # nicknames to `(nickname, username, host, status)' tuples), or None
+        # if no `NAMES' reply is in progress for it.
+        if not self._names:
+            return None
+        return self._names.get(self._fold(channel))
+
+    def _unstage_member(self, channel, nickname):
+        entries = self._staged_names(channel)
+        if entries is not None:
+            entries.pop(self._fold(nickname), None)
+
+    def _stage_mode(self, entries, nickname, c, value):
+        key = self._fold(nickname)
+        entry = entries.get(key)
+        if entry is not None:
+            status = entry[3]
+            if value:
+                status |= mode_bit(c)
+            else:
+                status &= ~mode_bit(c)
+            entries[key] = entry[:3] + (status,)
+
+    def _commit_names(self, chan, entries):
+        # Returns the lists of nicknames added and removed.
+        users = self._users
+        old = chan.nicknames
+        new = kaeirc.util.casedict(casemapping=self._casemapping)
+        joined, left = [ ], [ ]
+        for (key, (nickname, username, host, status)) in entries.iteritems():
+            user = users.get_folded(key)
+            if user is None:
+                user = User(nickname, username, host, key)
+                users.set_folded(key, user)
+            else:
+                key = user.key
+                if username is not None:
+                    user.username = username
+                    user.host = host
+            info = old.get_folded(key)
+            if info is None:
+                info = NickInfo(user, status=status)
+                if not chan in user.channels:
+                    user.channels.append(chan)
+                joined.append(user.nickname)
+            else:
+                info.status = status
+            new.set_folded(key, info)
+        for (key, info) in old.iteritems():
+            if new.get_folded(key) is None:
+                user = info.user
+                left.append(user.nickname)
+                if chan in user.channels:
+                    user.channels.remove(chan)
+                if not user.channels:
+                    users.pop_folded(user.key, None)
+        chan._nicknames = new
+        return (joined, left)
+
+    def _add_member(self, chan, nickname, status=0, username=None,
+      host=None):
+        key = self._fold(nickname)
+        user = self._users.get_folded(key)
+        if user is None:
+            user = User(nickname, username, host, key)
+            self._users.set_folded(key, user)
+        else:
+            # Share the key object with the other channels.
+            key = user.key
+            if username is not None:
+                user.username = username
+                user.host = host
+        info = chan.nicknames.get_folded(key)
+        if info is None:
+            chan.nicknames.set_folded(key, NickInfo(user, status=status))
+        else:
+            info.status = status
+        if not chan in user.channels:
+            user.channels.append(chan)
+
+    def _remove_member(self, chan, nickname):
+        chan.nicknames.pop(nickname, None)
+        user = self._users.get(nickname)
+        if user is not None:
+            if chan in user.channels:
+                user.channels.remove(chan)
+            if not user.channels:
+                del self._users[nickname]
+
+    def _remove_channel(self, channel):
+        chan = self._channels.pop(channel, None)
+        if chan is None:
+            return
+        for info in chan.nicknames.itervalues():
+            user = info.user
+            if chan in user.channels:
+                user.channels.remove(chan)
+            if not user.channels:
+                self._users.pop_folded(user.key, None)
 
     def _on_err_nicknameinuse(self, who, me, nickname, message):
         if not self.authed:
@@ -675,3 +1744,233 @@ class Client(object):
             self.nick(nick + c)
 
 #=============================================================================
+
+class MessageQueue(object):
+    """Queue of `Message' objects received by an `AsyncClient'.
+
+    Iterating over the queue yields (and removes) the messages already
+    received, without waiting. To wait for the next message, use `get()'.
+    """
+
+    @property
+    def closed(self):
+        """Boolean telling whether the client was disconnected. No more
+        messages are added after this is set.
+        """
+        return self._closed
+
+    def __init__(self):
+        """Create a new, empty `MessageQueue'."""
+        self._messages = collections.deque()
+        self._waiters = collections.deque()
+        self._closed = False
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        while self._messages:
+            yield self._messages.popleft()
+
+    def get(self):
+        """Return a `kaeirc.loop.Future' which completes with the next
+        message, or with None if the queue is closed.
+        """
+        f = kaeirc.loop.Future()
+        if self._messages:
+            f.set_result(self._messages.popleft())
+        elif self._closed:
+            f.set_result(None)
+        else:
+            self._waiters.append(f)
+        return f
+
+    def put(self, message):
+        """Add a message to the queue. Used by `AsyncClient'."""
+        if self._waiters:
+            self._waiters.popleft().set_result(message)
+        else:
+            self._messages.append(message)
+
+    def close(self):
+        """Close the queue, waking up all waiters with None."""
+        self._closed = True
+        while self._waiters:
+            self._waiters.popleft().set_result(None)
+
+#=============================================================================
+
+class AsyncClient(Client):
+    """Variant of `Client' which runs entirely on a `kaeirc.loop.EventLoop'.
+
+    Nothing in this class blocks (except for name resolution): `connect()'
+    returns a `kaeirc.loop.Future' which completes when the server sends the
+    `RPL_WELCOME' reply, and the received messages are available through
+    the `messages' queue in addition to the usual listener calls. This allows
+    several connections, and the coroutines using them (see
+    `kaeirc.loop.Task'), to share a single loop without threads or polling.
+
+    The listener API is the same as for `Client'.
+    """
+
+    @property
+    def messages(self):
+        """`MessageQueue' holding the `Message' objects received."""
+        return self._messages
+
+    def __init__(self, loop, username, address, nickname=None, realname=None,
+      encoding="utf-8", tls=False, tls_verify=True):
+        """Create a new `kaeirc.AsyncClient' running on `loop'.
+
+        The rest of the arguments are the same as for `Client'.
+        """
+        Client.__init__(self, username, address, nickname=nickname,
+          realname=realname, encoding=encoding, tls=tls,
+          tls_verify=tls_verify)
+        self._loop = loop
+        self._messages = MessageQueue()
+        self._connect_future = None
+        self._connect_timer = None
+        self._connector = None
+        self._attempt_timer = None
+        self._pending_socket = None
+
+    def connect(self, timeout=10, transport=None):
+        """Start connecting to the IRC server.
+
+        Returns a `kaeirc.loop.Future' which completes with this client once
+        the registration finishes, or with `ConnectionError' or
+        `socket.error' if it fails. `timeout' is the maximum time in seconds
+        (fractions allowed) for the whole process.
+
+        All the addresses of the host are tried as described in
+        `kaeirc.transport.Connector'. If `transport' is not None, it's used
+        instead of connecting to the address, as in `Client.connect()'.
+
+        Must be called from the loop thread.
+        """
+        f = kaeirc.loop.Future()
+        self._connect_future = f
+        self._messages = MessageQueue()
+        self._send_queue.clear()
+        self._quitting = False
+        self._authed = False
+        self._connect_timer = self._loop.call_later(timeout,
+          self._connect_failed, ConnectionError("Timed out"))
+        if transport is not None:
+            self._connect_done(transport)
+            return f
+        try:
+            self._connector = kaeirc.transport.Connector(self.address)
+        except socket.error as e:
+            self._connect_failed(e)
+            return f
+        self._start_attempts()
+        return f
+
+    def _start_attempts(self):
+        connector = self._connector
+        self._attempt_timer = None
+        for sock in connector.step():
+            self._loop.watch(sock.fileno(), kaeirc.loop.WRITE,
+              lambda mask, sock=sock: self._on_attempt_ready(sock))
+        if connector.failed:
+            self._connect_failed(connector.error)
+        elif connector.next_time is not None:
+            self._attempt_timer = self._loop.call_later(max(0,
+              connector.next_time - kaeirc.util.monotonic()),
+              self._start_attempts)
+
+    def _stop_attempts(self):
+        connector = self._connector
+        if connector is None:
+            return
+        if self._attempt_timer is not None:
+            self._attempt_timer.cancel()
+            self._attempt_timer = None
+        for sock in connector.attempts:
+            self._loop.unwatch(sock.fileno())
+        connector.close()
+        self._connector = None
+
+    def _on_attempt_ready(self, sock):
+        self._loop.unwatch(sock.fileno())
+        connector = self._connector
+        if not connector.check(sock):
+            if self._attempt_timer is not None:
+                self._attempt_timer.cancel()
+            self._start_attempts()
+            return
+        self._stop_attempts()
+        if not self._tls:
+            self._connect_done(kaeirc.transport.SocketTransport(sock))
+            return
+        self._pending_socket = sock
+        try:
+            transport = kaeirc.transport.TLSTransport(sock, self.address[0],
+              self._tls_verify)
+        except (socket.error, ssl.SSLError) as e:
+            self._connect_failed(e)
+            return
+        self._pending_socket = transport.socket
+        self._on_handshake_ready(transport, 0)
+
+    def _on_handshake_ready(self, transport, mask):
+        fd = transport.fileno()
+        try:
+            wait = transport.handshake()
+        except (socket.error, ssl.SSLError) as e:
+            self._loop.unwatch(fd)
+            self._connect_failed(e)
+            return
+        if wait:
+            self._loop.watch(fd, wait,
+              lambda mask: self._on_handshake_ready(transport, mask))
+            return
+        self._loop.unwatch(fd)
+        self._pending_socket = None
+        self._connect_done(transport)
+
+    def _connect_done(self, transport):
+        self._transport = transport
+        self._connected = True
+        self._init_buffers()
+        self._register()
+        self._loop.add_client(self)
+
+    def _connect_failed(self, exc):
+        f = self._connect_future
+        if (f is None) or f.done():
+            return
+        self._connect_timer.cancel()
+        self._stop_attempts()
+        if self._pending_socket is not None:
+            self._loop.unwatch(self._pending_socket.fileno())
+            self._pending_socket.close()
+            self._pending_socket = None
+        if self._transport is not None:
+            self._loop.remove_client(self)
+            self._transport.close()
+        self._transport = None
+        self._connected = False
+        self._messages.close()
+        f.set_exception(exc)
+
+    def poll(self):
+        Client.poll(self)
+        if (self._transport is None) and not self._messages.closed:
+            self._messages.close()
+            self._connect_failed(ConnectionError("Connection closed"))
+
+    def _dispatch(self, msg):
+        self._messages.put(msg)
+        return Client._dispatch(self, msg)
+
+    def _on_rpl_welcome(self, who, nickname, message):
+        Client._on_rpl_welcome(self, who, nickname, message)
+        f = self._connect_future
+        if (f is not None) and not f.done():
+            self._connect_timer.cancel()
+            f.set_result(self)
+
+#=============================================================================
@@ -15,7 +15,7 @@ command_aliases = {
     '002': 'rpl_yourhost',
     '003': 'rpl_created',
     '004': 'rpl_myinfo',
-    '005': 'rpl_bounce',
+    '005': 'rpl_isupport',
     '200': 'rpl_tracelink',
     '201': 'rpl_traceconnecting',
     '202': 'rpl_tracehandshake',
@@ -90,6 +90,7 @@ command_aliases = {
     '393': 'rpl_users',
     '394': 'rpl_endofusers',
     '395': 'rpl_nousers',
+    '396': 'rpl_hosthidden',
     '401': 'err_nosuchnick',
     '402': 'err_nosuchserver',
     '403': 'err_nosuchchannel',
@@ -110,6 +111,7 @@ command_aliases = {
     '432': 'err_erroneusnickname',
     '433': 'err_nicknameinuse',
     '436': 'err_nickcollision',
+    '437': 'err_unavailresource',
     '441': 'err_usernotinchannel',
     '442': 'err_notonchannel',
     '443': 'err_useronchannel',
@@ -123,11 +125,15 @@ command_aliases = {
     '464': 'err_passwdmismatch',
     '465': 'err_yourebannedcreep',
     '467': 'err_keyset',
+    '470': 'err_linkchannel',
     '471': 'err_channelisfull',
     '472': 'err_unknownmode',
     '473': 'err_inviteonlychan',
     '474': 'err_bannedfromchan',
     '475': 'err_badchannelkey',
+    '476': 'err_badchanmask',
+    '477': 'err_needreggednick',
+    '479': 'err_badchanname',
     '481': 'err_noprivileges',
     '482': 'err_chanoprivsneeded',
     '483': 'err_cantkillserver',
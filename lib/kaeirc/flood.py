@@ -0,0 +1,219 @@
+
+"""
+Flood Control
+
+This module contains the send queue used by `kaeirc.Client' to avoid being
+disconnected by the server for flooding ("Excess Flood").
+
+Lines are queued with a priority, and released according to a token bucket:
+the bucket holds up to `burst' tokens, and is refilled at `rate' tokens per
+second. Sending a line takes one token. Lines with `PRIORITY_IMMEDIATE' are
+always released right away (they still take a token, so the following lines
+are delayed accordingly); the rest are released only while there are tokens
+left, interactive lines first. So that steady interactive traffic doesn't
+hold bulk lines back forever, at least one of every `BULK_SHARE' lines
+released while bulk lines are waiting is a bulk line.
+
+Constants:
+
+PRIORITY_IMMEDIATE
+  Lines which must never be delayed, like `PONG' and `QUIT'. `kaeirc.Client'
+  also sends every line with this priority until the registration is
+  accepted, so retrying a nickname in use doesn't wait for tokens.
+
+PRIORITY_INTERACTIVE
+  Lines caused directly by the user, like `PRIVMSG' and `NOTICE'. This is the
+  default for commands not listed in `command_priorities'.
+
+PRIORITY_BULK
+  Lines which may wait, like `MODE', `WHO', or automatic `JOIN's.
+
+BULK_SHARE
+  Bulk lines get at least one of every this many lines released.
+
+DEFAULT_BURST
+DEFAULT_RATE
+  Default values for the `burst' and `rate' parameters of `SendQueue': a
+  burst of 10 lines, then one line every 2 seconds. This is the rate most
+  servers tolerate indefinitely; their own limits usually allow a burst of
+  about 10 lines, and disconnect clients averaging more than a line per
+  second or so, so staying below that leaves room for lag spikes.
+
+command_priorities
+  Mapping from upper-cased command names to their default priority.
+"""
+
+import collections
+
+import kaeirc.util
+
+#=============================================================================
+
+PRIORITY_IMMEDIATE = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+
+BULK_SHARE = 4
+
+DEFAULT_BURST = 10
+DEFAULT_RATE = 0.5
+
+command_priorities = {
+    "PONG": PRIORITY_IMMEDIATE,
+    "QUIT": PRIORITY_IMMEDIATE,
+    "PASS": PRIORITY_IMMEDIATE,
+    "CAP": PRIORITY_IMMEDIATE,
+    "USER": PRIORITY_IMMEDIATE,
+    "PRIVMSG": PRIORITY_INTERACTIVE,
+    "NOTICE": PRIORITY_INTERACTIVE,
+    "MODE": PRIORITY_BULK,
+    "WHO": PRIORITY_BULK,
+}
+
+#=============================================================================
+
+def command_priority(text):
+    """Return the default priority for a raw line, based on it's command."""
+    end = text.find(" ")
+    cmd = text[:end] if end != -1 else text
+    return command_priorities.get(cmd.upper(), PRIORITY_INTERACTIVE)
+
+#=============================================================================
+
+class SendQueue(object):
+    """Priority queue of outgoing lines, released by a token bucket.
+
+    `put()', `depth()', and `eta()' may be called from any thread. The rest
+    of the methods should only be called from the thread sending the data.
+    """
+
+    @property
+    def burst(self):
+        """Maximum number of lines sent at once after being idle."""
+        return self._burst
+
+    @property
+    def rate(self):
+        """Number of lines per second (fractions allowed) sent when the burst
+        is exhausted, or None if flood control is disabled.
+        """
+        return self._rate
+
+    def __init__(self, burst=DEFAULT_BURST, rate=DEFAULT_RATE):
+        """Create a new, empty `SendQueue'. See `configure()' for the meaning
+        of the parameters.
+        """
+        self._queues = (
+            collections.deque(),
+            collections.deque(),
+            collections.deque(),
+        )
+        self._burst = burst
+        self._rate = rate or None
+        self._tokens = float(burst)
+        self._stamp = kaeirc.util.monotonic()
+        # Interactive lines released in a row while bulk lines were waiting.
+        self._bulk_wait = 0
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues)
+
+    def configure(self, burst=DEFAULT_BURST, rate=DEFAULT_RATE):
+        """Change the parameters of the token bucket.
+
+        `burst' is the maximum number of lines sent at once. `rate' is the
+        number of lines per second (fractions allowed) sent after that. If
+        `rate' is None or zero, flood control is disabled.
+        """
+        self._refill(kaeirc.util.monotonic())
+        self._burst = burst
+        self._rate = rate or None
+        self._tokens = min(self._tokens, float(burst))
+
+    def put(self, line, priority=PRIORITY_INTERACTIVE):
+        """Add a line to the queue, with the given priority."""
+        self._queues[priority].append(line)
+
+    def clear(self):
+        """Remove all the lines, and fill the bucket."""
+        for q in self._queues:
+            q.clear()
+        self._tokens = float(self._burst)
+        self._stamp = kaeirc.util.monotonic()
+        self._bulk_wait = 0
+
+    def depth(self, priority=None):
+        """Return the number of lines waiting with the given priority, or in
+        total if `priority' is None.
+        """
+        if priority is None:
+            return len(self)
+        return len(self._queues[priority])
+
+    def ready(self):
+        """Return whether `pop_ready()' would return at least one line."""
+        if self._queues[PRIORITY_IMMEDIATE]:
+            return True
+        if not (self._queues[PRIORITY_INTERACTIVE]
+          or self._queues[PRIORITY_BULK]):
+            return False
+        if self._rate is None:
+            return True
+        self._refill(kaeirc.util.monotonic())
+        return (self._tokens >= 1)
+
+    def pop_ready(self):
+        """Remove and return the list of lines which may be sent now, in the
+        order they should be sent.
+        """
+        r = [ ]
+        immediate, interactive, bulk = self._queues
+        self._refill(kaeirc.util.monotonic())
+        while immediate:
+            r.append(immediate.popleft())
+            self._tokens -= 1
+        while ((interactive or bulk)
+          and ((self._rate is None) or (self._tokens >= 1))):
+            if bulk and ((not interactive)
+              or (self._bulk_wait >= BULK_SHARE - 1)):
+                r.append(bulk.popleft())
+                self._bulk_wait = 0
+            else:
+                r.append(interactive.popleft())
+                self._bulk_wait = (self._bulk_wait + 1) if bulk else 0
+            self._tokens -= 1
+        if self._rate is None:
+            self._tokens = float(self._burst)
+        return r
+
+    def delay(self):
+        """Return the time in seconds until the next queued line may be sent,
+        or None if there are no lines waiting for tokens.
+        """
+        if (self._rate is None) or not (self._queues[PRIORITY_INTERACTIVE]
+          or self._queues[PRIORITY_BULK]):
+            return None
+        self._refill(kaeirc.util.monotonic())
+        return max(0.0, (1 - self._tokens) / self._rate)
+
+    def eta(self):
+        """Return the estimated time in seconds needed to send all the queued
+        lines.
+        """
+        n = len(self)
+        if (n == 0) or (self._rate is None):
+            return 0.0
+        tokens = self._tokens_at(kaeirc.util.monotonic())
+        return max(0.0, (n - tokens) / self._rate)
+
+    def _tokens_at(self, now):
+        if self._rate is None:
+            return self._tokens
+        return min(float(self._burst),
+          self._tokens + (now - self._stamp) * self._rate)
+
+    def _refill(self, now):
+        self._tokens = self._tokens_at(now)
+        self._stamp = now
+
+#=============================================================================
@@ -0,0 +1,303 @@
+
+"""
+ISUPPORT Registry
+
+This module contains the registry of features announced by the server in
+`RPL_ISUPPORT' (005) replies, like the channel types, the user mode prefixes,
+or the number of modes allowed per `MODE' command.
+
+`kaeirc.Client' keeps an instance in it's `isupport' attribute, which is
+filled during registration and used by the client to parse replies and to
+build outgoing lines. Until the server sends a token, the value from
+`DEFAULTS' is used.
+
+Constants:
+
+DEFAULTS
+  Values assumed for tokens not sent by the server. These match the
+  behavior described in RFC 1459.
+
+DEFAULT_TARGETS
+  Number of targets assumed for commands which take a comma-separated list
+  in RFC 1459, when `TARGMAX' doesn't list them.
+"""
+
+import re
+
+import kaeirc.util
+
+#=============================================================================
+
+DEFAULTS = {
+    "CASEMAPPING": kaeirc.util.DEFAULT_CASEMAPPING,
+    "CHANTYPES": "#&+!",
+    "PREFIX": "(ov)@+",
+    "CHANMODES": "beI,k,l,imnpst",
+    "MODES": "3",
+    "NICKLEN": "9",
+    "CHANNELLEN": "50",
+    "TOPICLEN": "390",
+    "LINELEN": "512",
+}
+
+DEFAULT_TARGETS = {
+    "JOIN": 10,
+    "PART": 10,
+}
+
+#=============================================================================
+
+_escape_re = re.compile(r"\\x([0-9A-Fa-f]{2})")
+
+def unescape_value(value):
+    """Unescape a token value, replacing `\\xHH' sequences with the
+    character with code `HH' (in hexadecimal).
+    """
+    if not "\\" in value:
+        return value
+    return _escape_re.sub(lambda m: unichr(int(m.group(1), 16)), value)
+
+def _to_int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+#=============================================================================
+
+class ISupport(object):
+    """Registry of ISUPPORT tokens.
+
+    The raw values are available through `get()'; the most used tokens are
+    also available parsed as attributes, which are updated by `update()'.
+    """
+
+    @property
+    def tokens(self):
+        """Dictionary mapping upper-cased token names to their (unescaped)
+        values, as sent by the server. Tokens without a value are mapped to
+        an empty string. Does not include `DEFAULTS'.
+        """
+        return self._tokens
+
+    @property
+    def casemapping(self):
+        """Case mapping for nicknames and channel names."""
+        return self._casemapping
+
+    @property
+    def chantypes(self):
+        """String with the characters allowed as first character of a
+        channel name.
+        """
+        return self._chantypes
+
+    @property
+    def prefix_modes(self):
+        """String with the channel member modes having a prefix, from highest
+        to lowest rank (for example, `ov').
+        """
+        return self._prefix_modes
+
+    @property
+    def prefix_symbols(self):
+        """String with the prefixes of `prefix_modes', in the same order
+        (for example, `@+').
+        """
+        return self._prefix_symbols
+
+    @property
+    def prefix(self):
+        """Dictionary mapping prefix symbols to their modes."""
+        return self._prefix
+
+    @property
+    def chanmodes(self):
+        """4-tuple of strings with the channel modes taking a list argument
+        (type A), always taking an argument (type B), taking an argument only
+        when set (type C), and never taking an argument (type D).
+        """
+        return self._chanmodes
+
+    @property
+    def modes(self):
+        """Maximum number of modes with an argument per `MODE' command, or
+        None if there is no limit.
+        """
+        return self._modes
+
+    @property
+    def nicklen(self):
+        """Maximum length of a nickname."""
+        return self._nicklen
+
+    @property
+    def channellen(self):
+        """Maximum length of a channel name."""
+        return self._channellen
+
+    @property
+    def topiclen(self):
+        """Maximum length of a channel topic."""
+        return self._topiclen
+
+    @property
+    def linelen(self):
+        """Maximum length of a line, in bytes, including the CR/LF."""
+        return self._linelen
+
+    @property
+    def network(self):
+        """Name of the network, or None if not announced."""
+        return self._tokens.get("NETWORK")
+
+    def __init__(self):
+        """Create a new `ISupport' instance, with only the defaults."""
+        self._tokens = { }
+        self._targmax = { }
+        self._refresh()
+
+    def __contains__(self, name):
+        return name.upper() in self._tokens
+
+    def get(self, name, default=None):
+        """Return the value of a token, or `default' if the server didn't
+        send it. The value from `DEFAULTS' is not used here.
+        """
+        return self._tokens.get(name.upper(), default)
+
+    def clear(self):
+        """Forget all the tokens sent by the server."""
+        self._tokens.clear()
+        self._refresh()
+
+    def update(self, params):
+        """Update the registry with the parameters of a `RPL_ISUPPORT' reply
+        (without the target nickname and the trailing text).
+
+        Parameters of the form `-NAME' remove the token. Returns the set of
+        upper-cased names which changed.
+        """
+        changed = set()
+        for param in params:
+            if not param:
+                continue
+            if param[0] == "-":
+                name = param[1:].upper()
+                if self._tokens.pop(name, None) is not None:
+                    changed.add(name)
+                continue
+            eq = param.find("=")
+            if eq == -1:
+                name, value = param.upper(), ""
+            else:
+                name = param[:eq].upper()
+                value = unescape_value(param[eq+1:])
+            if self._tokens.get(name) != value:
+                self._tokens[name] = value
+                changed.add(name)
+        if changed:
+            self._refresh()
+        return changed
+
+    def is_channel(self, name):
+        """Return whether `name' is a channel name, according to
+        `CHANTYPES'.
+        """
+        return bool(name) and (name[0] in self._chantypes)
+
+    def mode_type(self, c):
+        """Return the type of the channel mode `c': `"prefix"' for member
+        modes (see `prefix_modes'), `"A"', `"B"', `"C"', or `"D"' as in
+        `chanmodes', or None if it's not known.
+        """
+        if c in self._prefix_modes:
+            return "prefix"
+        for (t, modes) in zip("ABCD", self._chanmodes):
+            if c in modes:
+                return t
+        return None
+
+    def parse_modes(self, modes, args):
+        """Split a mode string and it's arguments into single mode changes.
+
+        `modes' is a mode string like `+ov-b', and `args' the list of
+        arguments following it. Each mode takes an argument or not depending
+        on it's type (see `mode_type()'); unknown modes take no argument.
+
+        Returns a list of `(mode, arg)' tuples, where `mode' is a sign
+        followed by the mode character (like `+o'), and `arg' is the
+        argument, or None. This is the same format used by
+        `kaeirc.Client.modes()'.
+        """
+        changes = [ ]
+        always, when_set = self._arg_modes, self._set_arg_modes
+        nargs = len(args)
+        i = 0
+        sign = "+"
+        for c in modes:
+            if (c == "+") or (c == "-"):
+                sign = c
+            elif (c in always) or ((sign == "+") and (c in when_set)):
+                if i < nargs:
+                    changes.append((sign + c, args[i]))
+                    i += 1
+                else:
+                    # List modes without argument query the list.
+                    changes.append((sign + c, None))
+            else:
+                changes.append((sign + c, None))
+        return changes
+
+    def target_limit(self, command):
+        """Return the maximum number of targets for `command' (as given by
+        `TARGMAX', or `MAXTARGETS' for `PRIVMSG' and `NOTICE'), or None if
+        there is no limit. Commands not listed take the number of targets in
+        `DEFAULT_TARGETS', or a single target.
+        """
+        command = command.upper()
+        if command in self._targmax:
+            return self._targmax[command]
+        return DEFAULT_TARGETS.get(command, 1)
+
+    def _value(self, name):
+        value = self._tokens.get(name)
+        if value is None:
+            value = DEFAULTS.get(name)
+        return value
+
+    def _refresh(self):
+        self._casemapping = (self._value("CASEMAPPING").lower()
+          or kaeirc.util.DEFAULT_CASEMAPPING)
+        self._chantypes = self._value("CHANTYPES")
+        prefix = self._value("PREFIX")
+        modes, symbols = "", ""
+        if prefix.startswith("(") and (")" in prefix):
+            modes, symbols = prefix[1:].split(")", 1)
+            n = min(len(modes), len(symbols))
+            modes, symbols = modes[:n], symbols[:n]
+        self._prefix_modes = modes
+        self._prefix_symbols = symbols
+        self._prefix = dict(zip(symbols, modes))
+        chanmodes = self._value("CHANMODES").split(",")
+        chanmodes += [ "" ] * (4 - len(chanmodes))
+        self._chanmodes = tuple(chanmodes[:4])
+        self._arg_modes = frozenset(modes + chanmodes[0] + chanmodes[1])
+        self._set_arg_modes = frozenset(chanmodes[2])
+        value = self._value("MODES")
+        self._modes = _to_int(value, None) if value else None
+        self._nicklen = _to_int(self._value("NICKLEN"), 9)
+        self._channellen = _to_int(self._value("CHANNELLEN"), 50)
+        self._topiclen = _to_int(self._value("TOPICLEN"), 390)
+        self._linelen = _to_int(self._value("LINELEN"), 512)
+        self._targmax = targmax = { }
+        value = self._tokens.get("MAXTARGETS")
+        if value is not None:
+            limit = _to_int(value, None)
+            targmax["PRIVMSG"] = targmax["NOTICE"] = limit
+        for item in self._tokens.get("TARGMAX", "").split(","):
+            if ":" in item:
+                command, limit = item.split(":", 1)
+                targmax[command.upper()] = _to_int(limit, None)
+
+#=============================================================================
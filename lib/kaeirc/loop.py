@@ -0,0 +1,529 @@
+
+"""
+Event Loop
+
+This module contains a single-threaded event loop which multiplexes the
+sockets of any number of `kaeirc.Client' instances. The loop only wakes up
+when a socket becomes readable or writable, when a timer expires, or when
+another thread asks it to (for example, because a client has queued some text
+to send).
+
+On Linux, `select.epoll' is used. On other systems, the loop falls back to
+`select.select'.
+
+Constants:
+
+READ
+WRITE
+  Bit flags used to specify which events are of interest for a file
+  descriptor.
+
+Besides the loop itself, this module provides `Future' and `Task', which
+allow writing generator-based coroutines that run on the loop without
+blocking it. See `Task' for details.
+"""
+
+import os
+import errno
+import fcntl
+import heapq
+import select
+import thread
+import threading
+
+import kaeirc.util
+
+#=============================================================================
+
+READ = 1
+WRITE = 2
+
+#=============================================================================
+
+class _EpollPoller(object):
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def _convert(self, mask):
+        events = 0
+        if mask & READ:
+            events |= select.EPOLLIN
+        if mask & WRITE:
+            events |= select.EPOLLOUT
+        return events
+
+    def register(self, fd, mask):
+        self._epoll.register(fd, self._convert(mask))
+
+    def modify(self, fd, mask):
+        self._epoll.modify(fd, self._convert(mask))
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self._epoll.poll(timeout)
+        except IOError as e:
+            if e.errno == errno.EINTR:
+                return [ ]
+            raise
+        r = [ ]
+        for (fd, ev) in events:
+            mask = 0
+            if ev & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                mask |= READ
+            if ev & select.EPOLLOUT:
+                mask |= WRITE
+            r.append((fd, mask))
+        return r
+
+#=============================================================================
+
+class _SelectPoller(object):
+
+    def __init__(self):
+        self._fds = { }
+
+    def register(self, fd, mask):
+        self._fds[fd] = mask
+
+    modify = register
+
+    def unregister(self, fd):
+        del self._fds[fd]
+
+    def poll(self, timeout):
+        rl = [ fd for fd in self._fds if self._fds[fd] & READ ]
+        wl = [ fd for fd in self._fds if self._fds[fd] & WRITE ]
+        try:
+            rl, wl, _ = select.select(rl, wl, [ ], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return [ ]
+            raise
+        r = { }
+        for fd in rl:
+            r[fd] = READ
+        for fd in wl:
+            r[fd] = r.get(fd, 0) | WRITE
+        return r.items()
+
+#=============================================================================
+
+def _make_poller():
+    if hasattr(select, "epoll"):
+        return _EpollPoller()
+    else:
+        return _SelectPoller()
+
+#=============================================================================
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+#=============================================================================
+
+class Timer(object):
+    """Handle for a callback scheduled with `EventLoop.call_later()'."""
+
+    @property
+    def when(self):
+        """Time (as returned by `kaeirc.util.monotonic()') at which the
+        callback is called.
+        """
+        return self._when
+
+    @property
+    def cancelled(self):
+        """Boolean telling whether `cancel()' was called."""
+        return self._cancelled
+
+    def __init__(self, when, callback, args):
+        """Create a new `Timer'. Use `EventLoop.call_later()' instead."""
+        self._when = when
+        self._callback = callback
+        self._args = args
+        self._cancelled = False
+
+    def __lt__(self, other):
+        return self._when < other._when
+
+    def cancel(self):
+        """Cancel the timer, so the callback is not called."""
+        self._cancelled = True
+
+    def run(self):
+        """Call the callback, unless the timer was cancelled."""
+        if not self._cancelled:
+            self._callback(*self._args)
+
+#=============================================================================
+
+class Future(object):
+    """Placeholder for the result of an operation which has not completed
+    yet.
+
+    Callbacks added with `add_done_callback()' are called (in the thread
+    which completes the future, usually the loop thread) when either
+    `set_result()' or `set_exception()' is called.
+    """
+
+    def __init__(self):
+        """Create a new, pending `Future'."""
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = [ ]
+
+    def done(self):
+        """Return whether the future has a result or an exception."""
+        return self._done
+
+    def result(self):
+        """Return the result of the future.
+
+        If the future completed with an exception, that exception is raised.
+        If the future is not done yet, `RuntimeError' is raised.
+        """
+        if not self._done:
+            raise RuntimeError("Result is not ready")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        """Return the exception set on this future, or None."""
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """Arrange for `callback' to be called with this future as only
+        argument when the future is done. If it's already done, `callback' is
+        called immediately.
+        """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        """Mark the future as done, with the given result."""
+        self._complete(result, None)
+
+    def set_exception(self, exception):
+        """Mark the future as done, with the given exception."""
+        self._complete(None, exception)
+
+    def _complete(self, result, exception):
+        if self._done:
+            raise RuntimeError("Future is already done")
+        self._done = True
+        self._result = result
+        self._exception = exception
+        callbacks, self._callbacks = self._callbacks, [ ]
+        for callback in callbacks:
+            callback(self)
+
+#=============================================================================
+
+class Return(Exception):
+    """Raised by a coroutine to finish with a value. See `Task'."""
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+#=============================================================================
+
+class Task(Future):
+    """Run a generator-based coroutine on an `EventLoop'.
+
+    The coroutine yields `Future' instances (or None, to just let other tasks
+    run). The task resumes the coroutine with the result of the future once
+    it's done, or throws the exception into it. The coroutine may finish with
+    a value by raising `Return(value)'. The `Task' is itself a future, which
+    completes when the coroutine does. For example:
+
+      def bot(loop):
+          client = kaeirc.AsyncClient(loop, "bot", ("irc.example.net", 6667))
+          yield client.connect()
+          client.join("#bots")
+          while True:
+              msg = yield client.messages.get()
+              if msg is None:
+                  break
+              ...
+
+      kaeirc.loop.Task(loop, bot(loop))
+      loop.run()
+    """
+
+    def __init__(self, loop, coro):
+        """Create a new `Task' running the generator `coro' on `loop'. The
+        first step is scheduled with `loop.call_soon()'.
+        """
+        Future.__init__(self)
+        self._loop = loop
+        self._coro = coro
+        loop.call_soon(self._step, None, None)
+
+    def _step(self, value, exc_info):
+        try:
+            if exc_info is not None:
+                f = self._coro.throw(*exc_info)
+            else:
+                f = self._coro.send(value)
+        except StopIteration:
+            self.set_result(None)
+        except Return as r:
+            self.set_result(r.value)
+        except Exception as e:
+            self.set_exception(e)
+        else:
+            if f is None:
+                self._loop.call_soon(self._step, None, None)
+            else:
+                f.add_done_callback(self._wakeup)
+
+    def _wakeup(self, f):
+        e = f.exception()
+        if e is not None:
+            self._loop.call_soon(self._step, None, (type(e), e, None))
+        else:
+            self._loop.call_soon(self._step, f.result(), None)
+
+#=============================================================================
+
+class EventLoop(object):
+    """Multiplexes the sockets of several `kaeirc.Client' instances.
+
+    Clients are added with `add_client()' after they are connected. From that
+    point on, the loop calls the client's `poll()' method whenever there's data
+    to be read from the socket, or when the client has queued data to be sent
+    (or flood control allows sending more), so the application does not need
+    to call it.
+
+    The loop itself is run by calling `run()', usually from a dedicated thread.
+    The methods `add_client()', `remove_client()', `call_soon()',
+    `call_later()', `notify()', and `stop()' may be safely called from other
+    threads. The rest of the methods must only be called from the loop thread.
+    """
+
+    @property
+    def clients(self):
+        """List of clients currently handled by this loop."""
+        return self._fds.keys()
+
+    @property
+    def running(self):
+        """Boolean telling whether the loop is running."""
+        return self._running
+
+    def __init__(self):
+        """Create a new `EventLoop' with no clients."""
+        self._poller = _make_poller()
+        self._clients = { }
+        self._fds = { }
+        self._masks = { }
+        self._watchers = { }
+        self._send_timers = { }
+        self._timers = [ ]
+        self._pending = [ ]
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread_id = None
+        self._wake_r, self._wake_w = os.pipe()
+        _set_nonblocking(self._wake_r)
+        _set_nonblocking(self._wake_w)
+        self._poller.register(self._wake_r, READ)
+
+    def add_client(self, client):
+        """Start handling a connected `kaeirc.Client'."""
+        self.call_soon(self._add_client, client)
+
+    def remove_client(self, client):
+        """Stop handling a `kaeirc.Client'. The client is not disconnected."""
+        self.call_soon(self._remove_client, client)
+
+    def call_soon(self, callback, *args):
+        """Arrange for `callback' to be called with `args' in the loop thread
+        as soon as possible.
+        """
+        with self._lock:
+            self._pending.append((callback, args))
+        self.wakeup()
+
+    def call_later(self, delay, callback, *args):
+        """Arrange for `callback' to be called with `args' in the loop thread
+        after `delay' seconds (fractions allowed).
+
+        Returns a `Timer' instance, which may be used to cancel the call.
+        """
+        timer = Timer(kaeirc.util.monotonic() + delay, callback, args)
+        with self._lock:
+            heapq.heappush(self._timers, timer)
+        self.wakeup()
+        return timer
+
+    def sleep(self, delay, result=None):
+        """Return a `Future' which completes with `result' after `delay'
+        seconds. Useful in coroutines (see `Task').
+        """
+        f = Future()
+        self.call_later(delay, f.set_result, result)
+        return f
+
+    def watch(self, fd, mask, callback):
+        """Call `callback' with the ready events (a combination of `READ'
+        and `WRITE') whenever the file descriptor `fd' is ready for any of
+        the events in `mask'.
+
+        This is used for file descriptors which are not a client's socket, for
+        example a socket which is still connecting.
+        """
+        if fd in self._watchers:
+            self._poller.modify(fd, mask)
+        else:
+            self._poller.register(fd, mask)
+        self._watchers[fd] = callback
+
+    def unwatch(self, fd):
+        """Stop watching a file descriptor registered with `watch()'."""
+        if self._watchers.pop(fd, None) is not None:
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError, KeyError):
+                pass
+
+    def notify(self, client):
+        """Tell the loop that `client' has data to send, or that it was
+        disconnected. Called by the client itself.
+        """
+        with self._lock:
+            self._dirty.add(client)
+        self.wakeup()
+
+    def wakeup(self):
+        """Wake up the loop if it's waiting for events."""
+        if self._thread_id == thread.get_ident():
+            # Called from the loop itself; it's obviously not waiting.
+            return
+        try:
+            os.write(self._wake_w, "\0")
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def stop(self):
+        """Make `run()' return after the current iteration."""
+        self._running = False
+        self.wakeup()
+
+    def run(self):
+        """Run the loop until `stop()' is called."""
+        self._running = True
+        self._thread_id = thread.get_ident()
+        try:
+            while self._running:
+                self.run_once()
+        finally:
+            self._thread_id = None
+
+    def run_once(self, timeout=None):
+        """Wait for events once, and dispatch them.
+
+        `timeout' is the maximum time in seconds (fractions allowed) to wait
+        for events. If None (the default), waits until the next timer expires,
+        or forever if there are no timers.
+        """
+        with self._lock:
+            if self._pending or self._dirty:
+                timeout = 0
+            elif self._timers:
+                t = max(0, self._timers[0].when - kaeirc.util.monotonic())
+                if (timeout is None) or (t < timeout):
+                    timeout = t
+        for (fd, mask) in self._poller.poll(timeout):
+            if fd == self._wake_r:
+                self._drain_wakeup()
+            elif fd in self._clients:
+                self._poll_client(self._clients[fd])
+            elif fd in self._watchers:
+                self._watchers[fd](mask)
+        with self._lock:
+            pending, self._pending = self._pending, [ ]
+            dirty, self._dirty = self._dirty, set()
+            now = kaeirc.util.monotonic()
+            due = [ ]
+            while self._timers and (self._timers[0].when <= now):
+                due.append(heapq.heappop(self._timers))
+        for (callback, args) in pending:
+            callback(*args)
+        for client in dirty:
+            if client in self._fds:
+                self._poll_client(client)
+        for timer in due:
+            timer.run()
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _add_client(self, client):
+        fd = client.fileno()
+        if (fd is None) or (client in self._fds):
+            return
+        client._loop = self
+        self._clients[fd] = client
+        self._fds[client] = fd
+        self._masks[fd] = READ
+        self._poller.register(fd, READ)
+        self._poll_client(client)
+
+    def _remove_client(self, client):
+        fd = self._fds.pop(client, None)
+        if fd is None:
+            return
+        del self._clients[fd]
+        del self._masks[fd]
+        timer = self._send_timers.pop(client, None)
+        if timer is not None:
+            timer.cancel()
+        try:
+            self._poller.unregister(fd)
+        except (IOError, OSError, KeyError):
+            # Closing the descriptor already removed it from the poller.
+            pass
+
+    def _poll_client(self, client):
+        client.poll()
+        fd = client.fileno()
+        if fd is None:
+            self._remove_client(client)
+            return
+        mask = (READ | WRITE) if client.wants_write else READ
+        if self._masks.get(fd) != mask:
+            self._masks[fd] = mask
+            self._poller.modify(fd, mask)
+        if client not in self._send_timers:
+            delay = client.send_delay
+            if delay is not None:
+                # Flood control is holding lines back; come back when it
+                # allows sending the next one.
+                self._send_timers[client] = self.call_later(delay,
+                  self._send_timer_expired, client)
+
+    def _send_timer_expired(self, client):
+        if self._send_timers.pop(client, None) is not None:
+            self._poll_client(client)
+
+#=============================================================================
@@ -0,0 +1,337 @@
+
+"""
+Message Parser
+
+This module contains the parser used by `kaeirc.Client' to split received
+lines into their components, including IRCv3 message tags.
+
+The parser avoids regular expressions and Python-level loops over the words
+of the line: the trailing parameter is found with a single `find(" :")', and
+the prefix is only split into nickname, username, and host the first time a
+handler looks at it. `Prefix' objects are shared between lines from the same
+source, so a chatty user's prefix is split at most once.
+
+When run as a script, this module measures the parser throughput against a
+recorded corpus (one raw line per line, as sent by the server):
+
+  python -m kaeirc.parser [CORPUS]
+
+If `CORPUS' is not specified, `misc/corpus.irc' is used. The result is
+compared with `THROUGHPUT_TARGET'.
+
+Constants:
+
+THROUGHPUT_TARGET
+  Minimum number of lines per second the parser is expected to handle with
+  the reference corpus on a typical desktop machine.
+
+NO_PREFIX
+  Value used as `Message.who' for lines without a prefix.
+"""
+
+import operator
+
+import kaeirc.aliases
+
+#=============================================================================
+
+THROUGHPUT_TARGET = 200000
+
+NO_PREFIX = (None, None, None, None)
+
+#=============================================================================
+
+_TAG_ESCAPES = {
+    ":": ";",
+    "s": " ",
+    "\\": "\\",
+    "r": "\r",
+    "n": "\n",
+}
+
+_commands = { }
+
+_prefixes = { }
+
+_MAX_CACHE = 4096
+
+_tuple_new = tuple.__new__
+
+#=============================================================================
+
+def split_prefix(prefix):
+    """Split a "nickname!username@host" prefix.
+
+    Returns a 4-tuple, `(nickname, username, host, prefix)'. If `username' or
+    `host' is not present, it's returned as None.
+    """
+    at = prefix.find("@")
+    if at == -1:
+        return (prefix, None, None, prefix)
+    bang = prefix.find("!", 0, at)
+    if bang == -1:
+        return (prefix[:at], None, prefix[at+1:], prefix)
+    return (prefix[:bang], prefix[bang+1:at], prefix[at+1:], prefix)
+
+#=============================================================================
+
+def unescape_tag_value(value):
+    """Unescape a message tag value, as defined by the IRCv3 specification.
+
+    `\\:' becomes `;', `\\s' a space, `\\\\' a backslash, `\\r' and `\\n' CR
+    and LF respectively. A backslash before any other character is dropped,
+    as is a trailing backslash.
+    """
+    if not "\\" in value:
+        return value
+    parts = value.split("\\")
+    r = [ parts[0] ]
+    i = 1
+    n = len(parts)
+    while i < n:
+        part = parts[i]
+        if part:
+            r.append(_TAG_ESCAPES.get(part[0], part[0]))
+            r.append(part[1:])
+            i += 1
+        elif i + 1 < n:
+            # Two consecutive backslashes.
+            r.append("\\")
+            r.append(parts[i + 1])
+            i += 2
+        else:
+            # Trailing backslash.
+            i += 1
+    return "".join(r)
+
+#=============================================================================
+
+def parse_tags(text):
+    """Parse the tags part of a line (without the leading `@').
+
+    Returns a dictionary mapping tag names (including any vendor prefix or
+    leading `+') to their unescaped values. Tags without a value are mapped
+    to an empty string.
+    """
+    tags = { }
+    for item in text.split(";"):
+        if not item:
+            continue
+        eq = item.find("=")
+        if eq == -1:
+            tags[item] = ""
+        else:
+            tags[item[:eq]] = unescape_tag_value(item[eq+1:])
+    return tags
+
+#=============================================================================
+
+def command_name(command):
+    """Return the handler name for a raw command: the alias from
+    `kaeirc.aliases.command_aliases' for numeric replies, or the lower-cased
+    command otherwise.
+    """
+    name = _commands.get(command)
+    if name is None:
+        name = kaeirc.aliases.command_aliases.get(command, command).lower()
+        if len(_commands) < _MAX_CACHE:
+            _commands[command] = name
+    return name
+
+#=============================================================================
+
+def get_prefix(raw):
+    """Return a `Prefix' for the given raw prefix text.
+
+    Instances are cached, so lines from the same source share the same
+    object.
+    """
+    prefix = _prefixes.get(raw)
+    if prefix is None:
+        if len(_prefixes) >= _MAX_CACHE:
+            _prefixes.clear()
+        prefix = Prefix(raw)
+        _prefixes[raw] = prefix
+    return prefix
+
+#=============================================================================
+
+class Prefix(object):
+    """Lazily parsed message prefix.
+
+    Behaves like the 4-tuple returned by `split_prefix()' (it can be indexed,
+    iterated, and compared to tuples), but the prefix is only split when
+    first accessed. Comparing to a string compares the raw prefix, and the
+    hash is that of the raw prefix, so a `Prefix' and it's raw string may be
+    used interchangeably as dictionary keys.
+    """
+
+    __slots__ = ("_raw", "_parts")
+
+    @property
+    def raw(self):
+        """The prefix as received, without the leading colon."""
+        return self._raw
+
+    @property
+    def nickname(self):
+        """Nickname (or server name) part of the prefix."""
+        return self[0]
+
+    @property
+    def username(self):
+        """Username part of the prefix, or None."""
+        return self[1]
+
+    @property
+    def host(self):
+        """Host part of the prefix, or None."""
+        return self[2]
+
+    def __init__(self, raw):
+        """Create a new `Prefix' for the given raw prefix text."""
+        self._raw = raw
+        self._parts = None
+
+    def __getitem__(self, index):
+        if self._parts is None:
+            self._parts = split_prefix(self._raw)
+        return self._parts[index]
+
+    def __len__(self):
+        return 4
+
+    def __iter__(self):
+        if self._parts is None:
+            self._parts = split_prefix(self._raw)
+        return iter(self._parts)
+
+    def __eq__(self, other):
+        if isinstance(other, (Prefix, tuple)):
+            return tuple(self) == tuple(other)
+        elif isinstance(other, basestring):
+            return self._raw == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        # Python 2 doesn't derive this from `__eq__()'.
+        r = self.__eq__(other)
+        if r is NotImplemented:
+            return r
+        return not r
+
+    def __hash__(self):
+        # Like the raw prefix, which it compares equal to.
+        return hash(self._raw)
+
+    def __repr__(self):
+        return "Prefix(%r)" % self._raw
+
+#=============================================================================
+
+class Message(tuple):
+    """A parsed message.
+
+    This is a 4-tuple, `(who, command, args, tags)', with the items also
+    available as attributes:
+
+    `who' is the prefix (a `Prefix' instance, or `NO_PREFIX'), `command' is
+    the handler name for the command (see `command_name()'), `args' is the
+    list of arguments, and `tags' is a dictionary of IRCv3 message tags
+    (see `parse_tags()'), or None if the line had no tags.
+    """
+
+    __slots__ = ()
+
+    who = property(operator.itemgetter(0))
+    command = property(operator.itemgetter(1))
+    args = property(operator.itemgetter(2))
+    tags = property(operator.itemgetter(3))
+
+    def __new__(cls, who, command, args, tags=None):
+        """Create a new `Message' from it's parts."""
+        return _tuple_new(cls, (who, command, args, tags))
+
+    def __repr__(self):
+        return "Message(%r, %r, %r, %r)" % self
+
+#=============================================================================
+
+def parse(line):
+    """Parse a line (without the CR/LF terminator) into a `Message'.
+
+    `line' should be a unicode string. Byte strings are decoded as UTF-8.
+    """
+    if not isinstance(line, unicode):
+        line = unicode(line, "utf-8", "replace")
+    tags = None
+    if line[:1] == u"@":
+        sp = line.find(u" ")
+        if sp == -1:
+            return _tuple_new(Message,
+              (NO_PREFIX, u"", [ ], parse_tags(line[1:])))
+        tags = parse_tags(line[1:sp])
+        line = line[sp+1:].lstrip(u" ")
+    if line[:1] == u":":
+        sp = line.find(u" ")
+        if sp == -1:
+            return _tuple_new(Message, (get_prefix(line[1:]), u"", [ ], tags))
+        raw = line[1:sp]
+        who = _prefixes.get(raw) or get_prefix(raw)
+        line = line[sp+1:]
+    else:
+        who = NO_PREFIX
+    trailing = line.find(u" :")
+    if trailing != -1:
+        args = line[:trailing].split(u" ")
+        args.append(line[trailing+2:])
+    elif line[:1] == u":":
+        # No command; treat the whole line as trailing parameter.
+        args = [ u"", line[1:] ]
+    else:
+        args = line.split(u" ")
+    if u"" in args:
+        # Several spaces between parameters. Keep the trailing parameter
+        # even if it's empty.
+        last = args.pop() if trailing != -1 else None
+        args = [ a for a in args if a ]
+        if last is not None:
+            args.append(last)
+        if not args:
+            return _tuple_new(Message, (who, u"", [ ], tags))
+    cmd = args.pop(0)
+    return _tuple_new(Message,
+      (who, _commands.get(cmd) or command_name(cmd), args, tags))
+
+#=============================================================================
+
+def _benchmark(filename, passes=5):
+    import time
+    with open(filename, "rb") as f:
+        lines = [ unicode(line, "utf-8", "replace").rstrip("\r\n")
+          for line in f ]
+    lines = [ line for line in lines if line ]
+    best = None
+    for _ in xrange(passes):
+        st = time.time()
+        for line in lines:
+            parse(line)
+        t = time.time() - st
+        if (best is None) or (t < best):
+            best = t
+    return len(lines), len(lines) / best
+
+if __name__ == "__main__":
+    import sys
+    import os
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = os.path.join(os.path.dirname(__file__), "..", "..",
+          "misc", "corpus.irc")
+    count, rate = _benchmark(filename)
+    print "%d lines, %d lines/sec (target: %d lines/sec)" % (count, rate,
+      THROUGHPUT_TARGET)
+    sys.exit(0 if rate >= THROUGHPUT_TARGET else 1)
+
+#=============================================================================
@@ -0,0 +1,130 @@
+
+"""
+Outgoing Text Segmentation
+
+This module contains the functions used by `kaeirc.Client' to split long
+messages into lines which fit in the protocol limit.
+
+The server relays a message to the recipients as
+
+  :nickname!username@host PRIVMSG target :text
+
+and the whole line (including the CR/LF terminator) must fit in 512 bytes (or
+the `LINELEN' announced by the server). Longer lines are truncated by the
+server, possibly in the middle of a multibyte character. To avoid this, the
+text is split in chunks of at most the remaining number of bytes, at spaces
+when possible, and never in the middle of a character.
+"""
+
+import codecs
+
+#=============================================================================
+
+def _is_utf8(encoding):
+    try:
+        return codecs.lookup(encoding).name == "utf-8"
+    except LookupError:
+        return False
+
+#=============================================================================
+
+def split_text(text, maxbytes, encoding="utf-8"):
+    """Split `text' in chunks which take at most `maxbytes' bytes when
+    encoded with `encoding'.
+
+    Chunks are split at the last space which fits (the space itself is
+    dropped), or at the last character boundary if there is no space.
+    Returns a list of unicode strings.
+    """
+    if not isinstance(text, unicode):
+        text = unicode(text, encoding, "replace")
+    maxbytes = max(maxbytes, 1)
+    if len(text) * 4 <= maxbytes:
+        # Fits even if every character takes 4 bytes.
+        return [ text ]
+    if _is_utf8(encoding):
+        return _split_utf8(text.encode("utf-8"), maxbytes)
+    return _split_generic(text, maxbytes, encoding)
+
+def _split_utf8(data, maxbytes):
+    chunks = [ ]
+    start = 0
+    n = len(data)
+    while n - start > maxbytes:
+        end = start + maxbytes
+        sp = data.rfind(" ", start, end + 1)
+        if sp > start:
+            chunks.append(data[start:sp])
+            start = sp + 1
+            continue
+        # Back up to the first byte of the character. Continuation bytes
+        # have the form 10xxxxxx.
+        while (end > start) and ((ord(data[end]) & 0xC0) == 0x80):
+            end -= 1
+        if end == start:
+            # A single character larger than `maxbytes'; send it whole.
+            end += 1
+            while (end < n) and ((ord(data[end]) & 0xC0) == 0x80):
+                end += 1
+        chunks.append(data[start:end])
+        start = end
+    chunks.append(data[start:])
+    return [ chunk.decode("utf-8") for chunk in chunks if chunk ]
+
+def _split_generic(text, maxbytes, encoding):
+    chunks = [ ]
+    start = 0
+    size = 0
+    space = -1
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        width = len(c.encode(encoding, "replace"))
+        if (size + width > maxbytes) and (i > start):
+            if c == u" ":
+                chunks.append(text[start:i])
+                start = i + 1
+                i += 1
+            elif space > start:
+                chunks.append(text[start:space])
+                start = i = space + 1
+            else:
+                chunks.append(text[start:i])
+                start = i
+            size = 0
+            space = -1
+            continue
+        if c == u" ":
+            space = i
+        size += width
+        i += 1
+    chunks.append(text[start:])
+    return [ chunk for chunk in chunks if chunk ]
+
+#=============================================================================
+
+def group_targets(targets, limit, maxbytes, encoding="utf-8"):
+    """Join `targets' with commas in as few groups as possible.
+
+    Each group has at most `limit' targets (or any number, if `limit' is
+    None), and takes at most `maxbytes' bytes when encoded. Returns a list of
+    strings.
+    """
+    groups = [ ]
+    group = [ ]
+    size = 0
+    for target in targets:
+        width = len(target.encode(encoding, "replace"))
+        if group and (((limit is not None) and (len(group) >= limit))
+          or (size + 1 + width > maxbytes)):
+            groups.append(",".join(group))
+            group = [ ]
+            size = 0
+        size += width + (1 if group else 0)
+        group.append(target)
+    if group:
+        groups.append(",".join(group))
+    return groups
+
+#=============================================================================
@@ -0,0 +1,536 @@
+
+"""
+Transports
+
+This module contains the byte stream transports used by `kaeirc.Client' to
+talk to the server.
+
+A transport is an object with the following methods, which behave like the
+methods of the same name of a non-blocking socket:
+
+  recv_into(buffer, nbytes)
+    Read at most `nbytes' bytes into `buffer', and return the number of bytes
+    read, or 0 if the connection was closed by the peer. Raises
+    `socket.error' with `EAGAIN' if there's nothing to read.
+  send(data)
+    Write as much of `data' as possible, and return the number of bytes
+    written. Raises `socket.error' with `EAGAIN' if nothing can be written.
+  fileno()
+    Return a file descriptor which becomes readable when there's data to be
+    read, for use with `kaeirc.loop.EventLoop'.
+  close()
+    Close the transport.
+
+The transports included are `SocketTransport' (for connected TCP and Unix
+stream sockets, or one end of a `socket.socketpair()'), `TLSTransport', and
+`MemoryTransport' (in-memory pipes, see `pipe()'). The `open_tcp()',
+`open_tls()', and `open_unix()' functions connect and return a transport.
+
+Connections to a host name are established with `Connector', which
+implements "Happy Eyeballs" (RFC 8305): all the IPv4 and IPv6 addresses of
+the host are tried, alternating between families, starting a new attempt
+every `CONNECT_DELAY' seconds while the previous ones are still pending, so
+an unreachable address doesn't delay the connection.
+
+Constants:
+
+CONNECT_DELAY
+  Time in seconds to wait for a connection attempt before starting the next
+  one in parallel.
+"""
+
+import os
+import ssl
+import errno
+import select
+import socket
+import threading
+import collections
+
+import kaeirc.loop
+import kaeirc.util
+
+#=============================================================================
+
+CONNECT_DELAY = 0.25
+
+#=============================================================================
+
+def _would_block():
+    return socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+
+#=============================================================================
+
+class Transport(object):
+    """Base class for transports.
+
+    Subclasses must implement `recv_into()', `send()', `fileno()', and
+    `close()'.
+    """
+
+    @property
+    def closed(self):
+        """Boolean telling whether `close()' was called."""
+        return self._closed
+
+    @property
+    def socket(self):
+        """Underlying socket object, or None if there is none."""
+        return None
+
+    def __init__(self):
+        self._closed = False
+
+    def recv(self, bufsize):
+        """Read at most `bufsize' bytes, and return them as a string. An
+        empty string means the connection was closed by the peer.
+        """
+        buf = bytearray(bufsize)
+        n = self.recv_into(memoryview(buf), bufsize)
+        return str(buf[:n])
+
+    def sendall(self, data):
+        """Write all of `data', retrying while the transport can't take more.
+        Only meant for transports whose peer is being read concurrently.
+        """
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[self.send(view):]
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def recv_into(self, buffer, nbytes):
+        raise NotImplementedError
+
+    def send(self, data):
+        raise NotImplementedError
+
+    def fileno(self):
+        raise NotImplementedError
+
+    def close(self):
+        self._closed = True
+
+#=============================================================================
+
+class SocketTransport(Transport):
+    """Transport over a connected stream socket."""
+
+    @property
+    def socket(self):
+        return self._sock
+
+    def __init__(self, sock):
+        """Create a new `SocketTransport' using the connected socket `sock'.
+        The socket is switched to non-blocking mode.
+        """
+        Transport.__init__(self)
+        self._sock = sock
+        sock.setblocking(0)
+
+    def recv_into(self, buffer, nbytes):
+        return self._sock.recv_into(buffer, nbytes)
+
+    def send(self, data):
+        return self._sock.send(data)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        Transport.close(self)
+        self._sock.close()
+
+class TLSTransport(SocketTransport):
+    """Transport over a TLS connection.
+
+    The handshake is done by `handshake()', which `open_tls()' calls until it
+    completes; non-blocking users call it whenever the socket is ready.
+    """
+
+    def __init__(self, sock, hostname=None, verify=True):
+        """Create a new `TLSTransport' wrapping the connected socket `sock'.
+
+        If `verify' is true, the certificate of the server is checked against
+        the system's trusted certificates, and `hostname'.
+        """
+        if verify:
+            context = ssl.create_default_context()
+        else:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        sock = context.wrap_socket(sock, server_hostname=hostname,
+          do_handshake_on_connect=False)
+        SocketTransport.__init__(self, sock)
+
+    def handshake(self):
+        """Continue the TLS handshake.
+
+        Returns 0 if the handshake is complete, or `kaeirc.loop.READ' or
+        `kaeirc.loop.WRITE' if the socket must become readable or writable
+        before calling this again. Raises `ssl.SSLError' if it fails.
+        """
+        try:
+            self._sock.do_handshake()
+        except ssl.SSLWantReadError:
+            return kaeirc.loop.READ
+        except ssl.SSLWantWriteError:
+            return kaeirc.loop.WRITE
+        return 0
+
+    def recv_into(self, buffer, nbytes):
+        # Decrypted data buffered by the TLS layer doesn't make the socket
+        # readable; read it all now, so it's not left behind.
+        sock = self._sock
+        total = 0
+        try:
+            while total < nbytes:
+                n = sock.recv_into(buffer[total:], nbytes - total)
+                if n == 0:
+                    break
+                total += n
+                if not sock.pending():
+                    break
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            if total == 0:
+                raise _would_block()
+        return total
+
+    def send(self, data):
+        try:
+            return self._sock.send(data)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            raise _would_block()
+
+#=============================================================================
+
+class MemoryTransport(Transport):
+    """One end of an in-memory pipe. Create them with `pipe()'.
+
+    Data sent on one end is read from the other end, without involving the
+    kernel. A file descriptor (needed to use the transport with
+    `kaeirc.loop.EventLoop') is only created if `fileno()' is called; it only
+    reports readability, so pipes used with a loop should have no `limit'.
+
+    Both ends may be used from different threads.
+    """
+
+    def __init__(self, limit=None):
+        """Create a new unconnected `MemoryTransport'. See `pipe()'."""
+        Transport.__init__(self)
+        self._peer = None
+        self._inbox = bytearray()
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._eof = False
+        self._wake = None
+
+    def pending(self):
+        """Return the number of bytes waiting to be read."""
+        return len(self._inbox)
+
+    def recv_into(self, buffer, nbytes):
+        if self._closed:
+            raise socket.error(errno.EBADF, os.strerror(errno.EBADF))
+        with self._lock:
+            inbox = self._inbox
+            if not inbox:
+                if self._eof:
+                    return 0
+                raise _would_block()
+            n = min(nbytes, len(inbox))
+            buffer[:n] = bytes(inbox[:n])
+            del inbox[:n]
+            if (not inbox) and (not self._eof) and (self._wake is not None):
+                self._drain()
+        return n
+
+    def send(self, data):
+        if self._closed:
+            raise socket.error(errno.EBADF, os.strerror(errno.EBADF))
+        peer = self._peer
+        if (peer is None) or peer._closed:
+            raise socket.error(errno.EPIPE, os.strerror(errno.EPIPE))
+        return peer._feed(data)
+
+    def fileno(self):
+        with self._lock:
+            if self._wake is None:
+                self._wake = os.pipe()
+                kaeirc.loop._set_nonblocking(self._wake[0])
+                kaeirc.loop._set_nonblocking(self._wake[1])
+                if self._inbox or self._eof:
+                    os.write(self._wake[1], "\0")
+            return self._wake[0]
+
+    def close(self):
+        if self._closed:
+            return
+        Transport.close(self)
+        with self._lock:
+            self._inbox = bytearray()
+            if self._wake is not None:
+                os.close(self._wake[0])
+                os.close(self._wake[1])
+                self._wake = None
+        if self._peer is not None:
+            self._peer._hangup()
+
+    def _feed(self, data):
+        with self._lock:
+            n = len(data)
+            if self._limit is not None:
+                n = min(n, self._limit - len(self._inbox))
+                if n <= 0:
+                    raise _would_block()
+            was_empty = not self._inbox
+            self._inbox += data[:n]
+            if was_empty and (self._wake is not None):
+                os.write(self._wake[1], "\0")
+        return n
+
+    def _hangup(self):
+        with self._lock:
+            self._eof = True
+            if (self._wake is not None) and not self._inbox:
+                os.write(self._wake[1], "\0")
+
+    def _drain(self):
+        try:
+            while os.read(self._wake[0], 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+def pipe(limit=None):
+    """Create a pair of connected `MemoryTransport' instances.
+
+    If `limit' is not None, each end buffers at most that many bytes; sending
+    more raises `socket.error' with `EAGAIN' until the other end reads some,
+    like a socket with a full buffer.
+    """
+    a, b = MemoryTransport(limit), MemoryTransport(limit)
+    a._peer, b._peer = b, a
+    return (a, b)
+
+#=============================================================================
+
+def resolve(address):
+    """Return the list of `(family, sockaddr)' tuples to try when connecting
+    to `address', in the order given by RFC 8305: alternating between address
+    families, starting with the family of the first address returned by the
+    resolver.
+
+    `address' is a `(host, port)' tuple, or a string with the path of an Unix
+    domain socket. Raises `socket.gaierror' if the name can't be resolved.
+    """
+    if isinstance(address, basestring):
+        return [ (socket.AF_UNIX, address) ]
+    host, port = address
+    families = collections.OrderedDict()
+    for info in socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+      socket.SOCK_STREAM):
+        family, sockaddr = info[0], info[4]
+        addrs = families.setdefault(family, [ ])
+        if not sockaddr in addrs:
+            addrs.append(sockaddr)
+    addrs = [ ]
+    queues = [ collections.deque((family, sockaddr) for sockaddr in l)
+      for (family, l) in families.iteritems() ]
+    while queues:
+        for q in queues:
+            addrs.append(q.popleft())
+        queues = [ q for q in queues if q ]
+    return addrs
+
+class Connector(object):
+    """Races non-blocking connection attempts to the addresses of a host.
+
+    The owner calls `step()' to start attempts, waits until one of the
+    sockets in `attempts' becomes writable (or until `next_time'), and calls
+    `check()' for the writable sockets, until `socket' is set or `failed' is
+    true. `connect_socket()' does this with `select()'; `kaeirc.AsyncClient'
+    does it with the event loop.
+    """
+
+    @property
+    def socket(self):
+        """The connected socket (in non-blocking mode), or None."""
+        return self._socket
+
+    @property
+    def attempts(self):
+        """List of sockets still connecting."""
+        return self._attempts
+
+    @property
+    def next_time(self):
+        """Time (as returned by `kaeirc.util.monotonic()') at which `step()'
+        should be called again, or None if there are no more addresses to
+        try.
+        """
+        if (self._socket is not None) or not self._addrs:
+            return None
+        return self._next
+
+    @property
+    def failed(self):
+        """Boolean telling whether all the attempts failed. The reason is in
+        `error'.
+        """
+        return ((self._socket is None) and (not self._addrs)
+          and (not self._attempts))
+
+    @property
+    def error(self):
+        """Exception raised by the last failed attempt, or None."""
+        return self._error
+
+    def __init__(self, address, delay=CONNECT_DELAY):
+        """Create a new `Connector' for `address' (see `resolve()'). Name
+        resolution is done here, and may raise `socket.gaierror'.
+        """
+        self._addrs = collections.deque(resolve(address))
+        self._delay = delay
+        self._attempts = [ ]
+        self._socket = None
+        self._error = None
+        self._next = 0
+
+    def step(self):
+        """Start a new attempt if there are none pending, or if the last one
+        was started at least `delay' seconds ago. Returns the list of sockets
+        started.
+        """
+        started = [ ]
+        now = kaeirc.util.monotonic()
+        while (self._socket is None) and self._addrs and ((not self._attempts)
+          or (now >= self._next)):
+            family, sockaddr = self._addrs.popleft()
+            try:
+                sock = socket.socket(family, socket.SOCK_STREAM)
+            except socket.error as e:
+                self._error = e
+                continue
+            sock.setblocking(0)
+            err = sock.connect_ex(sockaddr)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+              errno.EAGAIN):
+                sock.close()
+                self._error = socket.error(err, os.strerror(err))
+                continue
+            self._attempts.append(sock)
+            started.append(sock)
+            self._next = now + self._delay
+        return started
+
+    def check(self, sock):
+        """Finish the attempt with `sock', which became writable. Returns
+        whether it succeeded, in which case the other attempts are cancelled.
+        If it failed, the next attempt should be started right away.
+        """
+        self._attempts.remove(sock)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            sock.close()
+            self._error = socket.error(err, os.strerror(err))
+            self._next = 0
+            return False
+        self._socket = sock
+        self.close()
+        return True
+
+    def close(self):
+        """Cancel all the pending attempts."""
+        for sock in self._attempts:
+            sock.close()
+        self._attempts = [ ]
+
+def connect_socket(address, timeout=None, delay=CONNECT_DELAY):
+    """Connect to `address' (see `resolve()') using a `Connector', and
+    return the connected socket, in non-blocking mode. Raises `socket.error'
+    if it fails, or `socket.timeout' if `timeout' seconds pass.
+    """
+    connector = Connector(address, delay)
+    deadline = None
+    if timeout is not None:
+        deadline = kaeirc.util.monotonic() + timeout
+    try:
+        while True:
+            connector.step()
+            if connector.socket is not None:
+                return connector.socket
+            elif connector.failed:
+                raise connector.error
+            now = kaeirc.util.monotonic()
+            wait = None
+            if connector.next_time is not None:
+                wait = max(0, connector.next_time - now)
+            if deadline is not None:
+                if now >= deadline:
+                    raise socket.timeout("timed out")
+                wait = min(wait, deadline - now) if wait is not None \
+                  else (deadline - now)
+            _, ready, _ = select.select([ ], connector.attempts, [ ], wait)
+            for sock in ready:
+                if connector.check(sock):
+                    break
+    finally:
+        connector.close()
+
+def open_tcp(address, timeout=None):
+    """Connect to `address' (a `(host, port)' tuple) over TCP, and return a
+    `SocketTransport'. Raises `socket.error' if it fails.
+    """
+    return SocketTransport(connect_socket(address, timeout))
+
+def open_tls(address, timeout=None, verify=True):
+    """Connect to `address' (a `(host, port)' tuple) over TCP, do the TLS
+    handshake, and return a `TLSTransport'. Raises `socket.error' or
+    `ssl.SSLError' if it fails.
+    """
+    deadline = None
+    if timeout is not None:
+        deadline = kaeirc.util.monotonic() + timeout
+    sock = connect_socket(address, timeout)
+    try:
+        transport = TLSTransport(sock, address[0], verify)
+        while True:
+            wait = transport.handshake()
+            if not wait:
+                break
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - kaeirc.util.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("timed out")
+            fds = [ transport.fileno() ]
+            if wait == kaeirc.loop.READ:
+                select.select(fds, [ ], [ ], remaining)
+            else:
+                select.select([ ], fds, [ ], remaining)
+    except:
+        sock.close()
+        raise
+    return transport
+
+def open_unix(path, timeout=None):
+    """Connect to the Unix domain socket at `path', and return a
+    `SocketTransport'. Raises `socket.error' if it fails.
+    """
+    return SocketTransport(connect_socket(path, timeout))
+
+def open_transport(address, timeout=None, tls=False, verify=True):
+    """Connect to `address' with the appropriate transport: a string is
+    taken as the path of an Unix domain socket, and a `(host, port)' tuple is
+    connected with TCP, or TLS if `tls' is true.
+    """
+    if isinstance(address, basestring):
+        return open_unix(address, timeout)
+    elif tls:
+        return open_tls(address, timeout, verify)
+    return open_tcp(address, timeout)
+
+#=============================================================================
@@ -1,37 +1,218 @@
 
+"""
+Utility Functions and Classes
+
+This module contains helpers used by `kaeirc.Client', which may also be
+useful to applications.
+
+Case insensitivity of nicknames and channel names is defined by the server
+through the `CASEMAPPING' ISUPPORT token. The supported mappings are:
+
+ascii
+  Only the letters `A' to `Z' are folded to `a' to `z'.
+
+rfc1459
+  Like `ascii', but `[', `]', `\\', and `~' are also folded to `{', `}',
+  `|', and `^' respectively. This is the default.
+
+strict-rfc1459
+  Like `rfc1459', but `~' and `^' are different characters.
+
+Folding is done with precomputed translation tables, so it costs a single
+call to `translate()'.
+
+Time intervals (timeouts, flood control, timers) are measured with
+`monotonic()', which is not affected by changes to the system clock.
+
+Constants:
+
+DEFAULT_CASEMAPPING
+  Mapping used until the server says otherwise, and for unknown mappings.
+
+CASEMAPPINGS
+  Tuple with the names of the supported mappings.
+"""
+
+import sys
+import time
+import string
+
+#=============================================================================
+
+def _make_monotonic():
+    try:
+        return time.monotonic
+    except AttributeError:
+        pass
+    if not sys.platform.startswith("linux"):
+        return time.time
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    class timespec(ctypes.Structure):
+        _fields_ = [ ("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long) ]
+    CLOCK_MONOTONIC = 1
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec())) != 0:
+        return time.time
+    def monotonic():
+        ts = timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+# monotonic() returns the value (in fractional seconds) of a clock which never
+# goes backwards. Only the difference between the results of two calls is
+# meaningful. Falls back to `time.time()' on systems without such a clock.
+monotonic = _make_monotonic()
+
+#=============================================================================
+
+DEFAULT_CASEMAPPING = "rfc1459"
+
+#=============================================================================
+
+def _make_tables(upper, lower):
+    utable = [ unichr(i) for i in xrange(128) ]
+    for (u, l) in zip(upper, lower):
+        utable[ord(u)] = unicode(l)
+    return string.maketrans(upper, lower), utable
+
+_tables = {
+    "ascii": _make_tables(string.ascii_uppercase, string.ascii_lowercase),
+    "rfc1459": _make_tables(string.ascii_uppercase + "[]\\~",
+      string.ascii_lowercase + "{}|^"),
+    "strict-rfc1459": _make_tables(string.ascii_uppercase + "[]\\",
+      string.ascii_lowercase + "{}|"),
+}
+
+CASEMAPPINGS = tuple(sorted(_tables))
+
+#=============================================================================
+
+def make_folder(casemapping=DEFAULT_CASEMAPPING):
+    """Return a function which folds a string (either `str' or `unicode')
+    according to the given case mapping. Unknown mappings are treated as
+    `DEFAULT_CASEMAPPING'.
+    """
+    btable, utable = (_tables.get(casemapping)
+      or _tables[DEFAULT_CASEMAPPING])
+    def fold(text):
+        if text.__class__ is unicode:
+            return text.translate(utable)
+        return text.translate(btable)
+    return fold
+
+_default_fold = make_folder()
+
+def casefold(text, casemapping=DEFAULT_CASEMAPPING):
+    """Fold a string according to the given case mapping. Two nicknames (or
+    channel names) are equal if their folded forms are equal.
+    """
+    if casemapping == DEFAULT_CASEMAPPING:
+        return _default_fold(text)
+    return make_folder(casemapping)(text)
+
 def strlower(x):
-    return str(x).lower().replace('{', ']').replace('}', ']')
+    """Deprecated. Same as `casefold(x)'."""
+    return _default_fold(x)
+
+#=============================================================================
 
 class casedict(dict):
     """Case-insensitive dictionary. Keys MUST be strings.
 
-    NOTE: Since this class is mainly used by the `irc' module, case
-    insensitivity is defined as per the IRC protocol; that is, '[' and ']' are
-    the lowercase versions of '{' and '}' respectively.
+    Case insensitivity is defined by the `casemapping' passed to the
+    constructor (see the module documentation). Keys are stored folded, so
+    methods like `keys()' return the folded keys; the `*_folded()' methods
+    accept keys which are already folded, skipping the conversion.
     """
 
-    def __init__(self, src=None):
+    __slots__ = ("_casemapping", "_fold")
+
+    @property
+    def casemapping(self):
+        """Name of the case mapping in use."""
+        return self._casemapping
+
+    def __init__(self, src=None, casemapping=DEFAULT_CASEMAPPING):
         dict.__init__(self)
+        self._casemapping = casemapping
+        self._fold = make_folder(casemapping)
         if src is not None:
             for k in src:
                 self[k] = src[k]
 
+    def fold(self, key):
+        """Return the folded form of `key'."""
+        return self._fold(key)
+
+    def set_casemapping(self, casemapping, key=None):
+        """Change the case mapping, and fold the existing keys again.
+
+        If `key' is specified, it's called with each value, and should
+        return the original (not folded) key for it. Otherwise, the current
+        keys are folded again, which may merge keys that would be different
+        under the new mapping.
+        """
+        self._casemapping = casemapping
+        self._fold = fold = make_folder(casemapping)
+        items = dict.items(self)
+        dict.clear(self)
+        for (k, v) in items:
+            if key is not None:
+                k = key(v)
+            dict.__setitem__(self, fold(k), v)
+
     def __setitem__(self, key, value):
-        dict.__setitem__(self, strlower(key), value)
+        dict.__setitem__(self, self._fold(key), value)
 
     def __getitem__(self, key):
-        return dict.__getitem__(self, strlower(key))
+        return dict.__getitem__(self, self._fold(key))
 
     def __delitem__(self, key):
-        return dict.__delitem__(self, strlower(key))
+        return dict.__delitem__(self, self._fold(key))
 
     def __contains__(self, key):
-        return dict.__contains__(self, strlower(key))
+        return dict.__contains__(self, self._fold(key))
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        return dict.get(self, self._fold(key), default)
+
+    def pop(self, key, *default):
+        return dict.pop(self, self._fold(key), *default)
+
+    def setdefault(self, key, default=None):
+        return dict.setdefault(self, self._fold(key), default)
+
+    def get_folded(self, key, default=None):
+        """Like `get()', but `key' must be already folded."""
+        return dict.get(self, key, default)
+
+    def set_folded(self, key, value):
+        """Like `d[key] = value', but `key' must be already folded."""
+        dict.__setitem__(self, key, value)
+
+    def pop_folded(self, key, *default):
+        """Like `pop()', but `key' must be already folded."""
+        return dict.pop(self, key, *default)
 
 if __name__ == "__main__":
     d = casedict()
     d["hello"] = "Hi!"
     assert d["hello"] == d["hElLo"]
+    d[u"Nick[away]"] = "away"
+    assert d[u"nick{AWAY}"] == "away"
+    assert d.get_folded(u"nick{away}") == "away"
+    d2 = casedict()
+    d2[u"A[b]"] = u"A[b]"
+    d2.set_casemapping("ascii", key=lambda v: v)
+    assert (u"a[B]" in d2) and not (u"a{b}" in d2)
     print d["HELLO"]
     print d
     del d["HeLLo"]
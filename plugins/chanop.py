@@ -9,9 +9,9 @@ def _kick(frame, cmd, args, args_eol):
     Kick users from the channel.
     """
     if len(args) < 1:
-        usage(frame, cmd, "Missing parameter.")
+        kaechatlib.usage(frame, cmd, "Missing parameter.")
         return
-    if args[0][0] in kaeirc.CHANNEL_PREFIXES:
+    if frame.client.is_channel(args[0]):
         channel = args[0]
         args = args[1:]
         if len(args) < 1:
@@ -29,17 +29,16 @@ def _set_user_mode(frame, cmd, args, args_eol, mode):
     if len(args) < 1:
         kaechatlib.usage(frame, cmd, "Missing parameter.")
         return
-    if args[0][0] in kaeirc.CHANNEL_PREFIXES:
+    if frame.client.is_channel(args[0]):
         channel = args[0]
         nicks = args[1:]
         if len(nicks) < 1:
-            usage(frame, cmd, "Missing parameter.")
+            kaechatlib.usage(frame, cmd, "Missing parameter.")
             return
     else:
         channel = frame.cur_channel
         nicks = args
-    for nick in nicks:
-        frame.client.mode(channel, mode, nick)
+    frame.client.modes(channel, [ (mode, nick) for nick in nicks ])
 
 @kaechatlib.chat_command
 def _op(frame, cmd, args, args_eol):
@@ -77,7 +76,7 @@ def _set_ban(frame, cmd, args, args_eol, do_set):
     if len(args) < 1:
         kaechatlib.usage(frame, cmd, "Missing parameter.")
         return False
-    if args[0][0] in kaeirc.CHANNEL_PREFIXES:
+    if frame.client.is_channel(args[0]):
         if len(args) < 2:
             kaechatlib.usage(frame, cmd, "Missing parameter.")
             return False
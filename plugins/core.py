@@ -1,8 +1,7 @@
 
-import time
-
 import kaechatlib
 import kaeirc
+import kaeirc.util
 
 @kaechatlib.chat_command
 def _say(frame, cmd, args, args_eol):
@@ -124,8 +123,10 @@ class PingHandler:
 
     def on_notice(self, who, channel, text):
         if text.startswith("\1PING ") and (who[0] in self.sent):
-            t = time.clock() - self.sent[who[0]]
-            self.frame.echo("Message to %s took %f seconds." % (who[0], t))
+            t = kaeirc.util.monotonic() - self.sent[who[0]]
+            # Called in the client thread; see `kaechatlib.ui.updates'.
+            self.frame.updates.echo(self.frame,
+              "Message to %s took %f seconds." % (who[0], t))
             del self.sent[who[0]]
 
 ping_handler = None
@@ -139,14 +140,14 @@ def _ping(frame, cmd, args, args_eol):
     if len(args) < 1:
         kaechatlib.usage(frame, cmd, "Missing parameter.")
         return
-    elif args[0][0] in kaeirc.CHANNEL_PREFIXES:
+    elif frame.client.is_channel(args[0]):
         kaechatlib.usage(frame, cmd, "/ping cannot be used on channels.")
         return
     global ping_handler
     if ping_handler is None:
         ping_handler = PingHandler(frame)
         frame.client.add_listener(ping_handler)
-    ping_handler.sent[args[0]] = time.clock()
+    ping_handler.sent[args[0]] = kaeirc.util.monotonic()
     # TODO: Use some other number.
     frame.client.privmsg(args[0], "\1PING 12345678\1")
 
@@ -180,6 +181,16 @@ def _recv(frame, cmd, args, args_eol):
         return
     frame.client.on_received(unicode(args_eol[0]))
 
+@kaechatlib.chat_command
+def _sendq(frame, cmd, args, args_eol):
+    """/sendq
+
+    Show how many lines are waiting to be sent, and how long it will take
+    to send them.
+    """
+    frame.echo("%d lines queued, about %.1f seconds to send."
+      % (frame.client.send_queue_depth, frame.client.send_queue_eta))
+
 @kaechatlib.chat_command
 def _server(frame, cmd, args, args_eol):
     """/server NET_ID
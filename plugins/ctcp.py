@@ -22,7 +22,7 @@ def _ctcp(frame, cmd, args, args_eol):
     if len(args) < 2:
         kaechatlib.usage(frame, cmd, "Missing parameter.")
         return
-    elif args[0][0] in kaeirc.CHANNEL_PREFIXES:
+    elif frame.client.is_channel(args[0]):
         kaechatlib.usage(frame, cmd, "/CTCP may not be used on channels.")
         return
     frame.client.privmsg(args[0], "\1%s\1" % args_eol[1])
@@ -36,7 +36,7 @@ def _nctcp(frame, cmd, args, args_eol):
     if len(args) < 2:
         kaechatlib.usage(frame, cmd, "Missing parameter.")
         return
-    elif args[0][0] in kaeirc.CHANNEL_PREFIXES:
+    elif frame.client.is_channel(args[0]):
         kaechatlib.usage(frame, cmd, "/NCTCP may not be used on channels.")
         return
     frame.client.notice(args[0], "\1%s\1" % args_eol[1])
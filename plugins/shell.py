@@ -1,9 +1,9 @@
 
 import os
-import time
 import threading
 
 import kaechatlib
+import kaeirc.util
 
 class ShellThread(threading.Thread):
 
@@ -20,29 +20,29 @@ class ShellThread(threading.Thread):
             self.echo = self._echo
 
     def _echo(self, text):
-        self.frame.echo(text, channel=self.channel, event=kaechatlib.NOTICE_EV)
+        # The frame must only be used from the Tk thread; see
+        # `kaechatlib.ui.updates'.
+        self.frame.updates.echo(self.frame, text, channel=self.channel,
+            event=kaechatlib.NOTICE_EV)
 
     def _send(self, text):
         self.frame.client.notice(self.channel, text)
-        self.frame.echo(text, channel=self.channel, event=kaechatlib.NOTICE_EV)
+        self._echo(text)
 
     def run(self):
-        st = time.clock()
+        st = kaeirc.util.monotonic()
         try:
             f = os.popen(self.command, "r")
             for line in f:
-                t = time.clock() - st
+                t = kaeirc.util.monotonic() - st
                 if t >= self.timeout:
-                    self.frame.echo("Program stopped due to timeout.",
-                        channel=self.channel, event=kaechatlib.NOTICE_EV)
+                    self._echo("Program stopped due to timeout.")
                     break
                 self.echo(line)
             r = f.close()
-            self.frame.echo("Program exited with code %d" % (r or 0),
-                channel=self.channel, event=kaechatlib.NOTICE_EV)
+            self._echo("Program exited with code %d" % (r or 0))
         except (OSError, IOError) as e:
-            self.frame.echo("Exception: %s" % str(e),
-                channel=self.channel, event=kaechatlib.NOTICE_EV)
+            self._echo("Exception: %s" % str(e))
 
 @kaechatlib.chat_command
 def _sh(frame, cmd, args, args_eol):
@@ -0,0 +1,203 @@
+#! /usr/bin/env python2.7
+
+# test_client.py: Tests for `kaeirc.Client', talking to a fake server over an
+# in-memory pipe (see `kaeirc.transport.pipe()').
+
+# Run with `python2.7 -m unittest discover tests' from the top directory.
+
+import os
+import sys
+import time
+import select
+import socket
+import unittest
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__) or ".", "..", "lib"))
+
+import kaeirc
+import kaeirc.transport
+
+def connect(lines=()):
+    # Returns a client registered as `me', and the server end of the pipe.
+    # `lines' are sent by the server after the welcome.
+    client_end, server_end = kaeirc.transport.pipe()
+    server_end.send(b":srv 001 me :Welcome\r\n")
+    for line in lines:
+        server_end.send(line + b"\r\n")
+    client = kaeirc.Client("me", ("localhost", 6667))
+    client.connect(timeout=2, transport=client_end)
+    client.poll()
+    return client, server_end
+
+def refuse_nicks(end, count):
+    # Fake server: replies `ERR_NICKNAMEINUSE' to the first `count' nicknames
+    # tried, and welcomes the next one.
+    buf = b""
+    while True:
+        select.select([ end.fileno() ], [ ], [ ], 5)
+        try:
+            data = end.recv(4096)
+        except socket.error:
+            continue
+        if not data:
+            return
+        buf += data
+        while b"\r\n" in buf:
+            line, buf = buf.split(b"\r\n", 1)
+            if line.startswith(b"NICK "):
+                nick = line[5:]
+                if count > 0:
+                    count -= 1
+                    end.send(b":srv 433 * %s :Nickname is already in use\r\n"
+                      % nick)
+                else:
+                    end.send(b":srv 001 %s :Welcome\r\n" % nick)
+                    return
+
+class RetryListener(object):
+    # Retries nicknames in use like `ClientThread' does, but with the line
+    # held back by flood control.
+
+    def __init__(self, client):
+        self.client = client
+
+    def before_err_nicknameinuse(self, who, me, nickname, message):
+        self.client.send("NICK %s_" % nickname, kaeirc.PRIORITY_INTERACTIVE)
+        return True
+
+class RegistrationTestCase(unittest.TestCase):
+
+    def register(self, refusals, listener=None):
+        client_end, server_end = kaeirc.transport.pipe()
+        server = threading.Thread(target=refuse_nicks,
+          args=(server_end, refusals))
+        server.daemon = True
+        server.start()
+        client = kaeirc.Client("nick", ("localhost", 6667))
+        if listener is not None:
+            client.add_listener(listener(client))
+        st = time.time()
+        client.connect(timeout=5, transport=client_end)
+        server.join(5)
+        return client, time.time() - st
+
+    def test_nickname_in_use(self):
+        client, elapsed = self.register(3)
+        self.assertTrue(client.authed)
+        self.assertEqual(client.nickname, "nic3")
+        self.assertLess(elapsed, 1)
+
+    def test_nickname_retry_held_back(self):
+        # Retries queued by a listener with flood control only wait for
+        # their tokens, not for the timeout.
+        client, elapsed = self.register(8, RetryListener)
+        self.assertTrue(client.authed)
+        self.assertEqual(client.nickname, "nick" + "_" * 8)
+        self.assertLess(elapsed, 4)
+
+def sent_lines(end):
+    # Returns the lines sent by the client so far, except the registration.
+    if not end.pending():
+        return [ ]
+    lines = end.recv(end.pending()).split(b"\r\n")[:-1]
+    return [ line for line in lines
+      if line.split(b" ", 1)[0] not in (b"CAP", b"NICK", b"USER") ]
+
+class BatchListener(object):
+
+    def __init__(self):
+        self.batches = [ ]
+
+    def on_join_batch(self, who, names):
+        self.batches.append(names)
+
+class JoinTestCase(unittest.TestCase):
+
+    def join(self, channels, isupport=None):
+        lines = [ ]
+        if isupport is not None:
+            lines.append(b":srv 005 me %s :are supported" % isupport)
+        client, server = connect(lines)
+        client.set_flood_control(rate=None)
+        listener = BatchListener()
+        client.add_listener(listener)
+        client.join_channels(channels)
+        client.poll()
+        return client, server, listener
+
+    def reply(self, client, server, line):
+        server.send(line + b"\r\n")
+        client.poll()
+        return sent_lines(server)
+
+    def test_batch_without_targmax(self):
+        # Servers not listing `JOIN' in `TARGMAX' take several channels.
+        client, server, _ = self.join([ "#a", "#b", "#c" ])
+        self.assertEqual(sent_lines(server), [ b"JOIN #a,#b,#c" ])
+        client, server, _ = self.join([ "#a", "#b", "#c" ],
+          b"TARGMAX=PRIVMSG:4")
+        self.assertEqual(sent_lines(server), [ b"JOIN #a,#b,#c" ])
+
+    def test_errors_finish_batch(self):
+        client, server, listener = self.join([ "#a", "#b", "#c", "#d" ],
+          b"TARGMAX=JOIN:1")
+        self.assertEqual(sent_lines(server), [ b"JOIN #a" ])
+        self.assertEqual(self.reply(client, server,
+          b":srv 477 me #a :Cannot join channel (+r)"), [ b"JOIN #b" ])
+        # Numerics without a handler (or an alias) count too.
+        self.assertEqual(self.reply(client, server,
+          b":srv 489 me #b :Cannot join channel (+z)"), [ b"JOIN #c" ])
+        self.assertEqual(self.reply(client, server,
+          b":srv 470 me #c ##c :Forwarding to another channel"),
+          [ b"JOIN #d" ])
+        self.assertEqual(self.reply(client, server,
+          b":srv 479 me #d :Illegal channel name"), [ ])
+        self.assertEqual(listener.batches, [ [ "#a" ], [ "#b" ], [ "#c" ],
+          [ "#d" ] ])
+        self.assertFalse(client.is_joining("#d"))
+
+    def test_timeout(self):
+        timeout = kaeirc._JOIN_BATCH_TIMEOUT
+        kaeirc._JOIN_BATCH_TIMEOUT = 0.1
+        try:
+            client, server, listener = self.join([ "#a", "#b" ],
+              b"TARGMAX=JOIN:1")
+        finally:
+            kaeirc._JOIN_BATCH_TIMEOUT = timeout
+        self.assertEqual(sent_lines(server), [ b"JOIN #a" ])
+        client.poll()
+        self.assertEqual(sent_lines(server), [ ])
+        time.sleep(0.2)
+        client.poll()
+        self.assertEqual(sent_lines(server), [ b"JOIN #b" ])
+        self.assertEqual(listener.batches, [ [ "#a" ] ])
+
+class NamesTestCase(unittest.TestCase):
+
+    def test_events_during_names(self):
+        # Changes between the first `RPL_NAMREPLY' and `RPL_ENDOFNAMES' must
+        # not be lost when the staged names are committed.
+        client, server = connect([
+            b":me!u@h JOIN #c",
+            b":srv 353 me = #c :me @alice bob eve",
+            b":carol!c@h JOIN #c",
+            b":bob!b@h PART #c",
+            b":op!o@h KICK #c eve",
+            b":alice!a@h NICK alicia",
+            b":op!o@h MODE #c +v alicia",
+            b":srv 353 me = #c :dave",
+            b":srv 366 me #c :End of /NAMES list.",
+        ])
+        chan = client.channels["#c"]
+        self.assertEqual(sorted(ni.nickname for ni in chan.nicknames.values()),
+          [ "alicia", "carol", "dave", "me" ])
+        alicia = chan.nicknames["alicia"]
+        self.assertTrue(alicia.status & kaeirc.mode_bit("o"))
+        self.assertTrue(alicia.status & kaeirc.mode_bit("v"))
+        self.assertIsNone(client.users.get("bob"))
+        self.assertIsNone(client.users.get("alice"))
+        self.assertIs(client.users["carol"].channels[0], chan)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+#! /usr/bin/env python2.7
+
+# test_flood.py: Tests for `kaeirc.flood.SendQueue'.
+
+# Run with `python2.7 -m unittest discover tests' from the top directory.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__) or ".", "..", "lib"))
+
+import kaeirc.flood
+from kaeirc.flood import PRIORITY_IMMEDIATE, PRIORITY_INTERACTIVE, \
+  PRIORITY_BULK, BULK_SHARE
+
+class SendQueueTestCase(unittest.TestCase):
+
+    def test_priorities(self):
+        q = kaeirc.flood.SendQueue(burst=3, rate=1)
+        q.put("b1", PRIORITY_BULK)
+        q.put("i1", PRIORITY_INTERACTIVE)
+        q.put("p1", PRIORITY_IMMEDIATE)
+        q.put("i2", PRIORITY_INTERACTIVE)
+        self.assertEqual(q.pop_ready(), [ "p1", "i1", "i2" ])
+        self.assertEqual(q.depth(PRIORITY_BULK), 1)
+        self.assertGreater(q.delay(), 0)
+
+    def test_bulk_share(self):
+        # Interactive lines keep coming, but bulk lines still get their share.
+        q = kaeirc.flood.SendQueue(burst=2, rate=1)
+        for i in xrange(3):
+            q.put("b%d" % i, PRIORITY_BULK)
+        sent = [ ]
+        for i in xrange(4 * BULK_SHARE):
+            q.put("i%d" % i, PRIORITY_INTERACTIVE)
+            # One token per round, as if the time for a line passed.
+            q._tokens = 1.0
+            sent.extend(q.pop_ready())
+        bulk = [ i for (i, line) in enumerate(sent) if line[0] == "b" ]
+        self.assertEqual(bulk, [ BULK_SHARE - 1, 2 * BULK_SHARE - 1,
+          3 * BULK_SHARE - 1 ])
+
+    def test_immediate_ignores_tokens(self):
+        q = kaeirc.flood.SendQueue(burst=1, rate=0.5)
+        for i in xrange(3):
+            q.put("p%d" % i, PRIORITY_IMMEDIATE)
+        q.put("i", PRIORITY_INTERACTIVE)
+        self.assertEqual(q.pop_ready(), [ "p0", "p1", "p2" ])
+        self.assertFalse(q.ready())
+        self.assertEqual(len(q), 1)
+
+if __name__ == "__main__":
+    unittest.main()
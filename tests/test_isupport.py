@@ -0,0 +1,117 @@
+#! /usr/bin/env python2.7
+
+# test_isupport.py: Tests for `kaeirc.isupport.ISupport'.
+
+# Run with `python2.7 -m unittest discover tests' from the top directory.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__) or ".", "..", "lib"))
+
+from kaeirc.isupport import ISupport
+
+def isupport(*params):
+    i = ISupport()
+    i.update(params)
+    return i
+
+class ModesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.i = isupport("CHANMODES=beI,k,lf,imnpst", "PREFIX=(qaohv)~&@%+")
+
+    def test_mode_types(self):
+        i = self.i
+        self.assertEqual([ i.mode_type(c) for c in "bkflmoqX" ],
+          [ "A", "B", "C", "C", "D", "prefix", "prefix", None ])
+
+    def test_type_a(self):
+        # Arguments when setting or unsetting; none queries the list.
+        self.assertEqual(self.i.parse_modes("+b-I+e", [ "*!*@a", "*!*@b" ]),
+          [ ("+b", "*!*@a"), ("-I", "*!*@b"), ("+e", None) ])
+
+    def test_type_b(self):
+        self.assertEqual(self.i.parse_modes("+k-k", [ "key", "key" ]),
+          [ ("+k", "key"), ("-k", "key") ])
+
+    def test_type_c(self):
+        # Argument only when set.
+        self.assertEqual(self.i.parse_modes("+l-l+f", [ "10", "#x" ]),
+          [ ("+l", "10"), ("-l", None), ("+f", "#x") ])
+
+    def test_type_d(self):
+        self.assertEqual(self.i.parse_modes("+nt-s", [ "extra" ]),
+          [ ("+n", None), ("+t", None), ("-s", None) ])
+
+    def test_prefix_modes(self):
+        self.assertEqual(self.i.parse_modes("+qo-hv+l", [ "a", "b", "c", "d",
+          "5" ]), [ ("+q", "a"), ("+o", "b"), ("-h", "c"), ("-v", "d"),
+          ("+l", "5") ])
+
+    def test_unknown_mode(self):
+        self.assertEqual(self.i.parse_modes("+Xo", [ "nick" ]),
+          [ ("+X", None), ("+o", "nick") ])
+
+class PrefixTestCase(unittest.TestCase):
+
+    def test_default(self):
+        i = ISupport()
+        self.assertEqual((i.prefix_modes, i.prefix_symbols), ("ov", "@+"))
+        self.assertEqual(i.prefix, { "@": "o", "+": "v" })
+
+    def test_custom(self):
+        i = isupport("PREFIX=(qaohv)~&@%+")
+        self.assertEqual((i.prefix_modes, i.prefix_symbols),
+          ("qaohv", "~&@%+"))
+        self.assertEqual(i.prefix["%"], "h")
+
+    def test_empty(self):
+        i = isupport("PREFIX=")
+        self.assertEqual((i.prefix_modes, i.prefix_symbols), ("", ""))
+        self.assertEqual(i.prefix, { })
+
+    def test_mismatched(self):
+        # Extra modes without a symbol are ignored.
+        i = isupport("PREFIX=(ohv)@+")
+        self.assertEqual((i.prefix_modes, i.prefix_symbols), ("oh", "@+"))
+
+    def test_removed(self):
+        i = isupport("PREFIX=(qo)~@")
+        i.update([ "-PREFIX" ])
+        self.assertEqual(i.prefix_modes, "ov")
+
+class TargmaxTestCase(unittest.TestCase):
+
+    def test_limits(self):
+        i = isupport("TARGMAX=PRIVMSG:4,NOTICE:,KICK:1,whois:2")
+        self.assertEqual(i.target_limit("privmsg"), 4)
+        # An empty limit means no limit.
+        self.assertIsNone(i.target_limit("NOTICE"))
+        self.assertEqual(i.target_limit("KICK"), 1)
+        self.assertEqual(i.target_limit("WHOIS"), 2)
+
+    def test_missing(self):
+        # Commands not listed take a single target, except those taking a
+        # list in RFC 1459.
+        for i in (ISupport(), isupport("TARGMAX=PRIVMSG:4"),
+          isupport("TARGMAX=")):
+            self.assertEqual(i.target_limit("WHOIS"), 1)
+            self.assertEqual(i.target_limit("JOIN"), 10)
+            self.assertEqual(i.target_limit("PART"), 10)
+
+    def test_listed_join(self):
+        self.assertIsNone(isupport("TARGMAX=JOIN:").target_limit("JOIN"))
+        self.assertEqual(isupport("TARGMAX=JOIN:3").target_limit("JOIN"), 3)
+
+    def test_maxtargets(self):
+        i = isupport("MAXTARGETS=5")
+        self.assertEqual(i.target_limit("PRIVMSG"), 5)
+        self.assertEqual(i.target_limit("NOTICE"), 5)
+        # `TARGMAX' takes precedence.
+        i.update([ "TARGMAX=PRIVMSG:2" ])
+        self.assertEqual(i.target_limit("PRIVMSG"), 2)
+
+if __name__ == "__main__":
+    unittest.main()
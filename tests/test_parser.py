@@ -0,0 +1,106 @@
+#! /usr/bin/env python2.7
+
+# test_parser.py: Tests for `kaeirc.parser'.
+
+# Run with `python2.7 -m unittest discover tests' from the top directory.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__) or ".", "..", "lib"))
+
+from kaeirc.parser import parse, Prefix, NO_PREFIX
+
+class TagsTestCase(unittest.TestCase):
+
+    def test_escapes(self):
+        m = parse(u"@a=x\\:y\\sz;b=\\\\\\r\\n;c;+d=\\q\\ :n!u@h PRIVMSG #c :hi")
+        self.assertEqual(m.tags, { "a": "x;y z", "b": "\\\r\n", "c": "",
+          "+d": "q" })
+        self.assertEqual(m.command, "privmsg")
+        self.assertEqual(m.args, [ "#c", "hi" ])
+
+    def test_vendor_and_empty(self):
+        m = parse(u"@example.com/foo=bar;;time= :srv PING :x")
+        self.assertEqual(m.tags, { "example.com/foo": "bar", "time": "" })
+
+    def test_no_tags(self):
+        self.assertIsNone(parse(u":srv PING :x").tags)
+
+class ParamsTestCase(unittest.TestCase):
+
+    def test_empty_trailing(self):
+        m = parse(u":n!u@h PRIVMSG #c :")
+        self.assertEqual(m.args, [ "#c", "" ])
+
+    def test_trailing_with_colons(self):
+        m = parse(u":n!u@h PRIVMSG #c ::) a :b")
+        self.assertEqual(m.args, [ "#c", ":) a :b" ])
+
+    def test_extra_spaces(self):
+        m = parse(u":srv  MODE  #c  +o  n :")
+        self.assertEqual(m.command, "mode")
+        self.assertEqual(m.args, [ "#c", "+o", "n", "" ])
+
+    def test_no_trailing(self):
+        m = parse(u"PING srv")
+        self.assertEqual(m.who, NO_PREFIX)
+        self.assertEqual(m.args, [ "srv" ])
+
+    def test_numeric_alias(self):
+        m = parse(u":srv 001 me :Welcome")
+        self.assertEqual(m.command, "rpl_welcome")
+        self.assertEqual(m.args, [ "me", "Welcome" ])
+
+    def test_bytes(self):
+        m = parse(b":n!u@h PRIVMSG #c :\xc3\xa1")
+        self.assertEqual(m.args[1], u"\xe1")
+
+class PrefixTestCase(unittest.TestCase):
+
+    def test_server_name(self):
+        who = parse(u":irc.example.net NOTICE * :hi").who
+        self.assertEqual(tuple(who), ("irc.example.net", None, None,
+          "irc.example.net"))
+        self.assertIsNone(who.username)
+        self.assertIsNone(who.host)
+
+    def test_nick_only(self):
+        who = parse(u":nick QUIT :bye").who
+        self.assertEqual(who.nickname, "nick")
+        self.assertIsNone(who.username)
+        self.assertIsNone(who.host)
+
+    def test_nick_host(self):
+        self.assertEqual(tuple(Prefix(u"nick@host")),
+          ("nick", None, "host", "nick@host"))
+
+    def test_full(self):
+        who = Prefix(u"nick!user@host")
+        self.assertEqual((who.nickname, who.username, who.host),
+          ("nick", "user", "host"))
+
+    def test_equality(self):
+        who = Prefix(u"n!u@h")
+        self.assertEqual(who, Prefix(u"n!u@h"))
+        self.assertEqual(who, ("n", "u", "h", "n!u@h"))
+        self.assertEqual(who, u"n!u@h")
+        self.assertNotEqual(who, u"n!u@x")
+        self.assertFalse(who == None)
+        self.assertTrue(who != None)
+        self.assertFalse(who == 5)
+
+    def test_hash(self):
+        who = Prefix(u"n!u@h")
+        self.assertEqual(hash(who), hash(u"n!u@h"))
+        self.assertIn(u"n!u@h", set([ who ]))
+        self.assertIn(who, { u"n!u@h": 1 })
+
+    def test_shared(self):
+        a = parse(u":n!u@h PRIVMSG #c :a").who
+        b = parse(u":n!u@h PRIVMSG #c :b").who
+        self.assertIs(a, b)
+
+if __name__ == "__main__":
+    unittest.main()
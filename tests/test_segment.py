@@ -0,0 +1,99 @@
+#! /usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+# test_segment.py: Tests for splitting outgoing messages (`kaeirc.segment'
+# and `kaeirc.Client.privmsg()').
+
+# Run with `python2.7 -m unittest discover tests' from the top directory.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__) or ".", "..", "lib"))
+
+import kaeirc
+import kaeirc.transport
+from kaeirc.segment import split_text, group_targets
+
+TEXT = (u"Zwölf Boxkämpfer jagen Viktor quer über den großen Sylter Deich. "
+  u"Съешь же ещё этих мягких французских булок, да выпей чаю. "
+  u"いろはにほへと ちりぬるを わかよたれそ つねならむ 🎉🎉🎉 ") * 20
+
+class SplitTextTestCase(unittest.TestCase):
+
+    def check(self, text, maxbytes, encoding="utf-8"):
+        chunks = split_text(text, maxbytes, encoding)
+        for chunk in chunks:
+            self.assertIs(type(chunk), unicode)
+            self.assertLessEqual(len(chunk.encode(encoding)), maxbytes)
+        # Nothing is lost but the spaces where the text was split.
+        self.assertEqual(u"".join(chunks).replace(u" ", u""),
+          text.replace(u" ", u""))
+        return chunks
+
+    def test_utf8_boundaries(self):
+        for maxbytes in (5, 7, 10, 61, 100, 433):
+            for chunk in self.check(TEXT, maxbytes):
+                # Splitting inside a sequence would have raised when
+                # decoding, or left U+FFFD behind.
+                self.assertNotIn(u"�", chunk)
+
+    def test_no_spaces(self):
+        text = TEXT.replace(u" ", u"")
+        for maxbytes in (4, 9, 50):
+            self.check(text, maxbytes)
+
+    def test_generic_encoding(self):
+        text = u"Zwölf Boxkämpfer jagen Viktor quer über den Deich. " * 10
+        self.check(text, 17, "latin-1")
+
+    def test_short(self):
+        self.assertEqual(split_text(u"hello", 5), [ u"hello" ])
+        self.assertEqual(split_text(u"hello world", 5), [ u"hello",
+          u"world" ])
+
+    def test_wide_character(self):
+        # A character wider than the limit is sent whole, on it's own.
+        self.assertEqual(split_text(u"ab🎉cd", 3), [ u"ab", u"🎉", u"cd" ])
+        self.assertEqual(split_text(u"🎉🎉", 1), [ u"🎉", u"🎉" ])
+        self.assertEqual(split_text(u"ñ", 1, "utf-8"), [ u"ñ" ])
+
+    def test_group_targets(self):
+        targets = [ "#a", "#bb", "#ccc", "#dddd" ]
+        self.assertEqual(group_targets(targets, 2, 100), [ "#a,#bb",
+          "#ccc,#dddd" ])
+        self.assertEqual(group_targets(targets, None, 8), [ "#a,#bb",
+          "#ccc", "#dddd" ])
+
+class PrivmsgTestCase(unittest.TestCase):
+
+    def test_relayed_length(self):
+        # Every line relayed by the server, with our prefix and the command,
+        # fits in `LINELEN'.
+        client_end, server_end = kaeirc.transport.pipe()
+        server_end.send(b":srv 001 me :Welcome me!~user@some.host.example\r\n"
+          b":srv 005 me LINELEN=300 :are supported\r\n")
+        client = kaeirc.Client("me", ("localhost", 6667))
+        client.connect(timeout=2, transport=client_end)
+        client.poll()
+        client.set_flood_control(rate=None)
+        for target in ("#chan", [ "#a", "#b", "nick" ]):
+            client.privmsg(target, TEXT)
+        client.privmsg_ctcp("#chan", u"ACTION " + TEXT)
+        client.poll()
+        data = server_end.recv(1 << 20)
+        lines = data.split(b"\r\n")[:-1]
+        self.assertGreater(len(lines), 3)
+        prefix = b":" + client.own_prefix.encode("utf-8") + b" "
+        sent = [ ]
+        for line in lines:
+            if line.startswith(b"CAP ") or line.startswith(b"NICK ") \
+              or line.startswith(b"USER "):
+                continue
+            self.assertLessEqual(len(prefix + line + b"\r\n"), 300)
+            sent.append(line.decode("utf-8"))
+        self.assertTrue(all(line.startswith(u"PRIVMSG ") for line in sent))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+#! /usr/bin/env python2.7
+
+# test_userlist.py: Tests for `kaechatlib.ui.userlist.UserListModel'.
+
+# Run with `python2.7 -m unittest discover tests' from the top directory.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__) or ".", "..", "lib"))
+
+import kaeirc
+from kaechatlib.ui.userlist import UserListModel
+
+OP = kaeirc.mode_bit("o")
+VOICE = kaeirc.mode_bit("v")
+
+class UserListModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.model = UserListModel()
+        self.model.reset([ ("dave", 0), ("Carol", VOICE), ("bob", OP),
+          ("alice", 0), ("Eve", OP | VOICE) ])
+
+    def check(self, rows):
+        model = self.model
+        self.assertEqual(model.rows(), rows)
+        self.assertEqual(len(model), len(rows))
+        self.assertEqual(model.op_count, sum(1 for row in rows
+          if row.startswith("@")))
+        for (i, row) in enumerate(rows):
+            nickname = row.lstrip("@+")
+            self.assertEqual(model.nickname(i), nickname)
+            self.assertEqual(model.index(nickname.upper()), i)
+
+    def test_reset(self):
+        self.check([ "@bob", "@Eve", "+Carol", "alice", "dave" ])
+
+    def test_add(self):
+        self.assertEqual(self.model.add("Zed", OP), (None, 2))
+        self.assertEqual(self.model.add("carl"), (None, 5))
+        self.check([ "@bob", "@Eve", "@Zed", "+Carol", "alice", "carl",
+          "dave" ])
+        # Adding a member again with the same status changes nothing.
+        self.assertEqual(self.model.add("carl"), (None, None))
+
+    def test_set_status(self):
+        model = self.model
+        self.assertEqual(model.set_status("ALICE", OP), (3, 0))
+        self.check([ "@alice", "@bob", "@Eve", "+Carol", "dave" ])
+        self.assertEqual(model.set_status("eve", VOICE), (2, 3))
+        self.check([ "@alice", "@bob", "+Carol", "+Eve", "dave" ])
+        self.assertEqual(model.set_status("bob", 0), (1, 3))
+        self.check([ "@alice", "+Carol", "+Eve", "bob", "dave" ])
+        # Same rank; the row stays where it is.
+        self.assertEqual(model.set_status("Carol", VOICE), (None, None))
+        self.check([ "@alice", "+Carol", "+Eve", "bob", "dave" ])
+
+    def test_rename(self):
+        model = self.model
+        self.assertEqual(model.rename("dave", "Aaron"), (4, 3))
+        self.check([ "@bob", "@Eve", "+Carol", "Aaron", "alice" ])
+        # The status is kept.
+        self.assertEqual(model.rename("Eve", "adam"), (1, 0))
+        self.check([ "@adam", "@bob", "+Carol", "Aaron", "alice" ])
+
+    def test_rename_case(self):
+        # A change in case only keeps the row, with the new text.
+        self.assertEqual(self.model.rename("bob", "Bob"), (0, 0))
+        self.check([ "@Bob", "@Eve", "+Carol", "alice", "dave" ])
+        self.assertEqual(self.model.rename("ALICE", "Alice"), (3, 3))
+        self.check([ "@Bob", "@Eve", "+Carol", "Alice", "dave" ])
+
+    def test_rename_existing(self):
+        # The new nickname is already in the list (after a reset); the old
+        # row is just removed.
+        self.assertEqual(self.model.rename("dave", "ALICE"), (4, None))
+        self.check([ "@bob", "@Eve", "+Carol", "alice" ])
+
+    def test_missing(self):
+        rows = self.model.rows()
+        self.assertEqual(self.model.remove("mallory"), (None, None))
+        self.assertEqual(self.model.rename("mallory", "trent"), (None, None))
+        self.assertEqual(self.model.set_status("mallory", OP), (None, None))
+        self.assertIsNone(self.model.index("mallory"))
+        self.check(rows)
+
+    def test_remove(self):
+        self.assertEqual(self.model.remove("EVE"), (1, None))
+        self.assertEqual(self.model.remove("alice"), (2, None))
+        self.check([ "@bob", "+Carol", "dave" ])
+
+    def test_find(self):
+        model = self.model
+        self.assertEqual(model.find("e"), 1)
+        self.assertEqual(model.find("CA"), 2)
+        self.assertEqual(model.find("d"), 4)
+        self.assertIsNone(model.find("x"))
+
+    def test_prefix(self):
+        model = UserListModel("qov", "~@+")
+        q = kaeirc.mode_bit("q")
+        model.reset([ ("a", VOICE), ("b", q | OP), ("c", OP) ])
+        self.assertEqual(model.rows(), [ "~b", "@c", "+a" ])
+        self.assertEqual(model.op_count, 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+#! /usr/bin/env python2.7
+
+# test_util.py: Tests for the case mappings and `casedict' in `kaeirc.util'.
+
+# Run with `python2.7 -m unittest discover tests' from the top directory.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__) or ".", "..", "lib"))
+
+from kaeirc.util import make_folder, casefold, casedict
+
+class FoldTestCase(unittest.TestCase):
+
+    def test_rfc1459(self):
+        fold = make_folder("rfc1459")
+        self.assertEqual(fold("Nick[A]\\~"), "nick{a}|^")
+        self.assertEqual(fold("{}|^"), "{}|^")
+        self.assertEqual(casefold("FOO[]"), casefold("foo{}"))
+
+    def test_strict_rfc1459(self):
+        fold = make_folder("strict-rfc1459")
+        self.assertEqual(fold("Nick[A]\\~"), "nick{a}|~")
+        self.assertNotEqual(fold("a~"), fold("a^"))
+
+    def test_ascii(self):
+        fold = make_folder("ascii")
+        self.assertEqual(fold("Nick[A]\\~"), "nick[a]\\~")
+        self.assertNotEqual(fold("[]"), fold("{}"))
+
+    def test_unknown(self):
+        self.assertEqual(make_folder("bogus")("A[~"), "a{^")
+
+    def test_unicode(self):
+        for mapping in ("ascii", "rfc1459", "strict-rfc1459"):
+            fold = make_folder(mapping)
+            r = fold(u"N\xc9[\u0416]")
+            self.assertIs(type(r), unicode)
+            # Only ASCII characters are folded.
+            self.assertEqual(r[:2], u"n\xc9")
+            self.assertEqual(r[3], u"\u0416")
+            self.assertEqual(fold(u"Nick[A]"), fold("Nick[A]"))
+
+class CaseDictTestCase(unittest.TestCase):
+
+    def test_lookup(self):
+        d = casedict()
+        d["Nick[A]"] = 1
+        self.assertEqual(d["NICK{a}"], 1)
+        self.assertIn(u"nick{a}", d)
+        self.assertEqual(d.keys(), [ "nick{a}" ])
+        self.assertEqual(d.get_folded("nick{a}"), 1)
+        self.assertIsNone(d.get_folded("Nick[A]"))
+        self.assertEqual(d.pop("nick[A]"), 1)
+        self.assertEqual(len(d), 0)
+
+    def test_set_casemapping(self):
+        d = casedict(casemapping="ascii")
+        d["A[b]"] = "A[b]"
+        d["a{b}"] = "a{b}"
+        self.assertEqual(len(d), 2)
+        d.set_casemapping("rfc1459", key=lambda v: v)
+        self.assertEqual(d.casemapping, "rfc1459")
+        # Both keys fold to the same under the new mapping.
+        self.assertEqual(d.keys(), [ "a{b}" ])
+        self.assertIn("A[B]", d)
+
+    def test_set_casemapping_original_keys(self):
+        # Going to a mapping with fewer folded characters needs the original
+        # keys, which the folded keys lost.
+        d = casedict()
+        d["X[1]"] = "X[1]"
+        d.set_casemapping("ascii", key=lambda v: v)
+        self.assertEqual(d.keys(), [ "x[1]" ])
+        self.assertNotIn("x{1}", d)
+        d.set_casemapping("strict-rfc1459")
+        self.assertEqual(d.keys(), [ "x{1}" ])
+        self.assertIn("X[1]", d)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+#! /usr/bin/env python2.7
+
+# membench.py: Measure the memory used to track channel members.
+
+# This script fills a `kaeirc.Client' with synthetic channels and `NAMES'
+# replies, and reports the bytes used per membership (an user being in a
+# channel), compared with the layout used by older versions (one plain
+# `NickInfo' with a `__dict__' and a mode string per membership, and a
+# separate copy of the nickname for each channel).
+
+# Sizes are computed by walking the objects reachable from the channel and
+# user tables, counting each object once, so shared strings and records are
+# only counted once.
+
+import os
+import sys
+import random
+
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__) or ".", "..", "lib"))
+
+import kaeirc
+
+class OldNickInfo(object):
+    def __init__(self, nickname, mode=""):
+        self._nickname = nickname
+        self._mode = mode
+
+class OldChannel(object):
+    def __init__(self, name):
+        self._name = name
+        self._nicknames = { }
+
+def old_strlower(x):
+    return str(x).lower().replace('{', ']').replace('}', ']')
+
+def copy(s):
+    # Names parsed from different lines are different objects.
+    return s[:1] + s[1:]
+
+def deep_size(*roots):
+    seen = set()
+    stack = list(roots)
+    total = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        if callable(o):
+            continue
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.iterkeys())
+            stack.extend(o.itervalues())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        else:
+            d = getattr(o, "__dict__", None)
+            if d is not None:
+                stack.append(d)
+            for cls in type(o).__mro__:
+                for name in cls.__dict__.get("__slots__", ()):
+                    if hasattr(o, name):
+                        stack.append(getattr(o, name))
+    return total
+
+def make_channels(opts):
+    rnd = random.Random(opts.seed)
+    nicks = [ u"User%d[%s]" % (i, rnd.choice("abcdef"))
+      for i in xrange(opts.users) ]
+    channels = [ ]
+    for i in xrange(opts.channels):
+        members = rnd.sample(nicks, min(opts.members, len(nicks)))
+        names = [ rnd.choice(("", "", "", "+", "@")) + copy(n)
+          for n in members ]
+        channels.append((u"#channel%d" % i, names))
+    return channels
+
+def measure_old(channels):
+    table = { }
+    for (name, names) in channels:
+        chan = OldChannel(name)
+        table[old_strlower(name)] = chan
+        for n in names:
+            n = copy(n)
+            mode = ""
+            if n[0] == "@":
+                mode, n = "o", n[1:]
+            elif n[0] == "+":
+                mode, n = "v", n[1:]
+            chan._nicknames[old_strlower(n)] = OldNickInfo(n, mode)
+    return deep_size(table)
+
+def measure_new(channels):
+    c = kaeirc.Client("bench", ("localhost", 6667))
+    c._nickname = u"bench"
+    for (name, names) in channels:
+        c.on_received(u":bench!bench@localhost JOIN %s" % name)
+        for i in xrange(0, len(names), 40):
+            c.on_received(u":server 353 bench = %s :%s"
+              % (name, " ".join(names[i:i+40])))
+        c.on_received(u":server 366 bench %s :End of /NAMES list." % name)
+    return deep_size(c.channels, c.users)
+
+def main(argv=sys.argv, stdout=sys.stdout, stderr=sys.stderr):
+    prog, args = argv[0], argv[1:]
+    argp = argparse.ArgumentParser(
+        prog=prog,
+        description="Measure the memory used per channel membership."
+    )
+    argp.add_argument("-c", "--channels", type=int, default=300,
+      help="Number of channels (default: 300).")
+    argp.add_argument("-m", "--members", type=int, default=500,
+      help="Members per channel (default: 500).")
+    argp.add_argument("-u", "--users", type=int, default=20000,
+      help="Number of distinct users (default: 20000).")
+    argp.add_argument("-s", "--seed", type=int, default=0,
+      help="Random seed (default: 0).")
+    try:
+        old_files = (sys.stdout, sys.stderr)
+        sys.stdout, sys.stderr = (stdout, stderr)
+        opts = argp.parse_args(args)
+        sys.stdout, sys.stderr = old_files
+    except SystemExit as e:
+        return e.code
+
+    channels = make_channels(opts)
+    count = sum(len(names) for (_, names) in channels)
+    old = measure_old(channels)
+    new = measure_new(channels)
+    print >>stdout, "%d memberships, %d channels" % (count, len(channels))
+    print >>stdout, "before: %10d bytes, %6.1f bytes/membership" % (old,
+      float(old) / count)
+    print >>stdout, "after:  %10d bytes, %6.1f bytes/membership" % (new,
+      float(new) / count)
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
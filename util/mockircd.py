@@ -0,0 +1,767 @@
+#! /usr/bin/env python2.7
+
+# mockircd.py: Minimal IRC server for load and soak testing.
+
+# This is NOT a real IRC server. It speaks just enough of RFC 2812 (plus
+# ISUPPORT, NAMES, WHO, MODE, and CAP) to drive `kaeirc.Client' end to end
+# over localhost, with simulated users instead of real connections:
+#
+#   - N channels with M simulated users each (`--channels', `--members').
+#   - Simulated users talk in the channels joined by real clients, at a
+#     given total rate (`--rate').
+#   - Netsplits (`--netsplit-every'), where a fraction of the users quit and
+#     join back a bit later.
+#   - Lag (`--lag'), delaying every line sent to the clients.
+#   - Slow readers (`--read-rate'), limiting how fast the server reads from
+#     the clients, so their send buffers fill up.
+#
+# The server also checks that clients respect the flood limits (a token
+# bucket, see `--flood-burst' and `--flood-rate') and the line length limit,
+# and reports violations in the statistics.
+#
+# Events may be scheduled with a script file (`--script'), with one event
+# per line:
+#
+#   <seconds> rate <lines per second>
+#   <seconds> netsplit <fraction of users>
+#   <seconds> lag <seconds>
+#   <seconds> read-rate <bytes per second, or 0 for no limit>
+#   <seconds> say <channel> <text>
+#   <seconds> stop
+#
+# Statistics are written every `--stats-interval' seconds as CSV lines to
+# `--stats' (standard output by default), ready to be graphed.
+#
+# With `--soak SECONDS', the server is run in a child process, and a
+# `kaeirc.Client' is connected to it for the given time; the client's
+# throughput, send queue, state, and memory use are written as CSV lines.
+
+import os
+import sys
+import time
+import errno
+import random
+import select
+import socket
+import resource
+import collections
+import multiprocessing
+
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__) or ".", "..", "lib"))
+
+SERVER = "mock.irc"
+
+CAPS = ("multi-prefix", "userhost-in-names")
+
+ISUPPORT = ("CHANTYPES=# PREFIX=(ov)@+ CHANMODES=beI,k,l,imnpst MODES=4"
+  " CASEMAPPING=ascii NICKLEN=30 TARGMAX=PRIVMSG:4,NOTICE:4,JOIN:,PART:"
+  " NETWORK=MockNet")
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do"
+  " eiusmod tempor incididunt ut labore et dolore magna aliqua enim ad minim"
+  " veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea"
+  " commodo consequat").split()
+
+#=============================================================================
+
+class Channel(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.members = { }      # nickname -> prefix ("", "@", "+", "@+")
+        self.topic = "Welcome to %s" % name
+        self.modes = "+nt"
+
+class Conn(object):
+
+    def __init__(self, server, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.rbuf = ""
+        self.wbuf = bytearray()
+        self.pending = collections.deque()
+        self.nick = None
+        self.user = None
+        self.host = "localhost"
+        self.registered = False
+        self.negotiating = False
+        self.caps = set()
+        self.channels = set()
+        self.tokens = float(server.opts.flood_burst)
+        self.stamp = time.time()
+        self.allowance = 0.0
+        self.closing = False
+
+    @property
+    def prefix(self):
+        return "%s!%s@%s" % (self.nick, self.user, self.host)
+
+class Server(object):
+
+    def __init__(self, opts, stats=None):
+        self.opts = opts
+        self.stats = stats or sys.stdout
+        self.rnd = random.Random(opts.seed)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((opts.host, opts.port))
+        self.listener.listen(16)
+        self.listener.setblocking(0)
+        self.port = self.listener.getsockname()[1]
+        self.conns = { }
+        self.channels = { }
+        self.users = [ "sim%d" % i for i in xrange(opts.users) ]
+        self.split = [ ]
+        for i in xrange(opts.channels):
+            chan = Channel("#chan%d" % i)
+            for nick in self.rnd.sample(self.users,
+              min(opts.members, len(self.users))):
+                chan.members[nick] = self.rnd.choice(("", "", "", "+", "@"))
+            self.channels[chan.name] = chan
+        self.rate = opts.rate
+        self.lag = opts.lag
+        self.read_rate = opts.read_rate
+        self.script = [ ]
+        self.counters = collections.Counter()
+        self.running = False
+
+    # Output.
+
+    def send(self, conn, line):
+        data = line + "\r\n"
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.counters["lines_out"] += 1
+        self.counters["bytes_out"] += len(data)
+        if self.lag > 0:
+            conn.pending.append((time.time() + self.lag, data))
+        else:
+            conn.wbuf.extend(data)
+
+    def numeric(self, conn, num, text):
+        self.send(conn, ":%s %s %s %s" % (SERVER, num, conn.nick or "*",
+          text))
+
+    def mask(self, nick):
+        for c in self.conns.itervalues():
+            if c.nick == nick:
+                return c.prefix
+        return "%s!~%s@%s.sim" % (nick, nick, nick)
+
+    def real_members(self, chan, exclude=None):
+        return [ c for c in self.conns.itervalues()
+          if (c is not exclude) and (c.nick in chan.members) and c.registered ]
+
+    def broadcast(self, chan, line, exclude=None):
+        for c in self.real_members(chan, exclude):
+            self.send(c, line)
+
+    def close(self, conn, reason=None):
+        if reason is not None:
+            self.send(conn, "ERROR :Closing Link: %s (%s)" % (conn.host,
+              reason))
+        conn.closing = True
+        for name in list(conn.channels):
+            chan = self.channels[name]
+            chan.members.pop(conn.nick, None)
+            self.broadcast(chan, ":%s QUIT :%s" % (conn.prefix,
+              reason or "Client Quit"))
+
+    # Input.
+
+    def handle(self, conn, line):
+        self.counters["lines_in"] += 1
+        if len(line) + 2 > 512:
+            self.counters["overlong"] += 1
+        if conn.registered:
+            now = time.time()
+            opts = self.opts
+            conn.tokens = min(float(opts.flood_burst),
+              conn.tokens + (now - conn.stamp) * opts.flood_rate)
+            conn.stamp = now
+            if conn.tokens < 1 - opts.flood_slack:
+                self.counters["flood"] += 1
+                if opts.flood_kill:
+                    self.close(conn, "Excess Flood")
+                    return
+            conn.tokens -= 1
+        trailing = None
+        if " :" in line:
+            line, trailing = line.split(" :", 1)
+        args = line.split()
+        if not args:
+            return
+        if trailing is not None:
+            args.append(trailing)
+        cmd = args.pop(0).upper()
+        fn = getattr(self, "cmd_" + cmd.lower(), None)
+        if fn is None:
+            self.numeric(conn, "421", "%s :Unknown command" % cmd)
+        elif (not conn.registered) and not (cmd in ("CAP", "NICK", "USER",
+          "PASS", "PING", "QUIT")):
+            self.numeric(conn, "451", ":You have not registered")
+        else:
+            fn(conn, args)
+
+    def try_register(self, conn):
+        if conn.registered or conn.negotiating \
+          or not (conn.nick and conn.user):
+            return
+        conn.registered = True
+        conn.stamp = time.time()
+        self.numeric(conn, "001", ":Welcome to MockNet %s" % conn.prefix)
+        self.numeric(conn, "002", ":Your host is %s" % SERVER)
+        self.numeric(conn, "003", ":This server was created just now")
+        self.numeric(conn, "004", "%s mockircd-1 iow beIklimnpstov" % SERVER)
+        self.numeric(conn, "005", "%s :are supported by this server"
+          % ISUPPORT)
+        self.numeric(conn, "375", ":- %s Message of the day -" % SERVER)
+        self.numeric(conn, "372", ":- This is a mock server for testing.")
+        self.numeric(conn, "376", ":End of /MOTD command.")
+
+    def cmd_cap(self, conn, args):
+        sub = args[0].upper() if args else ""
+        if sub == "LS":
+            if not conn.registered:
+                conn.negotiating = True
+            self.send(conn, ":%s CAP * LS :%s" % (SERVER, " ".join(CAPS)))
+        elif sub == "REQ":
+            wanted = (args[1] if len(args) > 1 else "").split()
+            if all(cap in CAPS for cap in wanted):
+                conn.caps.update(wanted)
+                self.send(conn, ":%s CAP * ACK :%s" % (SERVER,
+                  " ".join(wanted)))
+            else:
+                self.send(conn, ":%s CAP * NAK :%s" % (SERVER,
+                  " ".join(wanted)))
+        elif sub == "END":
+            conn.negotiating = False
+            self.try_register(conn)
+
+    def cmd_pass(self, conn, args):
+        pass
+
+    def cmd_nick(self, conn, args):
+        if not args:
+            self.numeric(conn, "431", ":No nickname given")
+            return
+        nick = args[0]
+        taken = ((nick in self.users) or any(c.nick == nick
+          for c in self.conns.itervalues() if c is not conn))
+        if taken:
+            self.numeric(conn, "433", "%s :Nickname is already in use" % nick)
+            return
+        if conn.registered:
+            line = ":%s NICK :%s" % (conn.prefix, nick)
+            self.send(conn, line)
+            for name in conn.channels:
+                chan = self.channels[name]
+                chan.members[nick] = chan.members.pop(conn.nick)
+                self.broadcast(chan, line, conn)
+        conn.nick = nick
+        self.try_register(conn)
+
+    def cmd_user(self, conn, args):
+        if len(args) < 4:
+            self.numeric(conn, "461", "USER :Not enough parameters")
+            return
+        conn.user = "~" + args[0][:10]
+        self.try_register(conn)
+
+    def cmd_ping(self, conn, args):
+        self.send(conn, ":%s PONG %s :%s" % (SERVER, SERVER,
+          args[-1] if args else ""))
+
+    def cmd_pong(self, conn, args):
+        pass
+
+    def cmd_quit(self, conn, args):
+        self.close(conn, "Quit: %s" % (args[0] if args else ""))
+
+    def cmd_join(self, conn, args):
+        if not args:
+            self.numeric(conn, "461", "JOIN :Not enough parameters")
+            return
+        for name in args[0].split(","):
+            if not name.startswith("#"):
+                self.numeric(conn, "403", "%s :No such channel" % name)
+                continue
+            chan = self.channels.get(name)
+            if chan is None:
+                chan = self.channels[name] = Channel(name)
+            if conn.nick in chan.members:
+                continue
+            chan.members[conn.nick] = "@" if not chan.members else ""
+            conn.channels.add(name)
+            self.broadcast(chan, ":%s JOIN %s" % (conn.prefix, name))
+            self.numeric(conn, "332", "%s :%s" % (name, chan.topic))
+            self.names(conn, chan)
+
+    def cmd_part(self, conn, args):
+        if not args:
+            return
+        for name in args[0].split(","):
+            chan = self.channels.get(name)
+            if (chan is None) or not (conn.nick in chan.members):
+                self.numeric(conn, "442", "%s :You're not on that channel"
+                  % name)
+                continue
+            self.broadcast(chan, ":%s PART %s :%s" % (conn.prefix, name,
+              args[1] if len(args) > 1 else ""))
+            del chan.members[conn.nick]
+            conn.channels.discard(name)
+
+    def cmd_privmsg(self, conn, args, cmd="PRIVMSG"):
+        if len(args) < 2:
+            self.numeric(conn, "412", ":No text to send")
+            return
+        for target in args[0].split(","):
+            line = ":%s %s %s :%s" % (conn.prefix, cmd, target, args[1])
+            if len(line) + 2 > 512:
+                self.counters["overlong"] += 1
+            chan = self.channels.get(target)
+            if chan is not None:
+                self.broadcast(chan, line, conn)
+                continue
+            for c in self.conns.itervalues():
+                if c.nick == target:
+                    self.send(c, line)
+                    break
+            else:
+                if not target in self.users:
+                    self.numeric(conn, "401", "%s :No such nick/channel"
+                      % target)
+
+    def cmd_notice(self, conn, args):
+        self.cmd_privmsg(conn, args, "NOTICE")
+
+    def cmd_names(self, conn, args):
+        chan = self.channels.get(args[0]) if args else None
+        if chan is not None:
+            self.names(conn, chan)
+
+    def names(self, conn, chan):
+        multi = "multi-prefix" in conn.caps
+        uhnames = "userhost-in-names" in conn.caps
+        entries = [ ]
+        for (nick, prefix) in chan.members.iteritems():
+            if not multi:
+                prefix = prefix[:1]
+            if uhnames:
+                nick = self.mask(nick)
+            entries.append(prefix + nick)
+        for i in xrange(0, len(entries), 20):
+            self.numeric(conn, "353", "= %s :%s" % (chan.name,
+              " ".join(entries[i:i+20])))
+        self.numeric(conn, "366", "%s :End of /NAMES list." % chan.name)
+
+    def cmd_who(self, conn, args):
+        chan = self.channels.get(args[0]) if args else None
+        if chan is not None:
+            for (nick, prefix) in chan.members.iteritems():
+                user, host = self.mask(nick).split("!", 1)[1].split("@", 1)
+                self.numeric(conn, "352", "%s %s %s %s %s H%s :0 %s"
+                  % (chan.name, user, host, SERVER, nick, prefix[:1], nick))
+        self.numeric(conn, "315", "%s :End of /WHO list."
+          % (args[0] if args else "*"))
+
+    def cmd_mode(self, conn, args):
+        if not args:
+            return
+        chan = self.channels.get(args[0])
+        if chan is None:
+            if args[0] == conn.nick:
+                self.numeric(conn, "221", "+i")
+            return
+        if len(args) == 1:
+            self.numeric(conn, "324", "%s %s" % (chan.name, chan.modes))
+            return
+        sign = "+"
+        params = args[2:]
+        for c in args[1]:
+            if c in "+-":
+                sign = c
+            elif c in "ov" and params:
+                nick = params.pop(0)
+                if nick in chan.members:
+                    sym = "@" if c == "o" else "+"
+                    prefix = chan.members[nick].replace(sym, "")
+                    if sign == "+":
+                        prefix = "".join(s for s in "@+"
+                          if (s in prefix) or (s == sym))
+                    chan.members[nick] = prefix
+        self.broadcast(chan, ":%s MODE %s" % (conn.prefix, " ".join(args)))
+
+    def cmd_topic(self, conn, args):
+        chan = self.channels.get(args[0]) if args else None
+        if chan is None:
+            return
+        if len(args) > 1:
+            chan.topic = args[1]
+            self.broadcast(chan, ":%s TOPIC %s :%s" % (conn.prefix, chan.name,
+              chan.topic))
+        else:
+            self.numeric(conn, "332", "%s :%s" % (chan.name, chan.topic))
+
+    # Simulation.
+
+    def simulate(self, dt):
+        if self.rate <= 0:
+            return
+        busy = [ self.channels[name] for name in set().union(*[ c.channels
+          for c in self.conns.itervalues() ]) if self.channels[name].members ]
+        if not busy:
+            return
+        rnd = self.rnd
+        # Poisson-ish: the expected number of lines in this interval.
+        count = int(self.rate * dt)
+        if rnd.random() < (self.rate * dt - count):
+            count += 1
+        for _ in xrange(count):
+            chan = rnd.choice(busy)
+            sims = [ n for n in chan.members if n in self.users ]
+            if not sims:
+                continue
+            nick = rnd.choice(sims)
+            text = " ".join(rnd.choice(WORDS)
+              for _ in xrange(rnd.randint(2, 20)))
+            self.broadcast(chan, ":%s!~%s@%s.sim PRIVMSG %s :%s" % (nick,
+              nick, nick, chan.name, text))
+
+    def netsplit(self, fraction):
+        rnd = self.rnd
+        victims = rnd.sample(self.users, int(len(self.users) * fraction))
+        split = [ ]
+        for nick in victims:
+            chans = [ chan for chan in self.channels.itervalues()
+              if nick in chan.members ]
+            if not chans:
+                continue
+            told = set()
+            for chan in chans:
+                for c in self.real_members(chan):
+                    if not c in told:
+                        told.add(c)
+                        self.send(c, ":%s!~%s@%s.sim QUIT :*.net *.split"
+                          % (nick, nick, nick))
+            split.append((nick, [ (chan, chan.members.pop(nick))
+              for chan in chans ]))
+        self.split.append((time.time() + self.opts.split_duration, split))
+        self.counters["netsplits"] += 1
+
+    def heal(self, now):
+        while self.split and (self.split[0][0] <= now):
+            _, split = self.split.pop(0)
+            for (nick, chans) in split:
+                for (chan, prefix) in chans:
+                    chan.members[nick] = prefix
+                    self.broadcast(chan, ":%s!~%s@%s.sim JOIN %s" % (nick,
+                      nick, nick, chan.name))
+
+    def run_script(self, start, now):
+        while self.script and (self.script[0][0] <= now - start):
+            _, action, args = self.script.pop(0)
+            if action == "rate":
+                self.rate = float(args[0])
+            elif action == "netsplit":
+                self.netsplit(float(args[0]))
+            elif action == "lag":
+                self.lag = float(args[0])
+            elif action == "read-rate":
+                self.read_rate = float(args[0])
+            elif action == "say":
+                chan = self.channels.get(args[0])
+                if chan is not None:
+                    self.broadcast(chan, ":%s NOTICE %s :%s" % (SERVER,
+                      chan.name, " ".join(args[1:])))
+            elif action == "stop":
+                self.running = False
+
+    def load_script(self, filename):
+        with open(filename) as f:
+            for line in f:
+                words = line.split()
+                if words and not words[0].startswith("#"):
+                    self.script.append((float(words[0]), words[1].lower(),
+                      words[2:]))
+        self.script.sort(key=lambda e: e[0])
+
+    def write_stats(self, start, now, last):
+        c = self.counters
+        dt = max(now - last[0], 1e-6)
+        row = (now - start, len(self.conns), c["lines_in"], c["lines_out"],
+          (c["lines_in"] - last[1]) / dt, (c["lines_out"] - last[2]) / dt,
+          c["flood"], c["overlong"], c["netsplits"],
+          sum(len(x.wbuf) for x in self.conns.itervalues()))
+        print >>self.stats, ("%.1f,%d,%d,%d,%.1f,%.1f,%d,%d,%d,%d" % row)
+        self.stats.flush()
+        return (now, c["lines_in"], c["lines_out"])
+
+    # Main loop.
+
+    def run(self, duration=None):
+        opts = self.opts
+        if opts.script:
+            self.load_script(opts.script)
+        print >>self.stats, ("time,clients,lines_in,lines_out,in_rate,"
+          "out_rate,flood_violations,overlong,netsplits,backlog_bytes")
+        start = last_tick = next_split = time.time()
+        next_split += opts.netsplit_every or 0
+        next_stats = start + opts.stats_interval
+        last = (start, 0, 0)
+        self.running = True
+        while self.running:
+            now = time.time()
+            if (duration is not None) and (now - start >= duration):
+                break
+            self.simulate(now - last_tick)
+            for conn in self.conns.itervalues():
+                conn.allowance = min(conn.allowance
+                  + (now - last_tick) * self.read_rate, 65536)
+                while conn.pending and (conn.pending[0][0] <= now):
+                    conn.wbuf.extend(conn.pending.popleft()[1])
+            last_tick = now
+            if opts.netsplit_every and (now >= next_split):
+                self.netsplit(opts.split_fraction)
+                next_split = now + opts.netsplit_every
+            self.heal(now)
+            self.run_script(start, now)
+            if now >= next_stats:
+                last = self.write_stats(start, now, last)
+                next_stats = now + opts.stats_interval
+            self.poll(0.02)
+        self.listener.close()
+        for conn in self.conns.values():
+            conn.sock.close()
+
+    def poll(self, timeout):
+        rlist = [ self.listener ]
+        wlist = [ ]
+        for conn in self.conns.itervalues():
+            if (self.read_rate <= 0) or (conn.allowance >= 1):
+                rlist.append(conn.sock)
+            if conn.wbuf:
+                wlist.append(conn.sock)
+        r, w, _ = select.select(rlist, wlist, [ ], timeout)
+        for sock in r:
+            if sock is self.listener:
+                try:
+                    s, addr = self.listener.accept()
+                except socket.error:
+                    continue
+                s.setblocking(0)
+                self.conns[s] = Conn(self, s, addr)
+                continue
+            conn = self.conns.get(sock)
+            if conn is not None:
+                self.read(conn)
+        for sock in w:
+            conn = self.conns.get(sock)
+            if conn is not None:
+                self.write(conn)
+        for conn in self.conns.values():
+            if conn.closing and not conn.wbuf:
+                conn.sock.close()
+                del self.conns[conn.sock]
+
+    def read(self, conn):
+        size = 4096
+        if self.read_rate > 0:
+            size = max(1, min(size, int(conn.allowance)))
+        try:
+            data = conn.sock.recv(size)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if self.read_rate > 0:
+            conn.allowance -= len(data)
+        if not data:
+            if not conn.closing:
+                self.close(conn)
+            conn.wbuf = bytearray()
+            return
+        conn.rbuf += data
+        lines = conn.rbuf.split("\n")
+        conn.rbuf = lines.pop()
+        for line in lines:
+            if conn.closing:
+                break
+            line = line.rstrip("\r")
+            if line:
+                self.handle(conn, line)
+
+    def write(self, conn):
+        try:
+            n = conn.sock.send(conn.wbuf)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            conn.wbuf = bytearray()
+            conn.closing = True
+            return
+        del conn.wbuf[:n]
+
+#=============================================================================
+# Soak testing.
+
+def _serve(opts, port_queue):
+    server = Server(opts, open(os.devnull, "w") if opts.stats == "-"
+      else open(opts.stats, "w"))
+    port_queue.put(server.port)
+    server.run()
+
+def _rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except (IOError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class _Counter(object):
+
+    def __init__(self):
+        self.lines = 0
+
+    def on_raw_recv(self, who, text):
+        self.lines += 1
+
+def soak(opts, stdout):
+    import kaeirc
+    import kaeirc.loop
+    port_queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_serve, args=(opts, port_queue))
+    proc.daemon = True
+    proc.start()
+    port = port_queue.get()
+    client = kaeirc.Client("soak", ("127.0.0.1", port))
+    client.set_flood_control(opts.flood_burst, opts.flood_rate)
+    counter = _Counter()
+    client.add_listener(counter)
+    client.connect()
+    client.join_channels([ "#chan%d" % i for i in xrange(opts.channels) ])
+    loop = kaeirc.loop.EventLoop()
+    loop.add_client(client)
+    start = time.time()
+    state = { "last": (start, 0), "sent": 0 }
+    print >>stdout, ("time,rss_kb,lines_in,in_rate,lines_sent,sendq_depth,"
+      "sendq_eta,channels,users")
+
+    def report():
+        now = time.time()
+        last_t, last_n = state["last"]
+        rate = (counter.lines - last_n) / max(now - last_t, 1e-6)
+        state["last"] = (now, counter.lines)
+        print >>stdout, "%.1f,%d,%d,%.1f,%d,%d,%.1f,%d,%d" % (now - start,
+          _rss_kb(), counter.lines, rate, state["sent"],
+          client.send_queue_depth, client.send_queue_eta,
+          len(client.channels), len(client.users))
+        stdout.flush()
+        if (now - start < opts.soak) and client.connected:
+            loop.call_later(opts.stats_interval, report)
+        else:
+            client.disconnect("Soak test finished")
+            loop.call_later(1, loop.stop)
+
+    def chatter():
+        if client.connected and client.channels:
+            name = random.choice(client.channels.values()).name
+            client.privmsg(name, " ".join(random.choice(WORDS)
+              for _ in xrange(random.randint(5, 120))))
+            state["sent"] += 1
+        if opts.client_rate > 0:
+            loop.call_later(1.0 / opts.client_rate, chatter)
+
+    loop.call_later(opts.stats_interval, report)
+    if opts.client_rate > 0:
+        loop.call_later(1.0 / opts.client_rate, chatter)
+    loop.run()
+    proc.terminate()
+    return 0
+
+#=============================================================================
+
+def main(argv=sys.argv, stdout=sys.stdout, stderr=sys.stderr):
+    prog, args = argv[0], argv[1:]
+    argp = argparse.ArgumentParser(
+        prog=prog,
+        description="Run a mock IRC server for load and soak testing."
+    )
+    argp.add_argument("--host", default="127.0.0.1",
+      help="Address to listen on (default: 127.0.0.1).")
+    argp.add_argument("-P", "--port", type=int, default=6667,
+      help="Port to listen on (default: 6667; 0 for any).")
+    argp.add_argument("-c", "--channels", type=int, default=10,
+      help="Number of channels (default: 10).")
+    argp.add_argument("-m", "--members", type=int, default=200,
+      help="Simulated users per channel (default: 200).")
+    argp.add_argument("-u", "--users", type=int, default=1000,
+      help="Number of simulated users (default: 1000).")
+    argp.add_argument("-r", "--rate", type=float, default=20,
+      help="Channel messages per second (default: 20).")
+    argp.add_argument("--netsplit-every", type=float, default=0,
+      help="Seconds between netsplits (default: 0, no netsplits).")
+    argp.add_argument("--split-fraction", type=float, default=0.3,
+      help="Fraction of users lost in a netsplit (default: 0.3).")
+    argp.add_argument("--split-duration", type=float, default=10,
+      help="Seconds until split users come back (default: 10).")
+    argp.add_argument("--lag", type=float, default=0,
+      help="Seconds to delay every line sent (default: 0).")
+    argp.add_argument("--read-rate", type=float, default=0,
+      help="Bytes per second read from each client (default: 0, no limit).")
+    argp.add_argument("--flood-burst", type=int, default=10,
+      help="Lines a client may send at once (default: 10, the same as"
+      " `kaeirc.Client').")
+    argp.add_argument("--flood-rate", type=float, default=0.5,
+      help="Lines per second a client may send after the burst"
+      " (default: 0.5).")
+    argp.add_argument("--flood-slack", type=float, default=0.5,
+      help="Tolerance, in lines, for flood checks (default: 0.5).")
+    argp.add_argument("--flood-kill", action="store_true",
+      help="Disconnect clients exceeding the flood limits.")
+    argp.add_argument("--script",
+      help="File with scheduled events.")
+    argp.add_argument("--stats", default="-",
+      help="File to write statistics to (default: standard output).")
+    argp.add_argument("--stats-interval", type=float, default=5,
+      help="Seconds between statistics lines (default: 5).")
+    argp.add_argument("--duration", type=float,
+      help="Stop after this many seconds.")
+    argp.add_argument("--soak", type=float,
+      help="Run a kaeirc.Client against the server for this many seconds.")
+    argp.add_argument("--client-rate", type=float, default=0.2,
+      help="Messages per second sent by the soak client; keep it below"
+      " `--flood-rate', or the client's send queue grows without bound"
+      " (default: 0.2).")
+    argp.add_argument("--seed", type=int, default=0,
+      help="Random seed (default: 0).")
+    try:
+        old_files = (sys.stdout, sys.stderr)
+        sys.stdout, sys.stderr = (stdout, stderr)
+        opts = argp.parse_args(args)
+        sys.stdout, sys.stderr = old_files
+    except SystemExit as e:
+        return e.code
+
+    if opts.soak:
+        opts.port = 0
+        return soak(opts, stdout)
+
+    try:
+        stats = stdout if opts.stats == "-" else open(opts.stats, "w")
+        server = Server(opts, stats)
+    except (IOError, socket.error) as e:
+        print >>stderr, e
+        return 1
+    print >>stderr, "Listening on %s:%d" % (opts.host, server.port)
+    try:
+        server.run(opts.duration)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,499 @@
+#! /usr/bin/env python2.7
+
+# replaybench.py: Replay recorded IRC traffic through `kaeirc.Client'.
+
+# This script feeds raw lines (as received from the server) to
+# `kaeirc.Client.on_received()', and reports the throughput, the per-line
+# latency, and the peak memory used, so regressions in the parser or the
+# dispatch code show up as numbers.
+
+# The input is a capture file with one raw line per line, optionally preceded
+# by a UNIX timestamp (as written by `--write'):
+#
+#   1395500000.250 :nick!user@host PRIVMSG #channel :Hello!
+#
+# If no capture is given, a synthetic one is generated with a mix of the
+# following kinds of traffic (see `--mix'):
+#   - chatty: messages, actions, and notices in busy channels.
+#   - names: joins to large channels, with their NAMES bursts.
+#   - netsplit: mass quits followed by mass joins.
+#   - ctcp: CTCP query floods.
+#
+# Each capture is replayed with the following setups (see `--setup'):
+#   - bare: a `kaeirc.Client' with no listeners.
+#   - pipe: the same, but reading the capture in 4 KB chunks from a
+#     `kaeirc.transport.pipe()', so the receive buffer and the decoding are
+#     measured too. Latencies are per chunk, divided by the lines in it.
+#   - listener: a listener formatting the events, like `ClientThread' does.
+#   - nullui: a real `kaechatlib.clientthread.ClientThread', with a frame
+#     which discards everything.
+
+import os
+import sys
+import time
+import Queue
+import random
+import resource
+import traceback
+import collections
+import multiprocessing
+
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__) or ".", "..", "lib"))
+
+import kaeirc
+import kaeirc.transport
+
+SETUPS = ("bare", "pipe", "listener", "nullui")
+
+PIPE_CHUNK = 4096
+
+MIXES = ("chatty", "names", "netsplit", "ctcp")
+
+WORDS = ("the a an of to in is it that for on with as was at by be this have"
+  " from or one had not but what all were when we there can your which their"
+  " said if do will each about how up out them then she many some so these"
+  " would other into has more her two like him see time could no make than"
+  " first been its who now people my made over did down only way find use"
+  " may water long little very after words called just where most").split()
+
+SERVER = "irc.example.net"
+
+#=============================================================================
+# Capture generation.
+
+class Scenario(object):
+
+    def __init__(self, opts):
+        self.rnd = random.Random(opts.seed)
+        self.nick = opts.nick
+        self.now = 1395500000.0
+        self.lines = [ ]
+        self.users = [ "user%d%s" % (i, self.rnd.choice(("", "_", "|away",
+          "[m]", "^"))) for i in xrange(opts.users) ]
+        self.channels = [ "#channel%d" % i for i in xrange(opts.channels) ]
+        self.members = { }
+        self.away = [ ]
+
+    def emit(self, line, delay=0.0):
+        self.now += delay
+        self.lines.append((self.now, line))
+
+    def mask(self, nick):
+        return "%s!~%s@%s.users.example.net" % (nick, nick[:8].strip("|[]^"),
+          nick.strip("|[]^"))
+
+    def text(self, lo=2, hi=25):
+        return " ".join(self.rnd.choice(WORDS)
+          for _ in xrange(self.rnd.randint(lo, hi)))
+
+    def header(self, members):
+        self.emit(":%s 001 %s :Welcome to the ExampleNet IRC Network %s"
+          % (SERVER, self.nick, self.mask(self.nick)))
+        self.emit(":%s 005 %s CHANTYPES=# PREFIX=(qaohv)~&@%%+"
+          " CHANMODES=beIq,k,flj,CFLMPQScgimnprstz MODES=4 CASEMAPPING=rfc1459"
+          " TARGMAX=PRIVMSG:4,NOTICE:4,KICK:1 NICKLEN=16 :are supported"
+          % (SERVER, self.nick))
+        for chan in self.channels:
+            self.join(chan, members)
+
+    def join(self, chan, count):
+        rnd = self.rnd
+        members = rnd.sample(self.users, min(count, len(self.users)))
+        self.members[chan] = members
+        self.emit(":%s JOIN %s" % (self.mask(self.nick), chan), 0.5)
+        for i in xrange(0, len(members), 30):
+            names = [ rnd.choice(("", "", "", "+", "@", "@+")) + n
+              for n in members[i:i+30] ]
+            self.emit(":%s 353 %s = %s :%s" % (SERVER, self.nick, chan,
+              " ".join(names)))
+        self.emit(":%s 366 %s %s :End of /NAMES list." % (SERVER, self.nick,
+          chan))
+
+    def chatty(self, count):
+        rnd = self.rnd
+        for _ in xrange(count):
+            chan = rnd.choice(self.channels)
+            who = self.mask(rnd.choice(self.members[chan]))
+            delay = rnd.expovariate(5.0)
+            r = rnd.random()
+            if r < 0.8:
+                self.emit(":%s PRIVMSG %s :%s" % (who, chan, self.text()),
+                  delay)
+            elif r < 0.9:
+                self.emit(":%s PRIVMSG %s :\1ACTION %s\1" % (who, chan,
+                  self.text()), delay)
+            elif r < 0.95:
+                self.emit(":%s NOTICE %s :%s" % (who, chan, self.text()),
+                  delay)
+            else:
+                self.emit("PING :%s" % SERVER, delay)
+
+    def names(self, count):
+        chan = "#big%d" % len(self.channels)
+        self.channels.append(chan)
+        self.join(chan, count)
+
+    def netsplit(self, count):
+        rnd = self.rnd
+        split = rnd.sample(self.users, min(count // 2, len(self.users)))
+        for nick in split:
+            self.emit(":%s QUIT :*.net *.split" % self.mask(nick))
+        self.emit("PING :%s" % SERVER, 30.0)
+        for nick in split:
+            for chan in self.channels:
+                if nick in self.members[chan]:
+                    self.emit(":%s JOIN %s" % (self.mask(nick), chan))
+
+    def ctcp(self, count):
+        rnd = self.rnd
+        for _ in xrange(count):
+            who = self.mask(rnd.choice(self.users))
+            query = rnd.choice(("VERSION", "PING %d" % rnd.randint(0, 1 << 30),
+              "TIME", "CLIENTINFO"))
+            self.emit(":%s PRIVMSG %s :\1%s\1" % (who, self.nick, query),
+              rnd.expovariate(50.0))
+
+def generate(opts):
+    sc = Scenario(opts)
+    sc.header(opts.members)
+    mixes = opts.mix.split(",")
+    per = opts.lines // len(mixes)
+    for mix in mixes:
+        getattr(sc, mix)(per)
+    return sc.lines
+
+#=============================================================================
+# Capture loading.
+
+def load(filename):
+    lines = [ ]
+    with open(filename, "rb") as f:
+        for raw in f:
+            raw = raw.rstrip("\r\n")
+            if not raw:
+                continue
+            stamp = None
+            sp = raw.find(" ")
+            if (sp != -1) and (raw[0] not in ":@"):
+                try:
+                    stamp = float(raw[:sp])
+                    raw = raw[sp+1:]
+                except ValueError:
+                    pass
+            lines.append((stamp, raw))
+    return lines
+
+def write(filename, lines):
+    with open(filename, "wb") as f:
+        for (stamp, line) in lines:
+            if stamp is not None:
+                f.write("%.3f " % stamp)
+            f.write(line)
+            f.write("\r\n")
+
+#=============================================================================
+# Setups.
+
+class EchoListener(object):
+    """Formats the events like `ClientThread', but keeps only the last few
+    lines in memory.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.log = collections.deque(maxlen=1000)
+
+    def on_privmsg(self, who, channel, text):
+        if text.startswith("\1") and text.endswith("\1"):
+            self.log.append("* %s %s" % (who[0], text[1:-1]))
+        else:
+            self.log.append("<%s> %s" % (who[0], text))
+
+    def on_notice(self, who, channel, text):
+        self.log.append("-%s- %s" % (who[0], text))
+
+    def on_join(self, who, channel):
+        self.log.append("%s (%s@%s) joined %s" % (who[0], who[1], who[2],
+          channel))
+
+    def on_part(self, who, channel, reason=None):
+        self.log.append("%s left %s (%s)" % (who[0], channel, reason))
+
+    def before_quit(self, who, reason=None):
+        user = self.client.users.get(who[0])
+        if user is not None:
+            for chan in user.channels:
+                self.log.append("%s quit (%s) [%s]" % (who[0], reason,
+                  chan.name))
+
+    def on_nick(self, who, nickname):
+        self.log.append("%s is now known as %s" % (who[0], nickname))
+
+    def on_mode(self, who, channel, mode=None, *args):
+        self.log.append("%s sets mode %s %s" % (who[0], mode,
+          " ".join(args)))
+
+    def on_rpl_endofnames(self, who, me, channel, message=None):
+        chan = self.client.channels.get(channel)
+        if chan is not None:
+            self.log.append(sorted(info.nickname
+              for info in chan.nicknames.itervalues()))
+
+class NullChannelFrame(object):
+
+    class _Var(object):
+        def set(self, value):
+            pass
+
+    _topicvar = _Var()
+
+class NullUpdates(object):
+    """Stand-in for `kaechatlib.ui.updates.UpdateQueue', running the updates
+    right away.
+    """
+
+    def post(self, fn, *args, **kw):
+        fn(*args, **kw)
+
+    def echo(self, frame, text, who=None, channel=None, prefix="",
+      event=None):
+        frame.echo(text, who=who, channel=channel, prefix=prefix, event=event)
+
+    def refresh_userlist(self, frame, channel):
+        frame.refresh_userlist(channel)
+
+    def change_userlist(self, frame, channel, change):
+        frame.change_userlist(channel, [ change ])
+
+class NullFrame(object):
+    """Stand-in for `kaechatlib.ui.mainframe.NetworkFrame'."""
+
+    class _Label(object):
+        def configure(self, **kw):
+            pass
+
+    class _Network(object):
+        nicks = None
+        username = None
+        realname = None
+        channels = None
+        address = ("localhost", 6667)
+
+    def __init__(self, nick):
+        self.network = self._Network()
+        self.network.nicks = [ nick ]
+        self.active = True
+        self.cur_channel = None
+        self._nicklabel = self._Label()
+        self._pagename = "bench"
+        self.updates = NullUpdates()
+        self.count = 0
+
+    def echo(self, text, **kw):
+        self.count += 1
+
+    def refresh_userlist(self, channel):
+        self.count += 1
+
+    def change_userlist(self, channel, changes):
+        self.count += 1
+
+    def set_topic(self, channel, topic):
+        pass
+
+    def select_channel(self, channel):
+        self.cur_channel = channel
+
+    def get_channel_frame(self, channel=None, create=True):
+        return NullChannelFrame()
+
+def make_client(setup, nick):
+    if setup == "nullui":
+        from ConfigParser import ConfigParser
+        import kaechatlib as _kl
+        import kaechatlib.config as _kc
+        import kaechatlib.clientthread as _kct
+        _kc.config = ConfigParser()
+        _kc.update_config()
+        class NullNotebook(object):
+            def raise_page(self, name):
+                pass
+        class NullMainFrame(object):
+            _notebook = NullNotebook()
+        _kl.mainframe = NullMainFrame()
+        _kct._show_notification = lambda title, message: None
+        return _kct.ClientThread(NullFrame(nick)).client
+    c = kaeirc.Client(nick, ("localhost", 6667), nickname=nick)
+    if setup == "listener":
+        c.add_listener(EchoListener(c))
+    elif setup == "pipe":
+        peer, transport = kaeirc.transport.pipe()
+        peer.send(":server 001 %s :Welcome %s!%s@localhost\r\n"
+          % (nick, nick, nick))
+        c.connect(transport=transport)
+        c.peer = peer
+    return c
+
+#=============================================================================
+# Measurement.
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def replay(setup, nick, lines, passes):
+    texts = [ unicode(line, "utf-8", "replace") for (_, line) in lines ]
+    data = "".join(line + "\r\n" for (_, line) in lines)
+    best = None
+    latencies = [ ]
+    clock = time.time
+    for _ in xrange(passes):
+        c = make_client(setup, nick)
+        c.set_flood_control(rate=None)
+        on_received = c.on_received
+        lat = [ ]
+        append = lat.append
+        st = clock()
+        if setup == "pipe":
+            peer, poll = c.peer, c.poll
+            for i in xrange(0, len(data), PIPE_CHUNK):
+                chunk = data[i:i+PIPE_CHUNK]
+                t = clock()
+                peer.send(chunk)
+                poll()
+                n = chunk.count("\n") or 1
+                lat.extend([ (clock() - t) / n ] * n)
+                if peer.pending():
+                    peer.recv(peer.pending())
+        else:
+            for text in texts:
+                t = clock()
+                on_received(text)
+                append(clock() - t)
+        total = clock() - st
+        if (best is None) or (total < best):
+            best, latencies = total, lat
+    latencies.sort()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (len(texts) / best, percentile(latencies, 50),
+      percentile(latencies, 99), peak)
+
+class ReplayError(Exception):
+    """Raised by `replay_isolated()' if the replay fails."""
+
+def _replay_child(queue, args):
+    try:
+        queue.put((True, replay(*args)))
+    except Exception:
+        queue.put((False, traceback.format_exc()))
+
+def replay_isolated(*args):
+    # Run in a new process, so the peak memory only counts this setup.
+    # Errors in the child are reported back; if it dies without reporting
+    # anything (like when killed), this doesn't wait forever.
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_replay_child, args=(queue, args))
+    p.start()
+    while True:
+        try:
+            ok, r = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            if not p.is_alive():
+                try:
+                    ok, r = queue.get_nowait()
+                    break
+                except Queue.Empty:
+                    raise ReplayError("Replay process exited with code %s"
+                      % p.exitcode)
+    p.join()
+    if not ok:
+        raise ReplayError(r)
+    return r
+
+def main(argv=sys.argv, stdout=sys.stdout, stderr=sys.stderr):
+    prog, args = argv[0], argv[1:]
+    argp = argparse.ArgumentParser(
+        prog=prog,
+        description="Measure the throughput of kaeirc.Client.on_received."
+    )
+    argp.add_argument("capture", nargs="?",
+      help="Capture file to replay (default: generate one).")
+    argp.add_argument("-s", "--setup", default=",".join(SETUPS),
+      help="Comma-separated list of setups (default: %s)." % ",".join(SETUPS))
+    argp.add_argument("-m", "--mix", default=",".join(MIXES),
+      help="Traffic for the generated capture (default: %s)."
+      % ",".join(MIXES))
+    argp.add_argument("-n", "--lines", type=int, default=100000,
+      help="Approximate number of generated lines (default: 100000).")
+    argp.add_argument("-c", "--channels", type=int, default=20,
+      help="Channels in the generated capture (default: 20).")
+    argp.add_argument("-M", "--members", type=int, default=300,
+      help="Members per channel (default: 300).")
+    argp.add_argument("-u", "--users", type=int, default=3000,
+      help="Distinct users (default: 3000).")
+    argp.add_argument("-N", "--nick", default="Kae",
+      help="Our nickname in the capture (default: Kae).")
+    argp.add_argument("-p", "--passes", type=int, default=3,
+      help="Passes per setup; the best is reported (default: 3).")
+    argp.add_argument("-w", "--write",
+      help="Write the generated capture to this file and exit.")
+    argp.add_argument("--seed", type=int, default=0,
+      help="Random seed (default: 0).")
+    try:
+        old_files = (sys.stdout, sys.stderr)
+        sys.stdout, sys.stderr = (stdout, stderr)
+        opts = argp.parse_args(args)
+        sys.stdout, sys.stderr = old_files
+    except SystemExit as e:
+        return e.code
+
+    for mix in opts.mix.split(","):
+        if not mix in MIXES:
+            print >>stderr, "Unknown traffic mix: %s" % mix
+            return 1
+    setups = opts.setup.split(",")
+    for setup in setups:
+        if not setup in SETUPS:
+            print >>stderr, "Unknown setup: %s" % setup
+            return 1
+
+    if opts.capture:
+        try:
+            lines = load(opts.capture)
+        except IOError as e:
+            print >>stderr, e
+            return 1
+    else:
+        lines = generate(opts)
+    if opts.write:
+        write(opts.write, lines)
+        return 0
+
+    stamps = [ stamp for (stamp, _) in lines if stamp is not None ]
+    print >>stdout, "%d lines" % len(lines),
+    if len(stamps) > 1 and (stamps[-1] > stamps[0]):
+        print >>stdout, "(recorded at %.1f lines/sec)" % (len(stamps)
+          / (stamps[-1] - stamps[0])),
+    print >>stdout
+    print >>stdout, "%-10s %12s %10s %10s %12s" % ("setup", "lines/sec",
+      "p50 (us)", "p99 (us)", "peak RSS (KB)")
+    status = 0
+    for setup in setups:
+        try:
+            rate, p50, p99, peak = replay_isolated(setup, opts.nick, lines,
+              opts.passes)
+        except ReplayError as e:
+            print >>stdout, "%-10s %12s" % (setup, "failed")
+            print >>stderr, e
+            status = 1
+            continue
+        print >>stdout, "%-10s %12d %10.1f %10.1f %12d" % (setup, rate,
+          p50 * 1e6, p99 * 1e6, peak)
+    return status
+
+if __name__ == "__main__":
+    exit(main())